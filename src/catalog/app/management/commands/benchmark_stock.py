@@ -0,0 +1,58 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from django.core.management.base import BaseCommand
+from app.utils import catalogs, StockTable, STOCK_LOCK_STRIPES
+
+
+class HeldStockTable(StockTable):
+    """
+    A stock table whose operations hold their locks for `hold` seconds more, to model slower
+    critical sections. Its results include that sleep, so they are reported apart from those
+    of the real table.
+    """
+
+    def __init__(self, products, stripes, hold):
+        super().__init__(products, stripes)
+        self.hold = hold
+
+    @contextmanager
+    def locked(self, names):
+        with super().locked(names):
+            if self.hold:
+                time.sleep(self.hold)
+            yield
+
+
+class Command(BaseCommand):
+    help = "Measure stock decrements per second with many threads, with one global lock and with striped locks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=16, help="Threads decrementing the stock")
+        parser.add_argument("--orders", type=int, default=5000, help="Decrements per scenario")
+        parser.add_argument("--hold", type=float, default=0.0001, help="Seconds of simulated work under the lock, for a second set of results, 0 to skip it")
+
+    def run(self, stripes, names, threads, orders, hold):
+        # More stock than orders, so every decrement succeeds and the final quantity can be checked
+        products = {name: {"name": name, "price": catalogs[name]["price"], "quantity": orders} for name in names}
+        # With a single stripe, the table behaves like one global lock
+        table = HeldStockTable(products, stripes, hold) if hold else StockTable(products, stripes)
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            taken = sum(pool.map(lambda i: table.try_decrement(names[i % len(names)], 1), range(orders)))
+        elapsed = time.perf_counter() - start_time
+        assert taken == orders and sum(product["quantity"] for product in products.values()) == orders * (len(names) - 1)
+        return orders / elapsed
+
+    def handle(self, *args, **options):
+        threads, orders, hold = options["threads"], options["orders"], options["hold"]
+        scenarios = {"one product": ["Tux"], "all products": list(catalogs)}
+        # The real decrements first, then the same with simulated work under the lock
+        variants = [("no added hold", 0)] + ([(f"{hold * 1e6:.0f}us simulated hold", hold)] if hold else [])
+        self.stdout.write(f"{threads} threads, {orders} decrements")
+        self.stdout.write(f"{'decrements/s':<44}{'global lock':>14}{'striped':>12}{'speedup':>10}")
+        for variant, variant_hold in variants:
+            for scenario, names in scenarios.items():
+                single = self.run(1, names, threads, orders, variant_hold)
+                striped = self.run(STOCK_LOCK_STRIPES, names, threads, orders, variant_hold)
+                self.stdout.write(f"{scenario + ', ' + variant:<44}{single:>14,.0f}{striped:>12,.0f}{striped / single:>9.1f}x")
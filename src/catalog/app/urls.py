@@ -6,6 +6,11 @@ from django.views.decorators.csrf import csrf_exempt
 urlpatterns = [
     path('products/<str:product_name>/', views.get_product),
     path('orders/', csrf_exempt(views.post_order)),
+    path('reservations/', csrf_exempt(views.post_reservation)),
+    path('reservations/<str:reservation_id>/confirm/', csrf_exempt(views.post_reservation_confirm)),
+    path('reservations/<str:reservation_id>/renew/', csrf_exempt(views.post_reservation_renew)),
+    path('reservations/<str:reservation_id>/release/', csrf_exempt(views.post_reservation_release)),
+    path('stats/admission/', views.get_admission_stats),
     path('cache/restock/', csrf_exempt(views.post_cache_restock)),
 ]
 
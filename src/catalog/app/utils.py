@@ -1,3 +1,4 @@
+from contextlib import contextmanager
 from threading import Lock, RLock
 
 
@@ -14,6 +15,9 @@ catalogs = {
     "Elephant": {"name": "Elephant", "price": 20.0, "quantity": 100},
 }
 
+# Number of locks the products of the stock table are spread over
+STOCK_LOCK_STRIPES = 64
+
 
 class ReadWriteLock:
     """
@@ -70,4 +74,100 @@ class ReadWriteLock:
         """
         Exit the context manager. Releases the write lock.
         """
-        self.release_write()
\ No newline at end of file
+        self.release_write()
+
+
+class StockTable:
+    """
+    The in-memory stock of the products. Products are spread over a fixed number of locks by
+    the hash of their names, so updates of different products do not wait for each other, while
+    the check and the update of a product's quantity happen under the same lock. Operations on
+    several products take their locks in stripe order, so they cannot deadlock. The quantity of
+    a product is its stock minus the quantity reserved.
+    """
+
+    def __init__(self, products=None, stripes=STOCK_LOCK_STRIPES):
+        self.products = products if products is not None else {}  # name -> {"name", "price", "quantity"}
+        self.reserved = {}  # name -> quantity reserved
+        self.locks = [Lock() for _ in range(stripes)]
+
+    @contextmanager
+    def locked(self, names):
+        locks = [self.locks[stripe] for stripe in sorted({hash(name) % len(self.locks) for name in names})]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def get(self, name):
+        with self.locked([name]):
+            product = self.products.get(name)
+            return dict(product) if product is not None else None
+
+    def add(self, name, price, quantity):
+        """
+        Add a product with its stock, or replace the price and stock of a known one.
+        """
+        with self.locked([name]):
+            self.products[name] = {"name": name, "price": price, "quantity": quantity - self.reserved.get(name, 0)}
+
+    def restock(self, name, quantity):
+        """
+        Set the stock of a known product, the quantity reserved stays unavailable. Returns
+        whether the product is known.
+        """
+        with self.locked([name]):
+            product = self.products.get(name)
+            if product is None:
+                return False
+            product["quantity"] = quantity - self.reserved.get(name, 0)
+            return True
+
+    def try_decrement(self, name, quantity):
+        """
+        Take `quantity` of a product if that much is left, so the quantity never goes negative.
+        Returns whether it was taken. Raises KeyError for an unknown product.
+        """
+        with self.locked([name]):
+            product = self.products[name]
+            if quantity > product["quantity"]:
+                return False
+            product["quantity"] -= quantity
+            return True
+
+    def try_decrement_many(self, quantities, reserve=False):
+        """
+        Take the quantity of every product in `quantities`, or of none. Returns None if they were
+        taken, otherwise the name of a product short of stock. Raises KeyError for an unknown
+        product. Reserved quantities are counted as reserved until confirmed or given back.
+        """
+        with self.locked(quantities):
+            for name, quantity in quantities.items():
+                if quantity > self.products[name]["quantity"]:
+                    return name
+            for name, quantity in quantities.items():
+                self.products[name]["quantity"] -= quantity
+                if reserve:
+                    self.reserved[name] = self.reserved.get(name, 0) + quantity
+        return None
+
+    def increment(self, quantities, reserved=False):
+        """
+        Give back quantities taken, and stop counting them as reserved if they were.
+        """
+        with self.locked(quantities):
+            for name, quantity in quantities.items():
+                self.products[name]["quantity"] += quantity
+                if reserved:
+                    self.reserved[name] -= quantity
+
+    def confirm(self, quantities):
+        """
+        Stop counting reserved quantities as reserved once they are sold.
+        """
+        with self.locked(quantities):
+            for name, quantity in quantities.items():
+                self.reserved[name] -= quantity
@@ -1,12 +1,18 @@
+import heapq
 import json
+import os
+import threading
+import time
+import uuid
 import requests
 from celery import shared_task
-from concurrent.futures import ThreadPoolExecutor
 from django.db import transaction
+from django.db.models import F
 from django.http import JsonResponse
 from django.views.decorators.http import require_GET, require_POST, require_http_methods
 from .models import Product
-from .utils import catalogs, ReadWriteLock
+from common.admission import AdmissionExecutor
+from .utils import catalogs, ReadWriteLock, StockTable
 
 
 # Define the host and port for the frontend server
@@ -15,35 +21,56 @@ FRONTEND_SERVER_PORT = "8000"
 CATALOG_SERVER_HOST = "localhost"
 CATALOG_SERVER_PORT = "8001"
 
-# Create a read-write lock for accessing on-disk and in-memory product data
+# Create a read-write lock for replacing on-disk product data
 products_lock = ReadWriteLock()
-catalogs_lock = ReadWriteLock()
 
-# Create a thread pool executor for concurrent task execution
-executor = ThreadPoolExecutor()
+# Bounds of the work queue in tasks and in seconds of waiting, beyond which requests are shed
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", "100"))
+ADMISSION_MAX_QUEUE_TIME = float(os.environ.get("ADMISSION_MAX_QUEUE_TIME", "1.0"))
+# Most stock updates served at once, so they cannot take all workers from product reads
+ENDPOINT_CONCURRENCY_LIMITS = {
+    "process_post_order_request": 16,
+    "process_post_reservation_request": 16,
+    "process_post_reservation_confirm_request": 16,
+}
 
-# Create in memory
-catalogs_in_memory = dict()
+# Workers of the separate pools serving reads, writes and internal traffic
+READ_POOL_WORKERS = int(os.environ.get("READ_POOL_WORKERS", "8"))
+WRITE_POOL_WORKERS = int(os.environ.get("WRITE_POOL_WORKERS", "8"))
+INTERNAL_POOL_WORKERS = int(os.environ.get("INTERNAL_POOL_WORKERS", "4"))
+
+# Create thread pool executors for concurrent task execution, with admission control. Views
+# submit product reads to the read pool, stock updates and reservations to the write pool, and cache restocks
+# to the internal pool, so a stall in one of them cannot take the workers of the others.
+read_executor = AdmissionExecutor(READ_POOL_WORKERS, ADMISSION_MAX_QUEUE, ADMISSION_MAX_QUEUE_TIME, ENDPOINT_CONCURRENCY_LIMITS, name="read")
+write_executor = AdmissionExecutor(WRITE_POOL_WORKERS, ADMISSION_MAX_QUEUE, ADMISSION_MAX_QUEUE_TIME, ENDPOINT_CONCURRENCY_LIMITS, name="write")
+internal_executor = AdmissionExecutor(INTERNAL_POOL_WORKERS, ADMISSION_MAX_QUEUE, ADMISSION_MAX_QUEUE_TIME, ENDPOINT_CONCURRENCY_LIMITS, name="internal")
+executors = (read_executor, write_executor, internal_executor)
+
+# Stock of the products in memory, with one lock per stripe of products
+stock = StockTable()
+
+# Seconds a stock reservation is held by default and at most, unless it is confirmed or released
+RESERVATION_TTL = 30
+RESERVATION_MAX_TTL = 300
+
+# Stock reservations by ID, with their expiry times. The stock table counts the quantity
+# reserved of each product.
+reservations_lock = threading.Lock()
+reservations = dict()
+reservation_expiries = []
 
 
 @shared_task
 def restock_product():
-    global catalogs_in_memory
     for product in catalogs.values():
         try:
             # Retrieve details for every product in the catalog
             with products_lock:
                 product_in_db = Product.objects.get(name=product["name"])
-            with catalogs_lock:
-                product_in_memory = catalogs_in_memory.get(product["name"], None)
-
-            if not product_in_memory:
-                with catalogs_lock:
-                    catalogs_in_memory[product["name"]] = {
-                        "name": product_in_db.name,
-                        "price": product_in_db.price,
-                        "quantity": product_in_db.quantity
-                    }
+
+            if stock.get(product["name"]) is None:
+                stock.add(product_in_db.name, product_in_db.price, product_in_db.quantity)
             product_in_db = Product.objects.get(name=product["name"])
             
             # Check whether each product is out of stock
@@ -52,8 +79,7 @@ def restock_product():
                 with products_lock:
                     product_in_db.quantity = product["quantity"]
                     product_in_db.save()
-                with catalogs_lock:
-                    catalogs_in_memory[product["name"]]["quantity"] = product["quantity"]
+                stock.restock(product["name"], product["quantity"])
                 
                 # Send request to the frontend server to invalidate the restocked product in the cache
                 product_in_db.quantity = product["quantity"]
@@ -75,68 +101,170 @@ def restock_product():
                     price = product["price"],
                     quantity = product["quantity"]
             )
-            with catalogs_lock:
-                catalogs_in_memory[product["name"]] = {
-                    "name": product["name"],
-                    "price": product["price"],
-                    "quantity": product["quantity"]
-                }
+            stock.add(product["name"], product["price"], product["quantity"])
         except Exception as e:
             pass
 
 
 def process_get_product_request(product_name):
-    global catalogs_in_memory
     try:
-        # Get the product detail from the database
-        with catalogs_lock:
-            product = catalogs_in_memory.get(product_name, None)
-            if product:
-                return JsonResponse(status = 200, data = {"data": product})
-            else:
-                return JsonResponse(status = 404, data = {"error": {"code": 404, "message": "Product not found"}})
+        # Get the product detail from memory
+        product = stock.get(product_name)
+        if product:
+            return JsonResponse(status = 200, data = {"data": product})
+        else:
+            return JsonResponse(status = 404, data = {"error": {"code": 404, "message": "Product not found"}})
     except Exception as e:
         return JsonResponse(status = 500, data={"error": {"code": 500, "message": "Internal server error"}})
 
 
-def process_post_order_request(order_data):
-    global catalogs_in_memory
+def take_stock_from_database(quantities):
+    '''
+    Take the quantities of the products out of the database in one transaction, with relative
+    updates, so concurrent orders of other products do not wait. If it fails, the stock taken
+    in memory is given back.
+    '''
     try:
         with transaction.atomic():
-            # Check whether the product exists
-            with catalogs_lock:
-                product_in_memory = catalogs_in_memory.get(order_data["name"], None)
+            for name, quantity in quantities.items():
+                if not Product.objects.filter(name=name).update(quantity=F("quantity") - quantity):
+                    raise Product.DoesNotExist
+    except Exception as e:
+        stock.increment(quantities)
+        raise
 
-            # Check whether the stock quantity is adequate
-            if order_data["quantity"] > product_in_memory["quantity"]:
-                return JsonResponse(status=400, data={"error": {"code": 400, "message": "No sufficient stock"}})
 
-            # Update the product quantity
-            with catalogs_lock:
-                catalogs_in_memory[order_data["name"]]["quantity"] -= order_data["quantity"]
-            with products_lock:
-                product_in_db = Product.objects.get(name = order_data["name"])
-                product_in_db.quantity -= order_data["quantity"]
-                product_in_db.save()
+def process_post_order_request(order_data):
+    try:
+        name, quantity = order_data["name"], order_data["quantity"]
+        # Check and take the stock in one step, so concurrent orders cannot oversell
+        try:
+            if not stock.try_decrement(name, quantity):
+                return JsonResponse(status=400, data={"error": {"code": 400, "message": "No sufficient stock"}})
+        except KeyError:
+            return JsonResponse(status=404, data={"error": {"code": 404, "message": "Product not found"}})
+        take_stock_from_database({name: quantity})
 
-            # Send request to the frontend server to invalidate the ordered product in the cache
-            requests.delete(f"http://{FRONTEND_SERVER_HOST}:{FRONTEND_SERVER_PORT}/cache/{order_data['name']}/")
+        # Send request to the frontend server to invalidate the ordered product in the cache
+        requests.delete(f"http://{FRONTEND_SERVER_HOST}:{FRONTEND_SERVER_PORT}/cache/{name}/")
 
-            # Return success response
-            return JsonResponse(status=200, data={"data": {"message": "Product stock updated successfully"}})
+        # Return success response
+        return JsonResponse(status=200, data={"data": {"message": "Product stock updated successfully"}})
     except Product.DoesNotExist:
         return JsonResponse(status=404, data={"error": {"code": 404, "message": "Product not found"}})
     except Exception as e:
         return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
 
 
+def expire_reservations():
+    '''
+    Give the stock of expired reservations back. The caller holds reservations_lock.
+    '''
+    now = time.monotonic()
+    while reservation_expiries and reservation_expiries[0][0] <= now:
+        expires, reservation_id = heapq.heappop(reservation_expiries)
+        reservation = reservations.get(reservation_id)
+        if reservation is not None and reservation["expires"] == expires:
+            del reservations[reservation_id]
+            stock.increment(reservation["items"], reserved=True)
+
+
+def invalidate_frontend_cache(product_names):
+    # Send requests to the frontend server to invalidate the products in the cache
+    for name in product_names:
+        try:
+            requests.delete(f"http://{FRONTEND_SERVER_HOST}:{FRONTEND_SERVER_PORT}/cache/{name}/")
+        except Exception as e:
+            pass
+
+
+def process_post_reservation_request(reservation_data):
+    '''
+    Reserve the stock of every item or of none, for `ttl` seconds. The stock is taken from the
+    in-memory quantities right away, so concurrent reservations can never oversell.
+    '''
+    quantities = {}
+    for item in reservation_data.get("orders", []):
+        quantities[item["name"]] = quantities.get(item["name"], 0) + item["quantity"]
+    if not quantities or any(quantity <= 0 for quantity in quantities.values()):
+        return JsonResponse(status=400, data={"error": {"code": 400, "message": "Invalid reservation"}})
+    ttl = min(float(reservation_data.get("ttl", RESERVATION_TTL)), RESERVATION_MAX_TTL)
+
+    with reservations_lock:
+        expire_reservations()
+    try:
+        short = stock.try_decrement_many(quantities, reserve=True)
+    except KeyError as e:
+        return JsonResponse(status=404, data={"error": {"code": 404, "message": f"Product {e.args[0]} not found"}})
+    if short is not None:
+        return JsonResponse(status=400, data={"error": {"code": 400, "message": f"No sufficient stock of {short}"}})
+    reservation_id = uuid.uuid4().hex
+    expires = time.monotonic() + ttl
+    with reservations_lock:
+        reservations[reservation_id] = {"items": quantities, "expires": expires}
+        heapq.heappush(reservation_expiries, (expires, reservation_id))
+
+    invalidate_frontend_cache(quantities)
+    return JsonResponse(status=200, data={"data": {"reservation_id": reservation_id, "ttl": ttl}})
+
+
+def process_post_reservation_confirm_request(reservation_id):
+    '''
+    Take the reserved stock out of the database for good.
+    '''
+    with reservations_lock:
+        expire_reservations()
+        reservation = reservations.pop(reservation_id, None)
+    if reservation is None:
+        return JsonResponse(status=404, data={"error": {"code": 404, "message": "Reservation not found or expired"}})
+    try:
+        with transaction.atomic():
+            for name, quantity in reservation["items"].items():
+                Product.objects.filter(name=name).update(quantity=F("quantity") - quantity)
+    except Exception as e:
+        # Keep the reservation, so it can be confirmed again or expire
+        with reservations_lock:
+            reservations[reservation_id] = reservation
+            heapq.heappush(reservation_expiries, (reservation["expires"], reservation_id))
+        raise
+    stock.confirm(reservation["items"])
+    return JsonResponse(status=200, data={"data": {"message": "Product stock updated successfully"}})
+
+
+def process_post_reservation_renew_request(reservation_id, renew_data):
+    '''
+    Hold a reservation for another `ttl` seconds from now, while the outcome of its orders is
+    not known yet.
+    '''
+    ttl = min(float(renew_data.get("ttl", RESERVATION_TTL)), RESERVATION_MAX_TTL)
+    with reservations_lock:
+        expire_reservations()
+        reservation = reservations.get(reservation_id)
+        if reservation is None:
+            return JsonResponse(status=404, data={"error": {"code": 404, "message": "Reservation not found or expired"}})
+        # The entry of the old expiry time stays in the heap and is skipped when it comes up
+        reservation["expires"] = time.monotonic() + ttl
+        heapq.heappush(reservation_expiries, (reservation["expires"], reservation_id))
+    return JsonResponse(status=200, data={"data": {"reservation_id": reservation_id, "ttl": ttl}})
+
+
+def process_post_reservation_release_request(reservation_id):
+    '''
+    Give the reserved stock back. Releasing an unknown or expired reservation does nothing.
+    '''
+    with reservations_lock:
+        expire_reservations()
+        reservation = reservations.pop(reservation_id, None)
+    if reservation is not None:
+        stock.increment(reservation["items"], reserved=True)
+        invalidate_frontend_cache(reservation["items"])
+    return JsonResponse(status=200, data={"data": {"message": "Reservation released"}})
+
+
 def process_post_cache_restock_request(restock_data):
     if "product_name" in restock_data and "quantity" in restock_data:
-        product_name = restock_data["product_name"]
-        quantity = restock_data["quantity"]
-        if product_name in catalogs_in_memory:
-            with catalogs_lock:
-                catalogs_in_memory[product_name]["quantity"] = quantity
+        # The stock held by open reservations stays unavailable
+        stock.restock(restock_data["product_name"], restock_data["quantity"])
 
     # Return response indicating that the product cache restock was successful
     return JsonResponse(status=200, data={"data": {"message": f"Cache restock successfully"}})
@@ -146,7 +274,7 @@ def process_post_cache_restock_request(restock_data):
 def get_product(request, product_name):
     try:
         # Submit a task to the thread pool executor
-        future = executor.submit(process_get_product_request, product_name)
+        future = read_executor.submit(process_get_product_request, product_name)
         # Wait for the result of execution
         response = future.result()
         return response
@@ -160,7 +288,7 @@ def post_order(request):
         # Extract data from the request
         order_data = json.loads(request.body)
         # Submit a task to the thread pool executor
-        future = executor.submit(process_post_order_request, order_data)
+        future = write_executor.submit(process_post_order_request, order_data)
         # Wait for the result of execution
         response = future.result()
         return response
@@ -168,17 +296,67 @@ def post_order(request):
         print(e)
         return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
 
+@require_POST
+def post_reservation(request):
+    try:
+        # Extract data from the request
+        reservation_data = json.loads(request.body)
+        # Submit a task to the thread pool executor
+        future = write_executor.submit(process_post_reservation_request, reservation_data)
+        # Wait for the result of execution
+        response = future.result()
+        return response
+    except Exception as e:
+        return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+
+@require_POST
+def post_reservation_confirm(request, reservation_id):
+    try:
+        future = write_executor.submit(process_post_reservation_confirm_request, reservation_id)
+        response = future.result()
+        return response
+    except Exception as e:
+        return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+
+@require_POST
+def post_reservation_renew(request, reservation_id):
+    try:
+        renew_data = json.loads(request.body) if request.body else {}
+        future = write_executor.submit(process_post_reservation_renew_request, reservation_id, renew_data)
+        response = future.result()
+        return response
+    except Exception as e:
+        return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+
+@require_POST
+def post_reservation_release(request, reservation_id):
+    try:
+        future = write_executor.submit(process_post_reservation_release_request, reservation_id)
+        response = future.result()
+        return response
+    except Exception as e:
+        return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+
 @require_POST
 def post_cache_restock(request):
     try:
         # Extract data from the request
         restock_data = json.loads(request.body)
         # Submit a task to the thread pool executor
-        future = executor.submit(process_post_cache_restock_request, restock_data)
+        future = internal_executor.submit(process_post_cache_restock_request, restock_data)
         # Wait for the result of execution
         response = future.result()
         return response
     except Exception as e:
         print(e)
         return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
-    
\ No newline at end of file
+
+
+@require_GET
+def get_admission_stats(request):
+    # Served outside of the executor, so the stats stay visible while requests are shed
+    return JsonResponse(status=200, data={"data": {"pools": {executor.name: executor.to_dict() for executor in executors}}})
@@ -1,16 +1,19 @@
 import pytest
 from rest_framework import status
 import json
+import time
 from unittest import mock
 from app.models import Product
-from app.views import process_get_product_request, process_post_order_request, process_post_cache_restock_request
+from app.views import process_get_product_request, process_post_order_request, process_post_cache_restock_request, process_post_reservation_request, process_post_reservation_confirm_request, process_post_reservation_renew_request, process_post_reservation_release_request
+from app.utils import StockTable
+from concurrent.futures import ThreadPoolExecutor
 
 def test_get_product_success():
     product_name = "Tux"
     catalogs_in_memory = {"Tux": {"name": "Tux", "price": 6.90, "quantity": 81}}
     expected_response = {"data": {"name": "Tux", "price": 6.90, "quantity": 81}}
 
-    with mock.patch("app.views.catalogs_in_memory", catalogs_in_memory):
+    with mock.patch("app.views.stock", StockTable(catalogs_in_memory)):
         response = process_get_product_request(product_name)
 
     assert response.status_code == status.HTTP_200_OK
@@ -24,7 +27,7 @@ def test_get_product_fail():
     catalogs_in_memory = {}
     expected_response = {"error": {"code": 404, "message": "Product not found"}}
 
-    with mock.patch("app.views.catalogs_in_memory", catalogs_in_memory):
+    with mock.patch("app.views.stock", StockTable(catalogs_in_memory)):
         response = process_get_product_request(prodcut_name)
 
     assert response.status_code == status.HTTP_404_NOT_FOUND
@@ -43,7 +46,7 @@ def test_post_order_success():
     catalogs_in_memory = {"Tux": {"name": "Tux", "price": 6.90, "quantity": initial_quantity}}
     expected_response = {"data": {"message": "Product stock updated successfully"}}
 
-    with mock.patch("app.views.catalogs_in_memory", catalogs_in_memory):
+    with mock.patch("app.views.stock", StockTable(catalogs_in_memory)):
         response = process_post_order_request(order_data)
 
     assert response.status_code == status.HTTP_200_OK
@@ -66,7 +69,7 @@ def test_post_order_fail():
     catalogs_in_memory = {"Tux": {"name": "Tux", "price": 6.90, "quantity": initial_quantity}}
     expected_response = {"error": {"code": 400, "message": "No sufficient stock"}}
 
-    with mock.patch("app.views.catalogs_in_memory", catalogs_in_memory):
+    with mock.patch("app.views.stock", StockTable(catalogs_in_memory)):
         response = process_post_order_request(order_data)
 
     assert response.status_code == 400
@@ -81,7 +84,7 @@ def test_post_cache_restock_success():
     expected_response = {"data": {"message": f"Cache restock successfully"}}
     restock_product_data = {"product_name": "Tux", "quantity": 100}
 
-    with mock.patch("app.views.catalogs_in_memory", catalogs_in_memory):
+    with mock.patch("app.views.stock", StockTable(catalogs_in_memory)):
         response = process_post_cache_restock_request(restock_product_data)
 
     assert response.status_code == status.HTTP_200_OK
@@ -90,4 +93,76 @@ def test_post_cache_restock_success():
     print("test_post_cache_restock_success:", response.status_code, expected_response)
     assert catalogs_in_memory["Tux"]["quantity"] == restock_product_data["quantity"]
 
-    
\ No newline at end of file
+    
+
+
+@pytest.mark.django_db
+def test_reservations_never_oversell():
+    Product.objects.create(name="Tux", price=6.90, quantity=10)
+    catalogs_in_memory = {"Tux": {"name": "Tux", "price": 6.90, "quantity": 10}}
+
+    with mock.patch("app.views.stock", StockTable(catalogs_in_memory)), mock.patch("app.views.requests.delete"), \
+            mock.patch("app.views.reservations", {}), mock.patch("app.views.reservation_expiries", []):
+        # 30 buyers race for 10 Tux, only 10 of them get a reservation
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            responses = list(pool.map(lambda _: process_post_reservation_request({"orders": [{"name": "Tux", "quantity": 1}]}), range(30)))
+        reserved = [json.loads(response.content)["data"]["reservation_id"] for response in responses if response.status_code == 200]
+        assert len(reserved) == 10
+        assert catalogs_in_memory["Tux"]["quantity"] == 0
+
+        for reservation_id in reserved[:6]:
+            assert process_post_reservation_confirm_request(reservation_id).status_code == 200
+        for reservation_id in reserved[6:8]:
+            process_post_reservation_release_request(reservation_id)
+        # The last two expire and give their stock back
+        expiring = process_post_reservation_request({"orders": [{"name": "Tux", "quantity": 2}], "ttl": 0})
+        expired_id = json.loads(expiring.content)["data"]["reservation_id"]
+        confirm_expired = process_post_reservation_confirm_request(expired_id)
+
+    assert confirm_expired.status_code == 404
+    assert Product.objects.get(name="Tux").quantity == 4
+    # 6 sold and 2 still reserved
+    assert catalogs_in_memory["Tux"]["quantity"] == 2
+    print("test_reservations_never_oversell", catalogs_in_memory["Tux"])
+
+
+@pytest.mark.django_db
+def test_renewed_reservation_does_not_expire():
+    Product.objects.create(name="Tux", price=6.90, quantity=10)
+    catalogs_in_memory = {"Tux": {"name": "Tux", "price": 6.90, "quantity": 10}}
+
+    with mock.patch("app.views.stock", StockTable(catalogs_in_memory)), mock.patch("app.views.requests.delete"), \
+            mock.patch("app.views.reservations", {}), mock.patch("app.views.reservation_expiries", []):
+        renewed = json.loads(process_post_reservation_request({"orders": [{"name": "Tux", "quantity": 3}], "ttl": 0.05}).content)["data"]["reservation_id"]
+        expiring = json.loads(process_post_reservation_request({"orders": [{"name": "Tux", "quantity": 2}], "ttl": 0.05}).content)["data"]["reservation_id"]
+        assert process_post_reservation_renew_request(renewed, {"ttl": 30}).status_code == 200
+        time.sleep(0.1)
+        renew_expired = process_post_reservation_renew_request(expiring, {})
+        confirm_renewed = process_post_reservation_confirm_request(renewed)
+
+    assert renew_expired.status_code == 404
+    assert confirm_renewed.status_code == 200
+    assert Product.objects.get(name="Tux").quantity == 7
+    assert catalogs_in_memory["Tux"]["quantity"] == 7
+    print("test_renewed_reservation_does_not_expire", catalogs_in_memory["Tux"])
+
+
+def test_stock_table_try_decrement_never_goes_negative():
+    table = StockTable({"Tux": {"name": "Tux", "price": 6.90, "quantity": 100}, "Lego": {"name": "Lego", "price": 23.3, "quantity": 100}}, stripes=2)
+
+    def buy(i):
+        # Buyers of several products lock them in opposite orders, which must not deadlock
+        items = {"Tux": 1, "Lego": 1} if i % 2 else {"Lego": 1, "Tux": 1}
+        return table.try_decrement("Tux", 3), table.try_decrement_many(items) is None
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        results = list(pool.map(buy, range(200)))
+
+    tux_quantity = table.get("Tux")["quantity"]
+    single, many = sum(result[0] for result in results), sum(result[1] for result in results)
+    # Every unit is sold at most once: 100 Tux over orders of 3 Tux and of 1 Tux with 1 Lego
+    assert tux_quantity >= 0 and 3 * single + many + tux_quantity == 100
+    assert table.get("Lego")["quantity"] == 100 - many
+    with pytest.raises(KeyError):
+        table.try_decrement("Uno", 1)
+    print("test_stock_table_try_decrement_never_goes_negative", single, many, tux_quantity)
@@ -71,23 +71,27 @@ def create_session_with_urllib3(frontend_host, frontend_port, order_probability=
             print(f"An unexpected error occurred while querying product {product_name}: {str(e)}")
 
     difference = 0
-    for order_data in client_order_records:
+    # Verify the orders in bulk, a bounded number of order numbers per request
+    for i in range(0, len(client_order_records), 500):
+        records = client_order_records[i:i + 500]
+        order_numbers = ",".join(str(order_data["number"]) for order_data in records)
         try:
-            order_number = order_data["number"]
-            response = http.request("GET", f"{base_url}/orders/{order_number}")
+            response = http.request("GET", f"{base_url}/orders/?numbers={order_numbers}")
             if response.status == 200:
-                server_data = json.loads(response.data.decode('utf-8'))
-                print(f"Order in client: {order_data}, Order in server: {server_data['data']}")
-                assert order_data == server_data['data']
+                server_orders = json.loads(response.data.decode('utf-8'))['data']['orders']
+                server_orders = {server_data["number"]: server_data for server_data in server_orders}
+                for order_data in records:
+                    server_data = server_orders.get(order_data["number"])
+                    print(f"Order in client: {order_data}, Order in server: {server_data}")
+                    if order_data != server_data:
+                        difference += 1
+                        print(f"Order {order_data['number']} does not match server data")
             else:
-                print(f"Failed to verify order {order_number}: {response.status}")
+                print(f"Failed to verify orders {order_numbers}: {response.status}")
         except json.JSONDecodeError:
-            print(f"Failed to decode JSON for order verification {order_number}.")
-        except AssertionError:
-            difference += 1
-            print(f"Order {order_number} does not match server data")
+            print(f"Failed to decode JSON for order verification {order_numbers}.")
         except Exception as e:
-            print(f"An error occurred while verifying order {order_number}: {str(e)}")
+            print(f"An error occurred while verifying orders {order_numbers}: {str(e)}")
 
     # Print out the latencies and order check results
     if query_latencies:
@@ -0,0 +1,146 @@
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from django.http import JsonResponse, StreamingHttpResponse
+
+
+class ReleasingIterator:
+    """
+    Iterator over the content of a streaming response that calls `release` once, when the
+    content is exhausted or the response is closed, whichever comes first.
+    """
+
+    def __init__(self, iterator, release):
+        self.iterator = iter(iterator)
+        self.release = release
+        self.released = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            self.close()
+            raise
+
+    def close(self):
+        if hasattr(self.iterator, "close"):
+            self.iterator.close()
+        if not self.released:
+            self.released = True
+            self.release()
+
+
+class AdmissionExecutor:
+    """
+    A thread pool with admission control. A task is shed instead of queued when the queue is
+    full or its endpoint already has `limits[endpoint]` tasks in flight, and shed when a worker
+    picks it up after it waited longer than `max_queue_time`. A shed task's future holds a 503
+    response with Retry-After, which the views return as is. The endpoint of a task is the name
+    of its function. Each executor is one bulkhead: its workers serve only the endpoints routed
+    to it, so a stall in one traffic class cannot use up the workers of another. A streaming
+    response is written after its task returned, so it holds its endpoint's slot until the
+    response is closed.
+    """
+
+    def __init__(self, max_workers=None, max_queue=100, max_queue_time=1.0, limits=None, retry_after=1, name="default"):
+        self.name = name
+        self.pool = ThreadPoolExecutor(max_workers, thread_name_prefix=f"{name}-pool")
+        self.max_queue = max_queue
+        self.max_queue_time = max_queue_time
+        self.limits = dict(limits or {})
+        self.retry_after = retry_after
+        self.lock = Lock()
+        self.queued = 0
+        self.running = 0
+        self.endpoints = {}  # endpoint -> in flight, admitted and shed counts
+        self.started_at = time.monotonic()
+        self.busy_seconds = 0.0  # time spent by the workers running tasks
+        self.waits = 0  # tasks picked up by a worker, with their total and longest queue time
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def overloaded_response(self, message):
+        response = JsonResponse(status=503, data={"error": {"code": 503, "message": message}})
+        response["Retry-After"] = str(self.retry_after)
+        return response
+
+    def shed(self, endpoint, reason, message):
+        with self.lock:
+            self.endpoints[endpoint][reason] += 1
+        future = Future()
+        future.set_result(self.overloaded_response(message))
+        return future
+
+    def submit(self, fn, *args, **kwargs):
+        endpoint = fn.__name__
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint, {"in_flight": 0, "admitted": 0, "shed_queue_full": 0, "shed_concurrency": 0, "shed_queue_time": 0})
+            queue_full = self.queued >= self.max_queue
+            over_limit = endpoint in self.limits and stats["in_flight"] >= self.limits[endpoint]
+            if not queue_full and not over_limit:
+                self.queued += 1
+                stats["in_flight"] += 1
+                stats["admitted"] += 1
+        if queue_full:
+            return self.shed(endpoint, "shed_queue_full", "Server overloaded, try again later")
+        if over_limit:
+            return self.shed(endpoint, "shed_concurrency", "Too many concurrent requests, try again later")
+        return self.pool.submit(self.run, endpoint, time.monotonic(), fn, args, kwargs)
+
+    def run(self, endpoint, enqueued_at, fn, args, kwargs):
+        started_at = time.monotonic()
+        waited = started_at - enqueued_at
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+            self.waits += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        streaming = False
+        try:
+            if waited > self.max_queue_time:
+                # The client has likely given up already, so the work would be wasted
+                with self.lock:
+                    self.endpoints[endpoint]["shed_queue_time"] += 1
+                return self.overloaded_response("Server overloaded, try again later")
+            response = fn(*args, **kwargs)
+            if isinstance(response, StreamingHttpResponse):
+                response.streaming_content = ReleasingIterator(response.streaming_content, lambda: self.release(endpoint))
+                streaming = True
+            return response
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.busy_seconds += time.monotonic() - started_at
+            if not streaming:
+                self.release(endpoint)
+
+    def release(self, endpoint):
+        with self.lock:
+            self.endpoints[endpoint]["in_flight"] -= 1
+
+    def to_dict(self):
+        with self.lock:
+            workers = self.pool._max_workers
+            return {
+                "workers": workers,
+                "running": self.running,
+                # Share of the workers busy now, and of the worker time spent busy since the start
+                "utilization": self.running / workers,
+                "busy_ratio": self.busy_seconds / (workers * (time.monotonic() - self.started_at)),
+                "wait_seconds": {
+                    "count": self.waits,
+                    "mean": self.wait_seconds / self.waits if self.waits else None,
+                    "max": self.max_wait_seconds,
+                },
+                "queued": self.queued,
+                "max_queue": self.max_queue,
+                "max_queue_time": self.max_queue_time,
+                "endpoints": {
+                    endpoint: dict(stats, limit=self.limits.get(endpoint))
+                    for endpoint, stats in self.endpoints.items()
+                },
+            }
@@ -0,0 +1,59 @@
+import threading
+import time
+from threading import Lock
+
+
+class Readiness:
+    """
+    The startup tasks of this server, such as leader discovery or catching up with the other
+    replicas. They run in background threads, so the server starts serving right away, and
+    /ready/ reports whether they are done.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.checks = {}  # task name -> whether it succeeded, its error, a warning and how long it took
+
+    def run_in_background(self, name, task):
+        '''
+        Run `task` in a background thread. It succeeds unless it returns False or raises.
+        '''
+        with self.lock:
+            self.checks[name] = {"ready": False, "error": None, "warning": None, "seconds": None}
+
+        def run():
+            start_time = time.monotonic()
+            try:
+                ok, error = task() is not False, None
+            except Exception as e:
+                ok, error = False, str(e)
+            with self.lock:
+                self.checks[name] = {"ready": ok, "error": None if ok else error or "task failed",
+                                     "warning": self.checks[name]["warning"], "seconds": time.monotonic() - start_time}
+
+        threading.Thread(target=run, name=f"startup-{name}", daemon=True).start()
+
+    def warn(self, name, warning):
+        '''
+        Report a condition of the task `name` that does not keep the server from being ready.
+        '''
+        with self.lock:
+            if name in self.checks:
+                self.checks[name]["warning"] = warning
+
+    def is_ready(self, name=None):
+        with self.lock:
+            checks = [self.checks[name]] if name in self.checks else [] if name else list(self.checks.values())
+            return all(check["ready"] for check in checks)
+
+    def is_pending(self, name):
+        '''
+        Whether the task `name` is still running.
+        '''
+        with self.lock:
+            return name in self.checks and self.checks[name]["seconds"] is None
+
+    def to_dict(self):
+        with self.lock:
+            return {name: dict(check) for name, check in self.checks.items()}
+
@@ -10,5 +10,6 @@ class AppConfig(AppConfig):
     def ready(self):
         USE_RAFT = True if os.environ.get("USE_RAFT") == "True" else False
         if not getattr(settings, 'TESTING', False) and not USE_RAFT:
-            views.find_order_leader()
+            # Look up the order leader in the background until one is found, so the server starts serving right away
+            views.readiness.run_in_background("order_leader", views.find_order_leader_until_found)
     
\ No newline at end of file
@@ -4,8 +4,12 @@ from django.views.decorators.csrf import csrf_exempt
 
 urlpatterns = [
     path('products/<str:product_name>/', views.get_product),
+    path('orders/batch/', csrf_exempt(views.post_batch_order)),
     path('orders/<str:order_number>/', views.get_order),
-    path('orders/', csrf_exempt(views.post_order)),
+    path('orders/', csrf_exempt(views.orders)),
     path('cache/<str:product_name>/', csrf_exempt(views.delete_cache)),
     path('leaders/', views.get_leader),
+    path('routing/', views.get_routing),
+    path('ready/', views.get_ready),
+    path('stats/admission/', views.get_admission_stats),
 ]
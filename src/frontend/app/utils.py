@@ -56,4 +56,4 @@ class ReadWriteLock:
         """
         Exit the context manager. Releases the write lock.
         """
-        self.release_write()
\ No newline at end of file
+        self.release_write()
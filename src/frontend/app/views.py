@@ -3,12 +3,13 @@ import json
 import logging
 import requests
 import random
-from concurrent.futures import ThreadPoolExecutor
 from django.views import View
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.http import require_GET, require_POST, require_http_methods
+from common.admission import AdmissionExecutor
+from common.startup import Readiness
 from .utils import ReadWriteLock
 import time
 import threading
@@ -38,6 +39,9 @@ order_leader_port=ORDER_SERVER_PORTS[order_leader_ID] if order_leader_ID else No
 # Get the logger instance for the current module
 logger = logging.getLogger(__name__)
 
+# Size of the chunks streamed from the order server's bulk lookup response to the client
+ORDERS_CHUNK_SIZE = 64 * 1024
+
 # Create a cache to store 5 query responses
 cache = []
 
@@ -47,8 +51,41 @@ cache_lock = ReadWriteLock()
 # Create a lock for leader
 leader_lock = threading.Lock()
 
-# Create a thread pool executor for concurrent task execution
-executor = ThreadPoolExecutor()
+# Routing table for the Raft order servers, kept up to date from the leader hints in their
+# responses and from probing their /raft/status/ endpoints
+raft_routing = {
+    "term": 0,
+    "source": "random",
+    "updated_at": None,
+    "hints": 0,
+    "probes": 0,
+}
+
+# Bounds of the work queue in tasks and in seconds of waiting, beyond which requests are shed
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", "100"))
+ADMISSION_MAX_QUEUE_TIME = float(os.environ.get("ADMISSION_MAX_QUEUE_TIME", "1.0"))
+# Most requests of an endpoint served at once, so slow orders cannot take all workers from queries
+ENDPOINT_CONCURRENCY_LIMITS = {
+    "process_post_order_request": 16,
+    "process_post_batch_order_request": 8,
+    "process_get_orders_request": 4,
+}
+
+# Workers of the separate pools serving reads, writes and internal traffic
+READ_POOL_WORKERS = int(os.environ.get("READ_POOL_WORKERS", "8"))
+WRITE_POOL_WORKERS = int(os.environ.get("WRITE_POOL_WORKERS", "8"))
+INTERNAL_POOL_WORKERS = int(os.environ.get("INTERNAL_POOL_WORKERS", "4"))
+
+# Create thread pool executors for concurrent task execution, with admission control. Views
+# submit product and order queries to the read pool, orders to the write pool, and leader and cache maintenance requests
+# to the internal pool, so a stall in one of them cannot take the workers of the others.
+read_executor = AdmissionExecutor(READ_POOL_WORKERS, ADMISSION_MAX_QUEUE, ADMISSION_MAX_QUEUE_TIME, ENDPOINT_CONCURRENCY_LIMITS, name="read")
+write_executor = AdmissionExecutor(WRITE_POOL_WORKERS, ADMISSION_MAX_QUEUE, ADMISSION_MAX_QUEUE_TIME, ENDPOINT_CONCURRENCY_LIMITS, name="write")
+internal_executor = AdmissionExecutor(INTERNAL_POOL_WORKERS, ADMISSION_MAX_QUEUE, ADMISSION_MAX_QUEUE_TIME, ENDPOINT_CONCURRENCY_LIMITS, name="internal")
+executors = (read_executor, write_executor, internal_executor)
+
+# Startup tasks of the front-end server
+readiness = Readiness()
 
 
 def find_order_leader(max_attempts=3):
@@ -61,7 +98,7 @@ def find_order_leader(max_attempts=3):
     while attempts < max_attempts:
         try:
             # Send a health check request to the order replica server to verify its responsiveness
-            health_check_response = requests.get(f"http://{ORDER_SERVER_HOST}:{ORDER_SERVER_PORTS[str(i)]}/")
+            health_check_response = requests.get(f"http://{ORDER_SERVER_HOST}:{ORDER_SERVER_PORTS[str(i)]}/", timeout=5)
             
             # Set the ID and the port of the leader order server
             with leader_lock:
@@ -82,14 +119,94 @@ def find_order_leader(max_attempts=3):
         except:
             # Update the next checking ID
             if i == 1: 
-                logger.info("Temporary not find available order server, retrying in 3 seconds...")
-                time.sleep(3)
                 attempts += 1
+                if attempts < max_attempts:
+                    logger.info("Temporary not find available order server, retrying in 3 seconds...")
+                    time.sleep(3)
                 i = 3
             else: i -= 1
     
     return
 
+def find_order_leader_until_found():
+    '''
+    Look up the order leader until one is found, so the front-end does not give up on the order
+    servers when they start after it.
+    '''
+    while find_order_leader() is None:
+        logger.info("No order server available yet, looking up the leader again...")
+    return True
+
+def order_leader_not_ready():
+    '''
+    Return the not ready response while the order leader is still being looked up after startup,
+    so order requests are not sent to an unknown port, or None once it is known. If the lookup
+    ended without a leader, look it up again for this request.
+    '''
+    if readiness.is_pending("order_leader"):
+        return not_ready_response()
+    if order_leader_port is None and find_order_leader(max_attempts=1) is None:
+        return not_ready_response()
+    return None
+
+def not_ready_response():
+    response = JsonResponse(status=503, data={"data": {"ready": False, "checks": readiness.to_dict()}})
+    response["Retry-After"] = "1"
+    return response
+
+def update_order_leader(leader_ID, term, source):
+    '''
+    Route order requests to the given Raft leader, unless a leader of a newer term is already known.
+    '''
+    global order_leader_ID, order_leader_port
+    leader_ID = str(leader_ID)
+    if leader_ID not in ORDER_SERVER_PORTS:
+        return
+    with leader_lock:
+        if term < raft_routing["term"]:
+            return
+        if leader_ID != order_leader_ID:
+            logger.info(f"Order leader changed to ID: {leader_ID} in term {term} ({source})")
+        order_leader_ID = leader_ID
+        order_leader_port = ORDER_SERVER_PORTS[leader_ID]
+        raft_routing["term"] = term
+        raft_routing["source"] = source
+        raft_routing["updated_at"] = time.time()
+
+
+def record_leader_hint(response):
+    '''
+    Learn the Raft leader from the X-Raft-Leader and X-Raft-Term headers of an order server response.
+    '''
+    if not USE_RAFT or "X-Raft-Leader" not in response.headers:
+        return
+    with leader_lock:
+        raft_routing["hints"] += 1
+    update_order_leader(response.headers["X-Raft-Leader"], int(response.headers.get("X-Raft-Term", 0)), "hint")
+
+
+def probe_raft_leader():
+    '''
+    Ask every order server for its Raft status and route to the leader of the newest term.
+    Return the ID of the leader, or None if no server knows one.
+    '''
+    with leader_lock:
+        raft_routing["probes"] += 1
+    leader = None
+    for id, port in ORDER_SERVER_PORTS.items():
+        try:
+            status_response = requests.get(f"http://{ORDER_SERVER_HOST}:{port}/raft/status/", timeout=1)
+            status = status_response.json()["data"]
+        except Exception:
+            continue
+        if status["leader"] and (leader is None or status["term"] > leader[1]):
+            leader = (str(status["leader"]), status["term"])
+    if leader is None:
+        return None
+    update_order_leader(*leader, "probe")
+    return leader[0]
+
+
 def process_get_product_request(product_name):
     global USE_CACHE, cache
     if USE_CACHE:
@@ -119,12 +236,34 @@ def process_get_product_request(product_name):
 def process_get_order_request(order_number):
     # Ask for the order detail from the order server
     response = requests.get(f"http://{ORDER_SERVER_HOST}:{order_leader_port}/orders/{order_number}/")
+    record_leader_hint(response)
     return JsonResponse(status = response.status_code, data = response.json())
 
+def process_get_orders_request(params):
+    # Ask for the orders from the order server and stream its reply to the client as it arrives
+    response = requests.get(f"http://{ORDER_SERVER_HOST}:{order_leader_port}/orders/", params=params, stream=True)
+    record_leader_hint(response)
+
+    def stream_orders():
+        try:
+            yield from response.iter_content(ORDERS_CHUNK_SIZE)
+        finally:
+            response.close()
+
+    return StreamingHttpResponse(stream_orders(), status = response.status_code, content_type = "application/json")
+
 def process_post_order_request(order_data):
     # Send the buy request to the order server
-    print(f"http://{ORDER_SERVER_HOST}:{order_leader_port}/orders/")
+    logger.debug(f"Forwarding order to http://{ORDER_SERVER_HOST}:{order_leader_port}/orders/")
     response = requests.post(f"http://{ORDER_SERVER_HOST}:{order_leader_port}/orders/", json=order_data)
+    record_leader_hint(response)
+    return JsonResponse(status = response.status_code, data = response.json())
+
+
+def process_post_batch_order_request(batch_data):
+    # Send all line items to the order server in a single request
+    response = requests.post(f"http://{ORDER_SERVER_HOST}:{order_leader_port}/orders/batch/", json=batch_data)
+    record_leader_hint(response)
     return JsonResponse(status = response.status_code, data = response.json())
 
 
@@ -150,11 +289,17 @@ def process_get_leader_request():
         return JsonResponse(status=404, data={"error": {"code": 404, "message": "Leader not found"}})
 
 
+def process_get_routing_request():
+    with leader_lock:
+        routing = dict(raft_routing, leader_ID=order_leader_ID, leader_port=order_leader_port, use_raft=USE_RAFT)
+    return JsonResponse(status=200, data={"data": routing})
+
+
 @require_GET
 def get_product(request, product_name):
     try:
         # Submit a task to the thread pool executor
-        future = executor.submit(process_get_product_request, product_name)
+        future = read_executor.submit(process_get_product_request, product_name)
         # Wait for the result of execution
         response = future.result()
         return response
@@ -164,9 +309,12 @@ def get_product(request, product_name):
 
 @require_GET
 def get_order(request, order_number):
+    response = order_leader_not_ready()
+    if response is not None:
+        return response
     try:
         # Submit a task to the thread pool executor
-        future = executor.submit(process_get_order_request, order_number)
+        future = read_executor.submit(process_get_order_request, order_number)
          # Wait for the result of execution
         response = future.result()
         return response
@@ -176,28 +324,75 @@ def get_order(request, order_number):
         if not os.environ.get("USE_RAFT") == "True": 
             leader = find_order_leader()
         else:
-            with leader_lock:
+            leader = probe_raft_leader()
+            if not leader:
                 leader = random_choice_raft_server()
-                order_leader_port=ORDER_SERVER_PORTS[leader]
+                update_order_leader(leader, raft_routing["term"], "random")
 
         if leader:
             logger.info(f'''Current leader switched to ID: {leader}''')
             try:
-                future = executor.submit(process_get_order_request, order_number)
+                future = read_executor.submit(process_get_order_request, order_number)
                 response = future.result()
                 return response
             except:
                 pass  
         return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
     
+@require_GET
+def get_orders(request):
+    # Pass ?numbers=1,2,3, ?from=&to= or ?product=&after=&limit= on to the order server
+    params = {key: request.GET[key] for key in ("numbers", "from", "to", "product", "after", "limit") if key in request.GET}
+    response = order_leader_not_ready()
+    if response is not None:
+        return response
+    try:
+        # Submit a task to the thread pool executor
+        future = read_executor.submit(process_get_orders_request, params)
+        # Wait for the result of execution
+        response = future.result()
+        return response
+    except Exception as e:
+        logger.info("Error connecting to leader. Re-electing...")
+
+        if not os.environ.get("USE_RAFT") == "True":
+            leader = find_order_leader()
+        else:
+            leader = probe_raft_leader()
+            if not leader:
+                leader = random_choice_raft_server()
+                update_order_leader(leader, raft_routing["term"], "random")
+
+        if leader:
+            logger.info(f'''Current leader switched to ID: {leader}''')
+            try:
+                future = read_executor.submit(process_get_orders_request, params)
+                response = future.result()
+                return response
+            except:
+                pass
+        return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+
+@require_http_methods(["GET", "POST"])
+def orders(request):
+    # GET looks up orders in bulk, POST places a new order
+    if request.method == "GET":
+        return get_orders(request)
+    return post_order(request)
+
+
 @require_POST
 def post_order(request):
     global order_leader_port
+    response = order_leader_not_ready()
+    if response is not None:
+        return response
     try:
         # Extract data from the request
         order_data = json.loads(request.body)
         # Submit a task to the thread pool executor
-        future = executor.submit(process_post_order_request, order_data)
+        future = write_executor.submit(process_post_order_request, order_data)
         # Wait for the result of execution
         response = future.result()
         return response
@@ -209,17 +404,18 @@ def post_order(request):
     while attempt_count < max_attempts:
         attempt_count += 1
         if not os.environ.get("USE_RAFT") == "True": 
-            print("Not using Raft")
+            logger.debug("Not using Raft, looking up the order leader")
             leader = find_order_leader()
         else:
-            with leader_lock:
+            leader = probe_raft_leader()
+            if not leader:
                 leader = random_choice_raft_server()
-                order_leader_port=ORDER_SERVER_PORTS[leader]
+                update_order_leader(leader, raft_routing["term"], "random")
 
         if leader:
             logger.info(f'''Current leader switched to ID: {leader}''')
             try:
-                future = executor.submit(process_post_order_request, order_data)
+                future = write_executor.submit(process_post_order_request, order_data)
                 response = future.result()
                 return response
             except Exception as e:
@@ -230,11 +426,51 @@ def post_order(request):
     return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
 
 
+@require_POST
+def post_batch_order(request):
+    response = order_leader_not_ready()
+    if response is not None:
+        return response
+    try:
+        # Extract data from the request
+        batch_data = json.loads(request.body)
+        # Submit a task to the thread pool executor
+        future = write_executor.submit(process_post_batch_order_request, batch_data)
+        # Wait for the result of execution
+        response = future.result()
+        return response
+    except Exception as e:
+        logger.info("Error connecting to leader. Re-electing...")
+
+    max_attempts = 3
+    attempt_count = 0
+    while attempt_count < max_attempts:
+        attempt_count += 1
+        if not os.environ.get("USE_RAFT") == "True":
+            leader = find_order_leader()
+        else:
+            leader = probe_raft_leader()
+            if not leader:
+                leader = random_choice_raft_server()
+                update_order_leader(leader, raft_routing["term"], "random")
+
+        if leader:
+            logger.info(f'''Current leader switched to ID: {leader}''')
+            try:
+                future = write_executor.submit(process_post_batch_order_request, batch_data)
+                response = future.result()
+                return response
+            except Exception as e:
+                logger.info(f"Attempt {attempt_count} failed: {str(e)}")
+
+    return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+
 @require_http_methods(["DELETE"])
 def delete_cache(request, product_name):
     try:
         # Submit a task to the thread pool executor
-        future = executor.submit(process_delete_cache_request, product_name)
+        future = internal_executor.submit(process_delete_cache_request, product_name)
         # Wait for the result of execution
         response = future.result()
         return response
@@ -246,9 +482,35 @@ def delete_cache(request, product_name):
 def get_leader(request):
     try:
         # Submit a task to the thread pool executor
-        future = executor.submit(process_get_leader_request)
+        future = internal_executor.submit(process_get_leader_request)
         # Wait for the result of execution
         response = future.result()
         return response
     except Exception as e:
-        return JsonResponse(status = 500, data = {"error": {"code": 500, "message": "Internal server error"}})
\ No newline at end of file
+        return JsonResponse(status = 500, data = {"error": {"code": 500, "message": "Internal server error"}})
+
+
+@require_GET
+def get_routing(request):
+    try:
+        # Submit a task to the thread pool executor
+        future = internal_executor.submit(process_get_routing_request)
+        # Wait for the result of execution
+        response = future.result()
+        return response
+    except Exception as e:
+        return JsonResponse(status = 500, data = {"error": {"code": 500, "message": "Internal server error"}})
+
+
+@require_GET
+def get_admission_stats(request):
+    # Served outside of the executor, so the stats stay visible while requests are shed
+    return JsonResponse(status=200, data={"data": {"pools": {executor.name: executor.to_dict() for executor in executors}}})
+
+
+@require_GET
+def get_ready(request):
+    # Served outside of the executors, like a liveness probe
+    if not readiness.is_ready():
+        return not_ready_response()
+    return JsonResponse(status=200, data={"data": {"ready": True, "checks": readiness.to_dict()}})
@@ -4,7 +4,10 @@ from rest_framework.test import APIClient
 import json
 from unittest import mock
 from django.http import JsonResponse
-from app.views import process_get_product_request, process_get_order_request, process_post_order_request, process_delete_cache_request
+from django.test import RequestFactory
+import threading
+from common.startup import Readiness
+from app.views import process_get_product_request, process_get_order_request, process_get_orders_request, process_post_order_request, process_post_batch_order_request, process_delete_cache_request, process_get_routing_request, probe_raft_leader, post_order
 
 CATALOG_SERVER_HOST = "localhost"
 CATALOG_SERVER_PORT = "8001"
@@ -81,6 +84,20 @@ def test_query_order_fail():
     print("test_query_order_fail:", response.status_code, expected_response)
 
 
+def test_query_orders_streams_reply():
+    order_leader_port = ORDER_SERVER_PORTS["1"]
+    expected_response = {"data": {"orders": [{"number": 1, "name": "Tux", "quantity": 2}, {"number": 3, "name": "Lego", "quantity": 1}]}}
+
+    with mock.patch("app.views.order_leader_port", order_leader_port):
+        with requests_mock.Mocker() as m:
+            m.get(f"http://{ORDER_SERVER_HOST}:{order_leader_port}/orders/?numbers=1,3", json=expected_response, status_code=200)
+            response = process_get_orders_request({"numbers": "1,3"})
+            content = b"".join(response.streaming_content)
+
+    assert response.status_code == status.HTTP_200_OK
+    assert json.loads(content.decode('utf-8')) == expected_response
+    print("test_query_orders_streams_reply:", response.status_code, expected_response)
+
 def test_post_order_success():
     order_leader_port = ORDER_SERVER_PORTS["1"]
     order_data = {"name": "Tux", "quantity": 2}
@@ -96,6 +113,23 @@ def test_post_order_success():
     assert response_data == expected_response
     print("test_post_order_success:", response.status_code, expected_response)
 
+def test_post_batch_order_success():
+    order_leader_port = ORDER_SERVER_PORTS["1"]
+    batch_data = {"orders": [{"name": "Tux", "quantity": 2}, {"name": "Lego", "quantity": 1}]}
+    expected_response = {"data": {"order_numbers": [120, 121]}}
+
+    with mock.patch("app.views.order_leader_port", order_leader_port):
+        with requests_mock.Mocker() as m:
+            m.post(f"http://{ORDER_SERVER_HOST}:{order_leader_port}/orders/batch/", json=expected_response, status_code=200)
+            response = process_post_batch_order_request(batch_data)
+            forwarded = m.last_request.json()
+
+    assert response.status_code == status.HTTP_200_OK
+    assert forwarded == batch_data
+    response_data = json.loads(response.content.decode('utf-8'))
+    assert response_data == expected_response
+    print("test_post_batch_order_success:", response.status_code, expected_response)
+
 def test_delete_cache_success():
     USE_CACHE = True
     product_name = 'Tux'
@@ -110,4 +144,80 @@ def test_delete_cache_success():
     print("test_delete_cache_success:", response.status_code)
 
 
+def test_post_order_follows_leader_hint():
+    order_data = {"name": "Tux", "quantity": 2}
+    expected_response = {"data": {"order_number": 121}}
+    routing = {"term": 0, "source": "random", "updated_at": None, "hints": 0, "probes": 0}
+
+    with mock.patch("app.views.USE_RAFT", True), mock.patch("app.views.order_leader_ID", "1"), mock.patch("app.views.order_leader_port", ORDER_SERVER_PORTS["1"]), mock.patch.dict("app.views.raft_routing", routing):
+        with requests_mock.Mocker() as m:
+            m.post(f"http://{ORDER_SERVER_HOST}:{ORDER_SERVER_PORTS['1']}/orders/", json=expected_response, status_code=200, headers={"X-Raft-Leader": "3", "X-Raft-Term": "2"})
+            response = process_post_order_request(order_data)
+        routing_data = json.loads(process_get_routing_request().content.decode('utf-8'))["data"]
 
+    assert response.status_code == status.HTTP_200_OK
+    assert routing_data["leader_ID"] == "3"
+    assert routing_data["leader_port"] == ORDER_SERVER_PORTS["3"]
+    assert routing_data["term"] == 2
+    assert routing_data["source"] == "hint"
+    assert routing_data["hints"] == 1
+    print("test_post_order_follows_leader_hint:", routing_data)
+
+
+def test_probe_raft_leader():
+    routing = {"term": 3, "source": "hint", "updated_at": None, "hints": 0, "probes": 0}
+    statuses = {
+        "3": {"id": "3", "role": "follower", "term": 3, "leader": "3"},
+        "2": {"id": "2", "role": "leader", "term": 4, "leader": "2"},
+    }
+
+    with mock.patch("app.views.USE_RAFT", True), mock.patch("app.views.order_leader_ID", "3"), mock.patch("app.views.order_leader_port", ORDER_SERVER_PORTS["3"]), mock.patch.dict("app.views.raft_routing", routing):
+        with requests_mock.Mocker() as m:
+            for id, status_data in statuses.items():
+                m.get(f"http://{ORDER_SERVER_HOST}:{ORDER_SERVER_PORTS[id]}/raft/status/", json={"data": status_data})
+            m.get(f"http://{ORDER_SERVER_HOST}:{ORDER_SERVER_PORTS['1']}/raft/status/", status_code=500)
+            leader = probe_raft_leader()
+        routing_data = json.loads(process_get_routing_request().content.decode('utf-8'))["data"]
+
+    assert leader == "2"
+    assert routing_data["leader_port"] == ORDER_SERVER_PORTS["2"]
+    assert routing_data["term"] == 4
+    assert routing_data["probes"] == 1
+    print("test_probe_raft_leader:", routing_data)
+
+def test_post_order_waits_for_order_leader_lookup():
+    readiness = Readiness()
+    release = threading.Event()
+    readiness.run_in_background("order_leader", release.wait)
+    request = RequestFactory().post("/orders/", data=json.dumps({"name": "Tux", "quantity": 1}), content_type="application/json")
+
+    with mock.patch("app.views.readiness", readiness), mock.patch("app.views.order_leader_port", None):
+        with requests_mock.Mocker() as m:
+            response = post_order(request)
+            order_requests = m.call_count
+    release.set()
+
+    # Answered right away without looking up the leader or calling an order server
+    assert response.status_code == 503 and response["Retry-After"] == "1"
+    assert json.loads(response.content)["data"]["checks"]["order_leader"]["seconds"] is None
+    assert order_requests == 0
+    print("test_post_order_waits_for_order_leader_lookup:", response.status_code)
+
+def test_post_order_looks_up_order_leader_after_failed_lookup():
+    readiness = Readiness()
+    readiness.run_in_background("order_leader", lambda: False)
+    while readiness.is_pending("order_leader"):
+        pass
+    request = RequestFactory().post("/orders/", data=json.dumps({"name": "Tux", "quantity": 1}), content_type="application/json")
+    expected_response = {"data": {"order_number": 7}}
+
+    with mock.patch("app.views.readiness", readiness), mock.patch("app.views.order_leader_ID", None), mock.patch("app.views.order_leader_port", None):
+        with requests_mock.Mocker() as m:
+            m.get(f"http://{ORDER_SERVER_HOST}:{ORDER_SERVER_PORTS['3']}/", status_code=200)
+            m.post(requests_mock.ANY, json=expected_response, status_code=200)
+            response = post_order(request)
+
+    # The failed startup lookup is retried for the request instead of refusing it
+    assert response.status_code == 200
+    assert json.loads(response.content) == expected_response
+    print("test_post_order_looks_up_order_leader_after_failed_lookup:", response.status_code)
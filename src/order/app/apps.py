@@ -1,5 +1,6 @@
 from django.apps import AppConfig
 from .utils import leader
+from .utils.archive import archiver
 import os
 
 class AppConfig(AppConfig):
@@ -11,4 +12,16 @@ class AppConfig(AppConfig):
         USE_RAFT = True if os.environ.get("USE_RAFT") == "True" else False
         if not current_ID or USE_RAFT:
             return
-        leader.synchronize_orders()
\ No newline at end of file
+        from . import views
+        # Look up the leader and catch up with the other replicas after startup, not while the
+        # server is starting. Orders are refused while the replica is catching up.
+        views.readiness.run_in_background("leader", views.discover_leader)
+        views.readiness.run_in_background("sync", self.synchronize)
+
+    @staticmethod
+    def synchronize():
+        from . import views
+        leader.synchronize_until_done(views.readiness)
+        # Move old orders out of the database in the background. With Raft the log entries
+        # reference their orders, so orders stay in the database.
+        archiver.start()
@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import time
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from app.models import Order, ProductStats
+from app.utils.store import SQLiteOrderStore
+
+
+PRODUCTS = ["Tux", "Lego", "Uno", "Clue", "Monopoly"]
+
+
+def orm_add(items, using):
+    # The order path before the order store: models, one statement per product for the counters
+    with transaction.atomic(using=using):
+        orders = [Order.objects.using(using).create(product_name=name, quantity=quantity) for name, quantity in items]
+        for order in orders:
+            updated = ProductStats.objects.using(using).filter(product_name=order.product_name).update(
+                orders=F('orders') + 1, units=F('units') + order.quantity, last_order_number=Greatest('last_order_number', Value(order.order_number)))
+            if not updated:
+                ProductStats.objects.using(using).create(product_name=order.product_name, orders=1, units=order.quantity, last_order_number=order.order_number)
+    return orders
+
+
+class Command(BaseCommand):
+    help = "Compare the order store with the Django ORM on a temporary database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--orders", type=int, default=20000, help="Orders written and read by each benchmark")
+        parser.add_argument("--batch", type=int, default=100, help="Orders per batch insert")
+
+    def run(self, function, operations):
+        start_time = time.perf_counter()
+        function()
+        return operations / (time.perf_counter() - start_time)
+
+    def handle(self, *args, **options):
+        count, batch = options["orders"], options["batch"]
+        directory = tempfile.mkdtemp(prefix="order-store-benchmark-")
+        try:
+            results = []
+            for path in ("orm", "store"):
+                # A fresh database per path, so both start from the same state
+                using = f"benchmark_{path}"
+                connections.databases[using] = {**connections.databases["default"], "NAME": os.path.join(directory, f"{path}.sqlite3")}
+                call_command("migrate", database=using, verbosity=0)
+                store = SQLiteOrderStore(using)
+                items = [(PRODUCTS[i % len(PRODUCTS)], i % 5 + 1) for i in range(count)]
+                if path == "orm":
+                    orders = Order.objects.using(using)
+                    rates = {
+                        "single insert": self.run(lambda: [orm_add([item], using) for item in items], count),
+                        "batch insert": self.run(lambda: [orm_add(items[i:i + batch], using) for i in range(0, count, batch)], count),
+                        "point lookup": self.run(lambda: [orders.filter(order_number=number).first() for number in range(1, count + 1)], count),
+                        "range read": self.run(lambda: [list(orders.filter(order_number__gte=number, order_number__lte=number + 999).order_by('order_number').values_list('order_number', 'product_name', 'quantity')) for number in range(1, 2 * count, 1000)], 2 * count),
+                    }
+                else:
+                    rates = {
+                        "single insert": self.run(lambda: [store.add([(None, *item)]) for item in items], count),
+                        "batch insert": self.run(lambda: [store.add([(None, *item) for item in items[i:i + batch]]) for i in range(0, count, batch)], count),
+                        "point lookup": self.run(lambda: [store.get(number) for number in range(1, count + 1)], count),
+                        "range read": self.run(lambda: [store.read_range(number, number + 999) for number in range(1, 2 * count, 1000)], 2 * count),
+                    }
+                connections[using].close()
+                results.append(rates)
+
+            self.stdout.write(f"{'orders/s':<16}{'ORM':>12}{'store':>12}{'speedup':>10}")
+            for name in results[0]:
+                orm, store = results[0][name], results[1][name]
+                self.stdout.write(f"{name:<16}{orm:>12,.0f}{store:>12,.0f}{store / orm:>9.1f}x")
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
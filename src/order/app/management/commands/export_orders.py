@@ -0,0 +1,16 @@
+import time
+from django.core.management.base import BaseCommand
+from app.utils.export import EXPORT_CHUNK_ORDERS, export_orders
+
+
+class Command(BaseCommand):
+    help = "Append the orders placed since the last export to a columnar NumPy export"
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory", help="Directory of the export, created if missing")
+        parser.add_argument("--chunk-orders", type=int, default=EXPORT_CHUNK_ORDERS, help="Orders per chunk")
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        exported = export_orders(options["directory"], options["chunk_orders"])
+        self.stdout.write(f"Exported {exported} orders to {options['directory']} in {time.time() - start_time:.2f}s")
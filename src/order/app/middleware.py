@@ -1,7 +1,25 @@
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.urls import resolve
+import logging
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from app.utils.log import log_event, middleware_logger
+
+# Size of the chunks streamed from the leader's response to the client
+FORWARD_CHUNK_SIZE = 64 * 1024
+# Seconds to wait for a connection to the leader, reading the response is not limited
+FORWARD_CONNECT_TIMEOUT = 3
+
+# Headers that only apply to a single connection and must not be forwarded
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailer',
+    'trailers', 'transfer-encoding', 'upgrade', 'host', 'content-length',
+}
+
+# Session with a pool of keep-alive connections shared by all forwarded requests
+forward_session = requests.Session()
+forward_session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=32))
 
 
 class RaftMiddleware:
@@ -11,43 +29,84 @@ class RaftMiddleware:
     def __call__(self, request):
         # Code executed before the request is processed
         response = self.process_request(request)
-        if response:
-            return response
-        # Return the response from the view
-        return self.get_response(request)
+        if response is None:
+            # Get the response from the view
+            response = self.get_response(request)
+        return self.add_leader_hint(response)
 
     def process_request(self, request):
-        from order.wsgi import raft_instance
+        from order.raft_node import raft_instance
         USE_RAFT = True if os.environ.get("USE_RAFT") == "True" else False
         if not USE_RAFT:
             return None
         term, is_leader = raft_instance.get_state()
-        if is_leader or (resolve(request.path_info) and resolve(request.path_info).url_name in ['vote', 'append_entries']):
-            print("Request pass middleware")
-            return None 
-        
+        if is_leader or self.is_served_locally(request):
+            return None
+
         # If the current node is not the leader, it can redirect to the leader node or return an error
-        print("This server is not leader. Redirecting to leader server.")
         if not is_leader:
             leader_url = raft_instance.get_leader_url()
             if leader_url:
                 # Redirect client requests to leader
-                print(f"Raft Server {raft_instance.me} redirect {request} to Leader Server at {leader_url}")
+                log_event(middleware_logger, logging.DEBUG, "forward to leader", server=raft_instance.me,
+                          method=request.method, path=request.path, leader=leader_url)
                 return self.forward_request(request, leader_url)
             else:
                 return JsonResponse({"term": term, "error": "Leader not found"}, status=503)
         return None
 
+    def is_served_locally(self, request):
+        '''
+        Whether a follower serves the request itself: the Raft RPCs, its own status and stats,
+        and product history lookups, which may read from any replica.
+        '''
+        url_name = resolve(request.path_info).url_name
+        if url_name in ['vote', 'append_entries', 'ready', 'raft_status', 'raft_events', 'cache_stats', 'admission_stats', 'archive_stats', 'product_stats', 'product_stats_rebuild', 'merkle', 'merkle_repair']:
+            return True
+        return url_name == 'orders' and request.method == 'GET' and 'product' in request.GET
+
+    def add_leader_hint(self, response):
+        '''
+        Tell the caller who the leader is, so it can send its next requests there directly.
+        '''
+        from order.raft_node import raft_instance
+        USE_RAFT = True if os.environ.get("USE_RAFT") == "True" else False
+        if USE_RAFT and raft_instance and raft_instance.leaderId:
+            term, is_leader = raft_instance.get_state()
+            response['X-Raft-Leader'] = str(raft_instance.leaderId)
+            response['X-Raft-Term'] = str(term)
+        return response
+
     def forward_request(self, request, leader_url):
-        # Determine the method of the original request
-        if request.method == 'POST':
-            print(leader_url + request.path, request.body)
-            resp = requests.post(leader_url + request.path, data=request.body)
-        elif request.method == 'GET':
-            resp = requests.get(leader_url + request.path, headers=request.headers)
-        else:
-            # Optionally handle other methods such as PUT, DELETE, etc.
-            return JsonResponse({"error": "Method not supported"}, status=405)
-
-        # Return the response from the leader to the client
-        return JsonResponse(resp.json(), status=resp.status_code)
\ No newline at end of file
+        '''
+        Proxy the request to the leader over a pooled connection, keeping its method, query
+        string, headers and body, and stream the leader's response back unchanged.
+        '''
+        from order.raft_node import raft_instance
+        headers = {name: value for name, value in request.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS}
+        try:
+            resp = forward_session.request(
+                request.method,
+                leader_url + request.get_full_path(),
+                data=request.body,
+                headers=headers,
+                stream=True,
+                timeout=(FORWARD_CONNECT_TIMEOUT, None),
+            )
+        except requests.RequestException as e:
+            term, is_leader = raft_instance.get_state()
+            log_event(middleware_logger, logging.WARNING, "leader unreachable", leader=leader_url, error=e)
+            return JsonResponse({"term": term, "error": "Leader unreachable"}, status=503)
+
+        def stream_body():
+            # Return the connection to the pool once the body has been sent
+            try:
+                yield from resp.raw.stream(FORWARD_CHUNK_SIZE, decode_content=False)
+            finally:
+                resp.close()
+
+        response = StreamingHttpResponse(stream_body(), status=resp.status_code)
+        for name, value in resp.headers.items():
+            if name.lower() not in HOP_BY_HOP_HEADERS:
+                response[name] = value
+        return response
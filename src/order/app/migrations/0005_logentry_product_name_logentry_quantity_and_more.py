@@ -0,0 +1,34 @@
+# Generated by Django 5.0.4 on 2026-10-19 16:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0004_alter_logentry_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="logentry",
+            name="product_name",
+            field=models.CharField(max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name="logentry",
+            name="quantity",
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name="logentry",
+            name="order",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="log_entries",
+                to="app.order",
+            ),
+        ),
+    ]
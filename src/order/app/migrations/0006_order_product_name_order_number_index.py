@@ -0,0 +1,17 @@
+# Generated by Django 5.0.4 on 2026-10-19 16:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_logentry_product_name_logentry_quantity_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['product_name', 'order_number'], name='orders_product_number_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.0.4 on 2026-10-19 16:37
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Sum
+
+
+def count_existing_orders(apps, schema_editor):
+    # Start the counters from the orders stored before they were maintained
+    Order = apps.get_model('app', 'Order')
+    ProductStats = apps.get_model('app', 'ProductStats')
+    db_alias = schema_editor.connection.alias
+    rows = Order.objects.using(db_alias).order_by().values('product_name').annotate(orders=Count('order_number'), units=Sum('quantity'), last=Max('order_number'))
+    ProductStats.objects.using(db_alias).bulk_create([
+        ProductStats(product_name=row['product_name'], orders=row['orders'], units=row['units'], last_order_number=row['last'])
+        for row in rows
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_order_product_name_order_number_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductStats',
+            fields=[
+                ('product_name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('orders', models.PositiveIntegerField(default=0)),
+                ('units', models.PositiveBigIntegerField(default=0)),
+                ('last_order_number', models.IntegerField(null=True)),
+            ],
+            options={
+                'db_table': 'product_stats',
+            },
+        ),
+        migrations.RunPython(count_existing_orders, migrations.RunPython.noop),
+    ]
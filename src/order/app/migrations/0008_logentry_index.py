@@ -0,0 +1,17 @@
+# Generated by Django 5.0.4 on 2026-10-19 17:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_productstats'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='logentry',
+            index=models.Index(fields=['index'], name='log_entries_index_idx'),
+        ),
+    ]
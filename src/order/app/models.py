@@ -8,6 +8,10 @@ class Order(models.Model):
 
     class Meta:
         db_table = "orders"
+        indexes = [
+            # Orders of a product in order number order, for product history lookups
+            models.Index(fields=["product_name", "order_number"], name="orders_product_number_idx"),
+        ]
 
     def __str__(self):
         return f"Order Number: {self.order_number}, Product: {self.product_name}, Quantity: {self.quantity}"
@@ -18,21 +22,54 @@ class Order(models.Model):
             'product_name': self.product_name,
             'quantity': self.quantity,
         }
+class ProductStats(models.Model):
+    # Counters of the orders of a product, updated in the same transaction as the orders
+    product_name = models.CharField(max_length=100, primary_key=True)
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveBigIntegerField(default=0)
+    last_order_number = models.IntegerField(null=True)
+
+    class Meta:
+        db_table = "product_stats"
+
+    def to_dict(self):
+        return {
+            'name': self.product_name,
+            'orders': self.orders,
+            'units': self.units,
+            'last_order_number': self.last_order_number,
+        }
+
 # Raft 
 class LogEntry(models.Model):
     index = models.IntegerField(null=True)
     term = models.IntegerField()
-    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='log_entries')
+    # Null until the entry is committed and applied to the state machine
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='log_entries', null=True)
     command = models.TextField(max_length=255,null=True, default='default_command')
+    # Order carried by the entry, so it can be persisted before it is committed
+    product_name = models.CharField(max_length=100, null=True)
+    quantity = models.PositiveIntegerField(null=True)
 
     class Meta:
         db_table = 'log_entries'
+        indexes = [
+            # Entries by index, to replace uncommitted entries and link committed ones to their orders
+            models.Index(fields=['index'], name='log_entries_index_idx'),
+        ]
     
     def to_dict(self):
+        if self.order_id is not None:
+            order = model_to_dict(self.order, fields=['product_name', 'quantity'])
+        elif self.product_name is not None:
+            order = {'product_name': self.product_name, 'quantity': self.quantity}
+        else:
+            # A no-op entry of a new leader
+            order = None
         return {
             'index': self.index,
             'term': self.term,
-            'order': model_to_dict(self.order, fields=['product_name', 'quantity']),
+            'order': order,
             'command': self.command,
         }
 
@@ -3,13 +3,28 @@ from . import views
 from django.views.decorators.csrf import csrf_exempt
 
 urlpatterns = [
+    path('orders/batch/', csrf_exempt(views.post_batch_order)),
     path('orders/<str:order_number>/', views.get_order),
-    path('orders/', csrf_exempt(views.post_order)),
+    path('orders/', csrf_exempt(views.orders), name='orders'),
     path('replicas/leaders/', csrf_exempt(views.post_replicas_leader)),
     path('replicas/orders/', csrf_exempt(views.post_replicas_order)),
+    path('replicas/orders/batch/', csrf_exempt(views.post_replicas_batch_order)),
+    path('replicas/status/', views.get_replication_status),
+    path('merkle/', views.get_merkle_node, name='merkle'),
+    path('merkle/repair/', csrf_exempt(views.post_merkle_repair), name='merkle_repair'),
+    path('sync/status/', views.get_sync_status),
+    path('sync/orders/', views.get_sync_orders_stream),
     path('sync/orders/<str:next_order_number>/', views.get_sync_orders),
+    path('stats/cache/', views.get_cache_stats, name='cache_stats'),
+    path('ready/', views.get_ready, name='ready'),
+    path('stats/admission/', views.get_admission_stats, name='admission_stats'),
+    path('stats/archive/', views.get_archive_stats, name='archive_stats'),
+    path('stats/products/', views.get_product_stats, name='product_stats'),
+    path('stats/products/rebuild/', csrf_exempt(views.post_product_stats_rebuild), name='product_stats_rebuild'),
     # Raft
     path('vote/', csrf_exempt(views.handle_vote), name='vote'),
     path('append_entries/', csrf_exempt(views.handle_append_entries), name='append_entries'),
+    path('raft/status/', views.get_raft_status, name='raft_status'),
+    path('raft/events/', views.get_raft_events, name='raft_events'),
 
 ]
\ No newline at end of file
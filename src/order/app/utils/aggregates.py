@@ -0,0 +1,37 @@
+from collections import defaultdict
+
+
+def count_orders(rows):
+    '''
+    Group (number, name, quantity) rows by product into {product name: [orders, units, last order number]}.
+    '''
+    counts = defaultdict(lambda: [0, 0, None])
+    for number, name, quantity in rows:
+        count = counts[name]
+        count[0] += 1
+        count[1] += quantity
+        count[2] = number if count[2] is None else max(count[2], number)
+    return counts
+
+
+def rebuild_product_stats():
+    '''
+    Recompute the counters of every product from the orders table and the archive, e.g. after
+    orders were repaired in place. Returns the number of products.
+    '''
+    from .archive import order_archive
+    from .store import order_store
+    with order_store.atomic():
+        counts = order_store.count_products()
+        # Add the archived orders that are not overridden by a row of the table
+        segments, firsts = order_archive.get_segments()
+        for segment in segments:
+            stored = order_store.numbers(segment.first, segment.last)
+            archived = [row for row in segment.iter_range(segment.first, segment.last) if row[0] not in stored]
+            for name, (orders, units, last) in count_orders(archived).items():
+                product = counts.setdefault(name, [0, 0, last])
+                product[0] += orders
+                product[1] += units
+                product[2] = max(product[2], last)
+        order_store.replace_product_stats(counts)
+        return len(counts)
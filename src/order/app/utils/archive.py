@@ -0,0 +1,282 @@
+import bisect
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from .log import log_event, sync_logger
+
+
+# Order numbers covered by one segment file. Segment k holds the orders numbered from
+# k * ARCHIVE_SEGMENT_ORDERS + 1 to (k + 1) * ARCHIVE_SEGMENT_ORDERS.
+ARCHIVE_SEGMENT_ORDERS = 65536
+# Orders per compressed block, the sparse index has one entry per block
+ARCHIVE_BLOCK_ORDERS = 256
+# Number of most recent orders kept in the orders table, older ones are archived
+ARCHIVE_KEEP_ORDERS = int(os.environ.get("ORDER_ARCHIVE_KEEP", "100000"))
+# Seconds between two runs of the archiver
+ARCHIVE_INTERVAL = float(os.environ.get("ORDER_ARCHIVE_INTERVAL", "60"))
+
+SEGMENT_MAGIC = b"ORDSEG01"
+RECORD = struct.Struct("<IIH")  # order number, quantity, length of the product name
+INDEX_ENTRY = struct.Struct("<IIQI")  # first and last order number, offset and length of a block
+FOOTER = struct.Struct("<QIII8s")  # index offset, blocks, first order number, orders, magic
+
+
+def encode_block(rows):
+    data = bytearray()
+    for number, product_name, quantity in rows:
+        name = product_name.encode()
+        data += RECORD.pack(number, quantity, len(name)) + name
+    return zlib.compress(bytes(data))
+
+
+def decode_block(data):
+    rows, offset, data = [], 0, zlib.decompress(data)
+    while offset < len(data):
+        number, quantity, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        rows.append((number, data[offset:offset + length].decode(), quantity))
+        offset += length
+    return rows
+
+
+class Segment:
+    """
+    An immutable file of archived orders sorted by number, in compressed blocks followed by a
+    sparse index of the first and last order number of every block. The file is memory-mapped,
+    an order is found with a binary search over the index, then only its block is decompressed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index_offset, self.blocks, self.first, self.orders, magic = FOOTER.unpack_from(self.map, len(self.map) - FOOTER.size)
+        if magic != SEGMENT_MAGIC or self.map[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+            raise ValueError(f"{path} is not an order segment")
+        self.last = self.index_entry(self.blocks - 1)[1] if self.blocks else self.first
+
+    @staticmethod
+    def write(path, rows):
+        '''
+        Write rows of (number, name, quantity) sorted by number to a new segment file. The file
+        is written under a temporary name and renamed once it is on disk, so a segment is
+        never seen half written.
+        '''
+        index = []
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(SEGMENT_MAGIC)
+            for i in range(0, len(rows), ARCHIVE_BLOCK_ORDERS):
+                block = rows[i:i + ARCHIVE_BLOCK_ORDERS]
+                data = encode_block(block)
+                index.append(INDEX_ENTRY.pack(block[0][0], block[-1][0], file.tell(), len(data)))
+                file.write(data)
+            index_offset = file.tell()
+            file.write(b"".join(index))
+            file.write(FOOTER.pack(index_offset, len(index), rows[0][0], len(rows), SEGMENT_MAGIC))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+        return Segment(path)
+
+    def index_entry(self, block):
+        return INDEX_ENTRY.unpack_from(self.map, self.index_offset + block * INDEX_ENTRY.size)
+
+    def find_block(self, order_number):
+        '''
+        Binary search the index for the first block whose last order number is at least
+        `order_number`. Returns the number of blocks if there is none.
+        '''
+        low, high = 0, self.blocks
+        while low < high:
+            middle = (low + high) // 2
+            if self.index_entry(middle)[1] < order_number:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def read_block(self, block):
+        first, last, offset, length = self.index_entry(block)
+        return decode_block(self.map[offset:offset + length])
+
+    def get(self, order_number):
+        block = self.find_block(order_number)
+        if block == self.blocks:
+            return None
+        rows = self.read_block(block)
+        i = bisect.bisect_left(rows, (order_number,))
+        return rows[i] if i < len(rows) and rows[i][0] == order_number else None
+
+    def iter_range(self, start, end):
+        for block in range(self.find_block(start), self.blocks):
+            for row in self.read_block(block):
+                if row[0] > end:
+                    return
+                if row[0] >= start:
+                    yield row
+
+    def close(self):
+        self.map.close()
+
+
+class OrderArchive:
+    """
+    The segments of archived orders of this replica, found in its archive directory on first
+    use. Archived orders are never changed: an order that is also in the orders table, e.g.
+    after a repair, is read from the table.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.segments = None  # loaded segments, sorted by first order number
+        self.firsts = []
+
+    def get_directory(self):
+        if self.directory is None:
+            from django.conf import settings
+            self.directory = os.environ.get("ORDER_ARCHIVE_DIR") or f"{settings.DATABASES['default']['NAME']}.archive"
+        return self.directory
+
+    def load(self):
+        with self.lock:
+            if self.segments is not None:
+                return
+            directory = self.get_directory()
+            names = sorted(name for name in os.listdir(directory) if name.endswith(".seg")) if os.path.isdir(directory) else []
+            segments = sorted((Segment(os.path.join(directory, name)) for name in names), key=lambda segment: segment.first)
+            self.firsts = [segment.first for segment in segments]
+            self.segments = segments
+
+    def get_segments(self):
+        '''
+        Return the segments and their first order numbers, as of the same moment.
+        '''
+        if self.segments is None:
+            self.load()
+        with self.lock:
+            return self.segments, self.firsts
+
+    @property
+    def archived_upto(self):
+        '''
+        Last order number covered by the archived segments, 0 if there are none.
+        '''
+        segments, firsts = self.get_segments()
+        return self.segment_range(segments[-1].first)[1] if segments else 0
+
+    @staticmethod
+    def segment_range(order_number):
+        k = (order_number - 1) // ARCHIVE_SEGMENT_ORDERS
+        return k * ARCHIVE_SEGMENT_ORDERS + 1, (k + 1) * ARCHIVE_SEGMENT_ORDERS
+
+    def add(self, rows):
+        '''
+        Write the rows of one segment range, sorted by number, to a new segment.
+        '''
+        directory = self.get_directory()
+        os.makedirs(directory, exist_ok=True)
+        first, last = self.segment_range(rows[0][0])
+        segment = Segment.write(os.path.join(directory, f"orders-{first:010d}-{last:010d}.seg"), rows)
+        self.get_segments()
+        with self.lock:
+            i = bisect.bisect_left(self.firsts, segment.first)
+            self.segments = self.segments[:i] + [segment] + self.segments[i:]
+            self.firsts = self.firsts[:i] + [segment.first] + self.firsts[i:]
+        return segment
+
+    def get(self, order_number):
+        '''
+        Return (number, name, quantity) of an archived order, or None.
+        '''
+        segments, firsts = self.get_segments()
+        i = bisect.bisect_right(firsts, order_number) - 1
+        return segments[i].get(order_number) if i >= 0 else None
+
+    def read_range(self, start, end, limit):
+        '''
+        Return up to `limit` archived orders numbered from start to end, sorted by number.
+        '''
+        segments, firsts = self.get_segments()
+        rows = []
+        for segment in segments[max(bisect.bisect_right(firsts, start) - 1, 0):]:
+            if segment.first > end or len(rows) >= limit:
+                break
+            for row in segment.iter_range(start, end):
+                rows.append(row)
+                if len(rows) >= limit:
+                    break
+        return rows
+
+    def to_dict(self):
+        segments, firsts = self.get_segments()
+        return {
+            "segments": len(segments),
+            "orders": sum(segment.orders for segment in segments),
+            "bytes": sum(len(segment.map) for segment in segments),
+            "archived_upto": self.archived_upto,
+        }
+
+
+class Archiver:
+    """
+    Background thread that moves the orders of whole segment ranges older than the most recent
+    ARCHIVE_KEEP_ORDERS from the orders table into segment files. A segment is on disk and
+    readable before its orders are deleted from the table, so lookups never miss an order.
+    """
+
+    def __init__(self, archive, keep=ARCHIVE_KEEP_ORDERS, interval=ARCHIVE_INTERVAL):
+        self.archive = archive
+        self.keep = keep
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.started = False
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        threading.Thread(target=self.run, name="order-archiver", daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.archive_once()
+            except Exception as e:
+                log_event(sync_logger, logging.WARNING, "archiving failed", error=e)
+
+    def archive_once(self):
+        '''
+        Archive every complete segment range older than the kept orders. Returns the number of
+        orders archived.
+        '''
+        from ..views import orders_lock
+        from .store import order_store
+        latest = order_store.latest()
+        first = self.archive.archived_upto + 1
+        archived = 0
+        while first + ARCHIVE_SEGMENT_ORDERS - 1 <= latest - self.keep:
+            last = first + ARCHIVE_SEGMENT_ORDERS - 1
+            rows = order_store.read_range(first, last)
+            if rows:
+                segment = self.archive.add(rows)
+                numbers = [row[0] for row in rows]
+                # Delete only the archived orders, orders stored in the range meanwhile stay in the table
+                with orders_lock:
+                    order_store.delete(numbers)
+                archived += len(rows)
+                log_event(sync_logger, logging.INFO, "orders archived", first=first, last=last, orders=len(rows), bytes=len(segment.map))
+            first = last + 1
+        return archived
+
+
+# Archived orders of this replica, and the archiver started by order servers without Raft
+order_archive = OrderArchive()
+archiver = Archiver(order_archive)
@@ -0,0 +1,85 @@
+import os
+import sys
+import threading
+from collections import OrderedDict
+from .metrics import Counter
+
+
+# Maximum number of committed orders kept in memory by each order replica
+ORDER_CACHE_SIZE = int(os.environ.get("ORDER_CACHE_SIZE", "100000"))
+
+
+class OrderCache:
+    """
+    A thread-safe, size-bounded LRU cache of committed orders keyed by order number.
+    Committed orders never change, so entries are only evicted for space, never invalidated.
+    """
+
+    def __init__(self, max_entries=ORDER_CACHE_SIZE):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.orders = OrderedDict()  # order number -> (product name, quantity), least recently used first
+        self.memory_bytes = 0  # approximate size of the cached keys and values
+        self.hits = Counter()
+        self.misses = Counter()
+        self.evictions = Counter()
+
+    @staticmethod
+    def entry_size(order_number, value):
+        return sys.getsizeof(order_number) + sys.getsizeof(value) + sum(sys.getsizeof(field) for field in value)
+
+    def get(self, order_number):
+        """
+        Return (product name, quantity) of a cached order, or None if it is not cached.
+        """
+        with self.lock:
+            value = self.orders.get(order_number)
+            if value is not None:
+                self.orders.move_to_end(order_number)
+        (self.hits if value is not None else self.misses).inc()
+        return value
+
+    def put(self, order_number, product_name, quantity):
+        value = (product_name, quantity)
+        with self.lock:
+            if order_number in self.orders:
+                self.orders.move_to_end(order_number)
+                return
+            self.orders[order_number] = value
+            self.memory_bytes += self.entry_size(order_number, value)
+            while len(self.orders) > self.max_entries:
+                evicted_number, evicted_value = self.orders.popitem(last=False)
+                self.memory_bytes -= self.entry_size(evicted_number, evicted_value)
+                self.evictions.inc()
+
+    def discard(self, order_number):
+        with self.lock:
+            value = self.orders.pop(order_number, None)
+            if value is not None:
+                self.memory_bytes -= self.entry_size(order_number, value)
+
+    def put_orders(self, orders):
+        for order in orders:
+            self.put(order.order_number, order.product_name, order.quantity)
+
+    def clear(self):
+        with self.lock:
+            self.orders.clear()
+            self.memory_bytes = 0
+
+    def to_dict(self):
+        hits, misses = self.hits.to_dict(), self.misses.to_dict()
+        with self.lock:
+            return {
+                "entries": len(self.orders),
+                "max_entries": self.max_entries,
+                "memory_bytes": self.memory_bytes,
+                "hits": hits,
+                "misses": misses,
+                "hit_ratio": hits / (hits + misses) if hits + misses else None,
+                "evictions": self.evictions.to_dict(),
+            }
+
+
+# Cache shared by the views and the Raft apply path of this replica
+order_cache = OrderCache()
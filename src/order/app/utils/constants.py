@@ -3,4 +3,11 @@ ORDER_SERVER_PORTS = {
     "3": "8002",
     "2": "8003",
     "1": "8004",
+}
+
+# Dedicated ports for the Raft RPCs between the order servers
+RAFT_RPC_PORTS = {
+    "3": "9002",
+    "2": "9003",
+    "1": "9004",
 }
\ No newline at end of file
@@ -0,0 +1,98 @@
+import json
+import os
+import shutil
+import numpy as np
+
+
+# Orders per exported chunk, and per query while exporting
+EXPORT_CHUNK_ORDERS = 1000000
+EXPORT_PAGE_SIZE = 10000
+
+# Columns of a chunk, one .npy file each
+EXPORT_COLUMNS = {
+    "order_number": np.int64,
+    "product_id": np.int32,  # index into the product names of the manifest
+    "quantity": np.int32,
+}
+
+
+def read_manifest(directory):
+    path = os.path.join(directory, "manifest.json")
+    if not os.path.exists(path):
+        return {"last_order_number": 0, "orders": 0, "products": [], "chunks": []}
+    with open(path) as file:
+        return json.load(file)
+
+
+def write_manifest(directory, manifest):
+    # Replace the manifest at once, so an interrupted export leaves the previous one valid
+    path = os.path.join(directory, "manifest.json")
+    with open(path + ".tmp", "w") as file:
+        json.dump(manifest, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def write_chunk(directory, name, columns):
+    chunk_dir = os.path.join(directory, name)
+    tmp_dir = chunk_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for column, values in columns.items():
+        np.save(os.path.join(tmp_dir, f"{column}.npy"), np.asarray(values, dtype=EXPORT_COLUMNS[column]))
+    os.replace(tmp_dir, chunk_dir)
+
+
+def export_orders(directory, chunk_orders=EXPORT_CHUNK_ORDERS):
+    '''
+    Append the orders numbered above the last export to `directory` as new chunks of columnar
+    .npy arrays. Product names are dictionary-encoded: a product keeps the id it got in an
+    earlier export, and new products get the next ids. Returns the number of orders exported.
+    '''
+    from ..views import iter_order_pages
+    os.makedirs(directory, exist_ok=True)
+    manifest = read_manifest(directory)
+    product_ids = {name: id for id, name in enumerate(manifest["products"])}
+    exported = 0
+    columns = {column: [] for column in EXPORT_COLUMNS}
+
+    def flush():
+        name = f"chunk-{len(manifest['chunks']):06d}"
+        write_chunk(directory, name, columns)
+        manifest["chunks"].append({"name": name, "orders": len(columns["order_number"]), "first": columns["order_number"][0], "last": columns["order_number"][-1]})
+        manifest["last_order_number"] = columns["order_number"][-1]
+        manifest["orders"] += len(columns["order_number"])
+        manifest["products"] = list(product_ids)
+        # The chunk is complete on disk before the manifest lists it
+        write_manifest(directory, manifest)
+        for values in columns.values():
+            values.clear()
+
+    for page in iter_order_pages(start=manifest["last_order_number"] + 1, page_size=EXPORT_PAGE_SIZE):
+        for number, name, quantity in page:
+            columns["order_number"].append(number)
+            columns["product_id"].append(product_ids.setdefault(name, len(product_ids)))
+            columns["quantity"].append(quantity)
+            if len(columns["order_number"]) >= chunk_orders:
+                flush()
+        exported += len(page)
+    if columns["order_number"]:
+        flush()
+    return exported
+
+
+def load_orders(directory, mmap_mode=None):
+    '''
+    Load an export as one array per column and the product names, indexed by product id.
+    '''
+    manifest = read_manifest(directory)
+    arrays = {
+        column: [np.load(os.path.join(directory, chunk["name"], f"{column}.npy"), mmap_mode=mmap_mode) for chunk in manifest["chunks"]]
+        for column in EXPORT_COLUMNS
+    }
+    columns = {
+        column: np.concatenate(chunks) if chunks else np.empty(0, dtype=EXPORT_COLUMNS[column])
+        for column, chunks in arrays.items()
+    }
+    return columns, manifest["products"]
@@ -1,6 +1,14 @@
+import json
+import logging
 import requests
 import os
-from django.http import HttpResponse, JsonResponse
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from django.http import JsonResponse
+from .log import log_event, sync_logger
+from .merkle import merkle_tree
+from .store import order_store
 
 
 FRONTEND_SERVER_HOST = "localhost"
@@ -13,12 +21,22 @@ ORDER_SERVER_PORTS = {
 }
 ORDER_SERVER_ID = os.getenv("ORDER_SERVER_ID")
 
+# Number of order numbers fetched from a peer per request, and inserted per transaction, when a
+# replica synchronizes, and the number of ranges fetched in parallel
+SYNC_RANGE_SIZE = 20000
+SYNC_WORKERS = 4
+# Seconds before a failed startup sync is retried, doubled after every attempt up to the maximum
+SYNC_RETRY_DELAY = 1
+SYNC_RETRY_MAX_DELAY = 30
+# Seconds a replica waits at startup for another replica to be reachable, before it starts from its
+# own orders alone, e.g. when it is the only one running or the whole cluster starts at once
+SYNC_PEER_WAIT = float(os.environ.get("SYNC_PEER_WAIT", "60"))
+
 def get_current_leader():
     try:
-        response = requests.get(f"http://{FRONTEND_SERVER_HOST}:{FRONTEND_SERVER_PORT}/leaders/")
+        response = requests.get(f"http://{FRONTEND_SERVER_HOST}:{FRONTEND_SERVER_PORT}/leaders/", timeout=5)
         if response.status_code == 200:
             response_data = response.json()
-            print(response_data['data']['leader_ID'], response_data['data']['leader_port'])
             return response_data['data']['leader_ID'], response_data['data']['leader_port']
         else:
             return None, None
@@ -26,37 +44,135 @@ def get_current_leader():
         return None, None
 
 def get_latest_order_number():
-    from ..models import Order
     from ..views import orders_lock
-    try:
-        with orders_lock:
-            latest_order = Order.objects.latest('order_number')
-        print("latest_order:", latest_order)
-        return int(latest_order.order_number)
-    except Order.DoesNotExist:
-        return 0
+    with orders_lock:
+        return order_store.latest()
 
-def synchronize_orders():
-    from ..models import Order
-    from ..views import orders_lock
-    latest_order_number = get_latest_order_number()
-    next_order_number = latest_order_number + 1
-    for id, port in ORDER_SERVER_PORTS.items():
-        if id != ORDER_SERVER_ID:
+def fetch_orders(port, after, limit=None, to=None):
+    '''
+    Stream the orders numbered above `after`, and up to `to` if given, from the replica at `port`,
+    one dict per order, followed by the trailer with the cursor to resume from and whether more
+    orders are left.
+    '''
+    params = {"after": after}
+    if limit:
+        params["limit"] = limit
+    if to:
+        params["to"] = to
+    with requests.get(f"http://{ORDER_SERVER_HOST}:{port}/sync/orders/", params=params, headers={"Accept-Encoding": "gzip"}, stream=True, timeout=(3, 30)) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                yield json.loads(line)
+
+def get_peer_latest_order_numbers():
+    '''
+    Ask all other replicas in parallel for their latest order number. Unreachable ones are left out.
+    '''
+    def get_latest(port):
+        response = requests.get(f"http://{ORDER_SERVER_HOST}:{port}/sync/status/", timeout=2)
+        response.raise_for_status()
+        return response.json()["data"]["latest_order_number"]
+
+    peers = {id: port for id, port in ORDER_SERVER_PORTS.items() if id != ORDER_SERVER_ID}
+    latest = {}
+    with ThreadPoolExecutor(max_workers=len(peers)) as pool:
+        futures = {id: pool.submit(get_latest, port) for id, port in peers.items()}
+        for id, future in futures.items():
             try:
-                sync_orders_response = requests.get(f"http://{ORDER_SERVER_HOST}:{port}/sync/orders/{next_order_number}")
-                if sync_orders_response.status_code == 200:
-                    orders_data = sync_orders_response.json()
-                    for order in orders_data["data"]["orders"]:
-                        with orders_lock:
-                            Order.objects.create(
-                                order_number=order['order_number'],
-                                product_name=order['product_name'],
-                                quantity=order['quantity']
-                        )
-                    return JsonResponse(status = 200, data = {'message': 'Orders synchronized successfully'})
-                else:
-                    return JsonResponse(status = sync_orders_response.status_code, data = sync_orders_response.json())
+                latest[id] = future.result()
             except Exception as e:
-                continue 
-    return
\ No newline at end of file
+                log_event(sync_logger, logging.WARNING, "peer status unavailable", peer=id, error=e)
+    return latest
+
+def fetch_range(peers, after, to):
+    '''
+    Fetch the orders in the range (after, to] from the first of the given peers that can serve it.
+    '''
+    for id in peers:
+        try:
+            return [
+                (order['order_number'], order['product_name'], order['quantity'])
+                for order in fetch_orders(ORDER_SERVER_PORTS[id], after, limit=to - after, to=to)
+                if "cursor" not in order
+            ]
+        except Exception as e:
+            log_event(sync_logger, logging.WARNING, "fetching range from peer failed", peer=id, after=after, to=to, error=e)
+    raise RuntimeError(f"No peer could serve the orders from {after + 1} to {to}")
+
+def synchronize_orders():
+    '''
+    Catch up with the most up-to-date peers. The missing order numbers are split into ranges that
+    are fetched from several peers in parallel, a bounded number of ranges ahead, and inserted in
+    order with one bulk insert and transaction per range, so a failed sync resumes from the last
+    inserted order.
+    '''
+    from ..views import orders_lock
+    cursor = get_latest_order_number()
+    latest = get_peer_latest_order_numbers()
+    if not latest:
+        # Without a peer, the orders this replica missed cannot be told apart from none
+        return JsonResponse(status = 503, data = {"error": {"code": 503, "message": "No replica reachable to synchronize with"}})
+    target = max(latest.values())
+    if target <= cursor:
+        return JsonResponse(status = 200, data = {'message': 'Orders synchronized successfully', 'synced': 0})
+
+    # Most up-to-date peers first, a range is only fetched from peers that have all of it
+    peers = sorted(latest, key=latest.get, reverse=True)
+    ranges = [(after, min(after + SYNC_RANGE_SIZE, target)) for after in range(cursor, target, SYNC_RANGE_SIZE)]
+    log_event(sync_logger, logging.INFO, "synchronization started", cursor=cursor, target=target, ranges=len(ranges), peers=len(peers))
+
+    start_time = time.time()
+    synced = 0
+    try:
+        with ThreadPoolExecutor(max_workers=SYNC_WORKERS) as pool:
+            pending = deque()
+            next_range = 0
+            while next_range < len(ranges) or pending:
+                # Keep a bounded number of ranges in flight, so memory does not grow with the backlog
+                while next_range < len(ranges) and len(pending) < SYNC_WORKERS * 2:
+                    after, to = ranges[next_range]
+                    eligible = [id for id in peers if latest[id] >= to]
+                    rotation = next_range % len(eligible)
+                    pending.append(pool.submit(fetch_range, eligible[rotation:] + eligible[:rotation], after, to))
+                    next_range += 1
+                rows = pending.popleft().result()
+                with orders_lock:
+                    # The sync runs after startup, while the leader may already replicate new orders
+                    # here, the store skips the orders stored already
+                    order_store.add(rows)
+                merkle_tree.mark_dirty(number for number, name, quantity in rows)
+                synced += len(rows)
+                elapsed = time.time() - start_time
+                log_event(sync_logger, logging.INFO, "synchronization progress", synced=synced,
+                          cursor=rows[-1][0] if rows else None, target=target, rows_per_sec=round(synced / elapsed) if elapsed else None)
+    except Exception as e:
+        log_event(sync_logger, logging.WARNING, "synchronization failed", synced=synced, error=e)
+        return JsonResponse(status = 500, data = {"error": {"code": 500, "message": "Synchronization failed"}})
+
+    elapsed = time.time() - start_time
+    rows_per_sec = round(synced / elapsed) if elapsed else None
+    log_event(sync_logger, logging.INFO, "synchronization finished", synced=synced, seconds=round(elapsed, 3), rows_per_sec=rows_per_sec)
+    return JsonResponse(status = 200, data = {'message': 'Orders synchronized successfully', 'synced': synced, 'seconds': elapsed, 'rows_per_sec': rows_per_sec})
+
+def synchronize_until_done(readiness=None):
+    '''
+    Synchronize with the peers after startup, retrying with growing delays until a sync succeeds,
+    e.g. once a peer is reachable. The replica refuses orders until then. If no peer has been
+    reachable for SYNC_PEER_WAIT seconds, it starts from its own orders, and reports that as a
+    warning of the "sync" task in `readiness`.
+    '''
+    delay = SYNC_RETRY_DELAY
+    start_time = time.monotonic()
+    while True:
+        response = synchronize_orders()
+        if response.status_code == 200:
+            return response
+        if response.status_code == 503 and time.monotonic() - start_time >= SYNC_PEER_WAIT:
+            log_event(sync_logger, logging.WARNING, "no replica reachable, starting from the local orders", waited=round(time.monotonic() - start_time, 3))
+            if readiness is not None:
+                readiness.warn("sync", f"No replica reachable within {SYNC_PEER_WAIT:g} s, started from the local orders without synchronizing")
+            return JsonResponse(status = 200, data = {'message': 'No replica reachable, started from the local orders', 'synced': 0})
+        log_event(sync_logger, logging.WARNING, "synchronization retry scheduled", status=response.status_code, delay=delay)
+        time.sleep(delay)
+        delay = min(delay * 2, SYNC_RETRY_MAX_DELAY)
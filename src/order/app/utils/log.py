@@ -0,0 +1,133 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+
+# Most recent events kept in memory and served by /raft/events/
+EVENT_BUFFER_SIZE = int(os.environ.get("RAFT_EVENT_BUFFER_SIZE", "1000"))
+recent_events = deque(maxlen=EVENT_BUFFER_SIZE)
+
+# Loggers of the Raft and order subsystems, each with its own level (see LOG_LEVELS in settings.py)
+election_logger = logging.getLogger("raft.election")
+replication_logger = logging.getLogger("raft.replication")
+apply_logger = logging.getLogger("raft.apply")
+rpc_logger = logging.getLogger("raft.rpc")
+middleware_logger = logging.getLogger("order.middleware")
+views_logger = logging.getLogger("order.views")
+sync_logger = logging.getLogger("order.sync")
+
+
+def log_event(logger, level, message, **fields):
+    """
+    Log a structured event with key-value fields. The fields are only formatted when the
+    logger is enabled for the level, so disabled debug events on hot paths cost one check.
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, message, extra={"fields": fields})
+
+
+def parse_log_levels(value, default="INFO"):
+    """
+    Parse per-subsystem levels such as "raft=INFO,raft.replication=DEBUG" into a dict.
+    """
+    levels = {"raft": default, "order": default}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, _, level = item.partition("=")
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Keep at most one out of every `sample` records and at most `rate` records per second for
+    each logger. Warnings and errors are never dropped. The number of records dropped since
+    the last one let through is attached to it as `suppressed`.
+    """
+
+    def __init__(self, rate=50, sample=1):
+        super().__init__()
+        self.rate = int(rate)
+        self.sample = max(int(sample), 1)
+        self.lock = threading.Lock()
+        self.windows = {}  # logger name -> [window start, emitted in window, suppressed, seen]
+
+    def filter(self, record):
+        record.suppressed = 0
+        if record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.setdefault(record.name, [now, 0, 0, 0])
+            window[3] += 1
+            if window[3] % self.sample:
+                window[2] += 1
+                return False
+            if now - window[0] >= 1:
+                window[0], window[1] = now, 0
+            if window[1] >= self.rate:
+                window[2] += 1
+                return False
+            window[1] += 1
+            record.suppressed, window[2] = window[2], 0
+        return True
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Format a record as "time level subsystem message key=value ...".
+    """
+
+    def format(self, record):
+        fields = dict(getattr(record, "fields", {}))
+        if getattr(record, "suppressed", 0):
+            fields["suppressed"] = record.suppressed
+        line = f"{self.formatTime(record)} {record.levelname} {record.name} {record.getMessage()}"
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class RingBufferHandler(logging.Handler):
+    """
+    Keep the most recent records as structured events in `recent_events`.
+    """
+
+    def emit(self, record):
+        event = {
+            "time": record.created,
+            "level": record.levelname,
+            "subsystem": record.name,
+            "message": record.getMessage(),
+            # Keep the events JSON serializable, e.g. exceptions passed as fields
+            "fields": {
+                key: value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+                for key, value in getattr(record, "fields", {}).items()
+            },
+        }
+        if getattr(record, "suppressed", 0):
+            event["suppressed"] = record.suppressed
+        recent_events.append(event)
+
+
+def get_recent_events(limit=100, subsystem=None, level=None):
+    """
+    Return up to `limit` of the most recent events, optionally only those of a subsystem
+    (including its children) and at or above a level.
+    """
+    min_level = logging.getLevelName(level.upper()) if level else 0
+    if not isinstance(min_level, int):
+        raise ValueError(f"Unknown level {level}")
+    events = []
+    for event in reversed(list(recent_events)):
+        if subsystem and not (event["subsystem"] == subsystem or event["subsystem"].startswith(subsystem + ".")):
+            continue
+        if logging.getLevelName(event["level"]) < min_level:
+            continue
+        events.append(event)
+        if len(events) >= limit:
+            break
+    return events
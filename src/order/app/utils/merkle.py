@@ -0,0 +1,192 @@
+import hashlib
+import logging
+import threading
+import requests
+from .constants import ORDER_SERVER_HOST, ORDER_SERVER_PORTS
+from .log import log_event, sync_logger
+
+
+# Number of order numbers covered by one leaf, and children per inner node. With 6 levels of
+# 16 children above the leaves, the tree covers the order numbers up to 1024 * 16 ** 6.
+MERKLE_LEAF_SIZE = 1024
+MERKLE_FANOUT = 16
+MERKLE_LEVELS = 6
+
+# Hash of a subtree without orders
+EMPTY_HASH = bytes(16)
+
+
+def order_digest(order_number, product_name, quantity):
+    return int.from_bytes(hashlib.blake2b(f"{order_number}:{product_name}:{quantity}".encode(), digest_size=16).digest(), "big")
+
+
+class MerkleTree:
+    """
+    A Merkle tree over ranges of order numbers, with the same fixed shape on every replica.
+
+    Level 0 holds the leaves, leaf i covers the order numbers from i * MERKLE_LEAF_SIZE + 1 to
+    (i + 1) * MERKLE_LEAF_SIZE. A leaf hash is the sum of the digests of its orders, so the
+    order of insertion does not matter, and an inner node hash is the hash of its children's.
+    Only non-empty nodes are stored. Writers mark the leaves of the orders they commit as dirty,
+    and the dirty leaves are read again from the database before the tree is next used, so the
+    cost of keeping the tree up to date follows the number of changed ranges, not the table size.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()  # guards the nodes, held while the tree is refreshed
+        self.dirty_lock = threading.Lock()
+        self.dirty = set()  # indexes of the leaves changed since the last refresh
+        self.built = False
+        self.nodes = [dict() for _ in range(MERKLE_LEVELS + 1)]  # level -> node index -> hash
+
+    @staticmethod
+    def leaf_of(order_number):
+        return (int(order_number) - 1) // MERKLE_LEAF_SIZE
+
+    @staticmethod
+    def leaf_range(level, index):
+        '''
+        First and last order number covered by a node.
+        '''
+        span = MERKLE_LEAF_SIZE * MERKLE_FANOUT ** level
+        return index * span + 1, (index + 1) * span
+
+    def mark_dirty(self, order_numbers):
+        with self.dirty_lock:
+            self.dirty.update(self.leaf_of(number) for number in order_numbers)
+
+    def refresh(self):
+        '''
+        Build the tree from the database on first use, then recompute the dirty leaves and
+        the nodes above them.
+        '''
+        from ..views import iter_order_pages
+        with self.lock:
+            with self.dirty_lock:
+                dirty, self.dirty = self.dirty, set()
+            if not self.built:
+                leaves = {}
+                for page in iter_order_pages(start=1, page_size=10000):
+                    for number, name, quantity in page:
+                        leaf = self.leaf_of(number)
+                        leaves[leaf] = leaves.get(leaf, 0) + order_digest(number, name, quantity)
+                self.nodes[0] = {leaf: self.leaf_hash(total) for leaf, total in leaves.items()}
+                changed = set(leaves)
+                self.built = True
+            else:
+                for leaf in dirty:
+                    first, last = self.leaf_range(0, leaf)
+                    rows = [row for page in iter_order_pages(start=first, end=last, page_size=MERKLE_LEAF_SIZE) for row in page]
+                    total = sum(order_digest(*row) for row in rows)
+                    if rows:
+                        self.nodes[0][leaf] = self.leaf_hash(total)
+                    else:
+                        self.nodes[0].pop(leaf, None)
+                changed = dirty
+
+            # Recompute the inner nodes above the changed leaves, one level at a time
+            for level in range(1, MERKLE_LEVELS + 1):
+                changed = {index // MERKLE_FANOUT for index in changed}
+                for index in changed:
+                    children = [self.nodes[level - 1].get(index * MERKLE_FANOUT + k, EMPTY_HASH) for k in range(MERKLE_FANOUT)]
+                    if any(child != EMPTY_HASH for child in children):
+                        self.nodes[level][index] = hashlib.blake2b(b"".join(children), digest_size=16).digest()
+                    else:
+                        self.nodes[level].pop(index, None)
+
+    @staticmethod
+    def leaf_hash(total):
+        return (total % (1 << 128)).to_bytes(16, "big")
+
+    def get_node(self, level=MERKLE_LEVELS, index=0):
+        '''
+        Return the hash of a node and, above the leaves, the hashes of its children.
+        '''
+        self.refresh()
+        with self.lock:
+            node = {
+                "level": level,
+                "index": index,
+                "from": self.leaf_range(level, index)[0],
+                "to": self.leaf_range(level, index)[1],
+                "hash": self.nodes[level].get(index, EMPTY_HASH).hex(),
+            }
+            if level > 0:
+                node["children"] = [
+                    self.nodes[level - 1].get(index * MERKLE_FANOUT + k, EMPTY_HASH).hex()
+                    for k in range(MERKLE_FANOUT)
+                ]
+            return node
+
+
+def find_differing_ranges(tree, port):
+    '''
+    Compare the local tree with the one of the replica at `port`, descending only into the
+    children whose hashes differ. Returns the differing leaf ranges and the nodes compared.
+    '''
+    session = requests.Session()
+    url = f"http://{ORDER_SERVER_HOST}:{port}/merkle/"
+    pending = [(MERKLE_LEVELS, 0)]
+    ranges, compared = [], 0
+    while pending:
+        level, index = pending.pop()
+        local = tree.get_node(level, index)
+        response = session.get(url, params={"level": level, "index": index}, timeout=5)
+        response.raise_for_status()
+        remote = response.json()["data"]
+        compared += 1
+        if local["hash"] == remote["hash"]:
+            continue
+        if level == 0:
+            ranges.append((local["from"], local["to"]))
+            continue
+        for k, (local_child, remote_child) in enumerate(zip(local["children"], remote["children"])):
+            if local_child != remote_child:
+                pending.append((level - 1, index * MERKLE_FANOUT + k))
+    return sorted(ranges), compared
+
+
+def repair_from_peer(tree, peer_id):
+    '''
+    Make the differing ranges of this replica match the replica `peer_id`: orders missing here
+    are inserted and orders with other contents are overwritten with the peer's. Orders that
+    only this replica has are kept and reported.
+    '''
+    from ..views import orders_lock, iter_order_pages
+    from .leader import fetch_orders
+    from .cache import order_cache
+    from .aggregates import rebuild_product_stats
+    from .store import order_store
+    port = ORDER_SERVER_PORTS[peer_id]
+    ranges, compared = find_differing_ranges(tree, port)
+    inserted, updated, local_only = 0, 0, 0
+    for first, last in ranges:
+        remote = {
+            order['order_number']: (order['product_name'], order['quantity'])
+            for order in fetch_orders(port, first - 1, limit=last - first + 1, to=last)
+            if "cursor" not in order
+        }
+        local = {number: (name, quantity) for page in iter_order_pages(start=first, end=last) for number, name, quantity in page}
+        with orders_lock:
+            with order_store.atomic():
+                missing = order_store.add([(number, name, quantity) for number, (name, quantity) in remote.items() if number not in local])
+                # An archived order is overridden by a row in the table, archives are never rewritten
+                changed = [(number, name, quantity) for number, (name, quantity) in remote.items() if number in local and local[number] != (name, quantity)]
+                order_store.replace(changed)
+        for number, name, quantity in changed:
+            order_cache.discard(number)
+        updated += len(changed)
+        inserted += len(missing)
+        local_only += len(set(local) - set(remote))
+        tree.mark_dirty(range(first, last + 1, MERKLE_LEAF_SIZE))
+    if updated:
+        # Overwritten orders may have moved between products, so count them all again
+        with orders_lock:
+            rebuild_product_stats()
+    result = {"peer": peer_id, "nodes_compared": compared, "ranges": len(ranges), "inserted": inserted, "updated": updated, "local_only": local_only}
+    log_event(sync_logger, logging.INFO, "anti-entropy repair finished", **result)
+    return result
+
+
+# Merkle tree of the orders of this replica
+merkle_tree = MerkleTree()
@@ -0,0 +1,108 @@
+import threading
+
+
+# Default latency buckets in seconds, from 1 ms up to 10 s
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Default buckets for the number of log entries carried by one AppendEntries RPC
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+
+class Counter:
+    """
+    A thread-safe monotonically increasing counter.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def to_dict(self):
+        return self.value
+
+
+class Histogram:
+    """
+    A thread-safe fixed-bucket histogram. Each bucket counts the observations that are
+    less than or equal to its upper bound, the last bucket ("+Inf") counts everything else.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            else:
+                self.counts[-1] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Estimate the q-quantile as the upper bound of the bucket that contains it.
+        """
+        with self.lock:
+            if self.count == 0:
+                return None
+            rank = q * self.count
+            seen = 0
+            for i, bound in enumerate(self.buckets):
+                seen += self.counts[i]
+                if seen >= rank:
+                    return bound
+            return self.max
+
+    def to_dict(self):
+        p50, p99 = self.quantile(0.5), self.quantile(0.99)
+        with self.lock:
+            buckets = {str(bound): count for bound, count in zip(self.buckets, self.counts)}
+            buckets["+Inf"] = self.counts[-1]
+            return {
+                "count": self.count,
+                "sum": self.sum,
+                "mean": self.sum / self.count if self.count else None,
+                "max": self.max,
+                "p50": p50,
+                "p99": p99,
+                "buckets": buckets,
+            }
+
+
+class RaftMetrics:
+    """
+    Metrics collected by a Raft node for capacity planning of the order tier.
+    """
+
+    def __init__(self, peer_ids):
+        self.commit_latency = Histogram()  # proposal-to-commit latency on the leader
+        self.append_entries_rtt = {id: Histogram() for id in peer_ids}  # AppendEntries round trip time per peer
+        self.elections_started = Counter()
+        self.elections_won = Counter()
+        self.election_duration = Histogram()  # time from starting an election to collecting all votes
+        self.batch_size = Histogram(BATCH_SIZE_BUCKETS)  # entries carried by a non-empty AppendEntries
+        self.disk_write_latency = Histogram()  # time to make new log entries durable
+
+    def to_dict(self):
+        return {
+            "commit_latency_seconds": self.commit_latency.to_dict(),
+            "append_entries_rtt_seconds": {id: histogram.to_dict() for id, histogram in self.append_entries_rtt.items()},
+            "elections_started": self.elections_started.to_dict(),
+            "elections_won": self.elections_won.to_dict(),
+            "election_duration_seconds": self.election_duration.to_dict(),
+            "batch_size": self.batch_size.to_dict(),
+            "disk_write_latency_seconds": self.disk_write_latency.to_dict(),
+        }
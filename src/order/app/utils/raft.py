@@ -1,12 +1,20 @@
+import asyncio
+import logging
 import threading
 import time
 import os
 import random
-import requests
+import httpx
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
-from django.db import transaction
-from app.models import Order, LogEntry, RaftServer
+from app.models import LogEntry, RaftServer
 from app.utils.constants import ORDER_SERVER_HOST, ORDER_SERVER_PORTS
+from app.utils.metrics import RaftMetrics
+from app.utils.cache import order_cache
+from app.utils.merkle import merkle_tree
+from app.utils.store import order_store
+from app.utils.raft_rpc import RaftRPCServer
+from app.utils.log import log_event, election_logger, replication_logger, apply_logger, rpc_logger
 
 USE_DELAY = True if os.environ.get("USE_DELAY") == "True" else False
 
@@ -15,9 +23,14 @@ class RaftConfig:
     HEARTBEAT_TIMEOUT = timedelta(milliseconds=1500)
     ELECT_TIMEOUT_BASE = timedelta(milliseconds=5000)
     ELECT_TIMEOUT_CHECK_INTERVAL = timedelta(milliseconds=3000)
+    RPC_TIMEOUT = timedelta(milliseconds=1000)
+    PROPOSAL_TIMEOUT = timedelta(milliseconds=10000)
+    MAX_ENTRIES_PER_RPC = 256
+    NOOP_COMMAND = 'no-op' # command of the entry without an order that a new leader appends
     FOLLOWER   	= 0
     CANDIDATE 	= 1
     LEADER     	= 2
+    STATE_NAMES = {FOLLOWER: "follower", CANDIDATE: "candidate", LEADER: "leader"}
 
 class RequestVoteArgs:
     def __init__(self, term, candidate_id, last_log_index, last_log_term):
@@ -44,57 +57,219 @@ class AppendEntriesReply:
     def __init__(self):
         self.term = 0 # currentTerm, for leader to update itself
         self.success = False # true if follower contained entry matching prevLogIndex and prevLogTerm  
+        self.next_index = None # on failure, where the follower suggests the leader backs up nextIndex to
 
 class Raft:
-    def __init__(self, server_id, peers):
-        self.mu = threading.Lock()
+    '''
+    A Raft server driven by a single asyncio event loop. The election timer, heartbeats,
+    replication and the RPC handlers all run as coroutines on that loop, outgoing RPCs share
+    one pooled async HTTP client, and database writes are handed to a single disk thread so
+    they never block the loop.
+    '''
+    def __init__(self, server_id, peers, rpc_port=None):
+        self.mu = asyncio.Lock() # guards the Raft state, only acquired on the event loop
         self.peers = peers  
         self.me = server_id
         self.dead = False
+        self.loaded = threading.Event() # set once the persistent state is loaded and the server runs
+        self.load_seconds = None
         
-        # Initial persistent state from database
-        self.server_state, created = RaftServer.objects.get_or_create(pk=1)
-        self.logs = [log_entry.to_dict() for log_entry in LogEntry.objects.all().order_by('id')]
-        self.currentTerm = self.server_state.current_term # latest term server has seen (initialized to 0 on first boot, increases monotonically)
-        self.votedFor = self.server_state.voted_for # candidateId that received vote in current term (or null if none)
+        # Persistent state, loaded from the database by load()
+        self.server_state = None
+        self.logs = []
+        self.currentTerm = 0 # latest term server has seen (initialized to 0 on first boot, increases monotonically)
+        self.votedFor = None # candidateId that received vote in current term (or null if none)
 
         # Initial volatile state
-        self.commitIndex = self.logs[-1]['index'] if self.logs else 0 # index of highest log entry known to be committed (initialized to 0, increases monotonically)
-        self.lastApplied = self.logs[-1]['index'] if self.logs else 0 # index of highest log entry applied to state machine (initialized to 0, increases monotonically)
+        self.commitIndex = 0 # index of highest log entry known to be committed (initialized to 0, increases monotonically)
+        self.lastApplied = 0 # index of highest log entry applied to state machine (initialized to 0, increases monotonically)
 
         # Leader state
-        self.nextIndex = {id: len(self.logs) + 1 for id, url in peers} # for each server, index of the next log entry to send to that server (initialized to leader last log index + 1)
+        self.nextIndex = {id: 1 for id, url in peers} # for each server, index of the next log entry to send to that server (initialized to leader last log index + 1)
         self.matchIndex = {id: 0 for id, url in peers} # for each server, index of highest log entry known to be replicated on server (initialized to 0, increases monotonically)
 
         self.leaderId = None
         self.currentState = RaftConfig.FOLLOWER 
         self.lastHeartbeatTime = time.time()
+
+        # Event loop, set by start() or start_async()
+        self.loop = None
+        self.rpc_port = rpc_port # port of the dedicated Raft RPC listener, if any
+        self.rpc_server = None
+        self.client = None # async HTTP client shared by all outgoing RPCs
+        self.disk = ThreadPoolExecutor(max_workers=1, thread_name_prefix='raft-disk') # serializes database writes
+        self.replicate_events = {} # peer id -> event set when new entries are waiting to be replicated to it
+        self.commit_waiters = {} # log index -> future resolved with the stored order once the entry is applied
+        self.unresolved_proposals = [] # (first index, term, callback) of proposals that returned before their outcome was known
+        self.persistedIndex = 0 # index of highest log entry known to be durable in the local database
+        self.persist_task = None # writes the leader's new entries to disk while they are being replicated
+
+        # Metrics exposed through /raft/status/
+        self.peer_ids = {url: id for id, url in peers}
+        self.metrics = RaftMetrics([id for id, url in peers if id != server_id])
+
+    def load(self):
+        '''
+        Load the persistent state from the database.
+        '''
+        self.server_state, created = RaftServer.objects.get_or_create(pk=1)
+        self.logs = [log_entry.to_dict() for log_entry in LogEntry.objects.select_related('order').order_by('index')]
+        self.currentTerm = self.server_state.current_term
+        self.votedFor = self.server_state.voted_for
+        # Entries are persisted before they are committed, so only those with an order are applied
+        applied = LogEntry.objects.filter(order__isnull=False).order_by('-index').first()
+        self.commitIndex = applied.index if applied else 0
+        self.lastApplied = applied.index if applied else 0
+        self.persistedIndex = len(self.logs)
+        self.nextIndex = {id: len(self.logs) + 1 for id, url in self.peers}
+
+    def start(self):
+        '''
+        Start the server on an event loop of its own in a background thread. Used by the WSGI
+        entry point, where no event loop is running. Returns right away, the log is loaded in
+        the background and `loaded` is set once the server runs.
+        '''
+        loop = asyncio.new_event_loop()
+
+        def run_loop():
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.start_async())
+            loop.run_forever()
+
+        threading.Thread(target=run_loop, name='raft-loop', daemon=True).start()
+
+    async def start_async(self):
+        '''
+        Start the server on the running event loop. Used by the ASGI entry point.
+        '''
+        if self.loop is not None:
+            return
+        self.loop = asyncio.get_running_loop()
+        start_time = time.time()
+        await self.loop.run_in_executor(self.disk, self.load)
+        self.load_seconds = time.time() - start_time
+        self.client = httpx.AsyncClient(timeout=RaftConfig.RPC_TIMEOUT.total_seconds())
+        if self.rpc_port:
+            self.rpc_server = await RaftRPCServer(self).start(ORDER_SERVER_HOST, self.rpc_port)
+        self.replicate_events = {id: asyncio.Event() for id, url in self.peers if id != self.me}
+        self.loop.create_task(self.ticker())
+        self.loaded.set()
+        log_event(election_logger, logging.INFO, "Raft server started", server=self.me, entries=len(self.logs), load_seconds=round(self.load_seconds, 3))
+
+    async def stop(self):
+        self.dead = True
+        if self.rpc_server:
+            await self.rpc_server.stop()
+        if self.client:
+            await self.client.aclose()
+
+    def run(self, coro):
+        '''
+        Run a coroutine on the Raft event loop from a synchronous caller and wait for its result.
+        '''
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def call(self, coro):
+        '''
+        Await a coroutine on the Raft event loop from any event loop.
+        '''
+        if asyncio.get_running_loop() is self.loop:
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
     
     # return currentTerm and whether this server believes it is the leader.
     def get_state(self):
-        with self.mu:
-            term = self.currentTerm
-            is_leader = (self.currentState == RaftConfig.LEADER)
-            return term, is_leader
+        # The event loop is the only writer, so reading the two fields needs no lock
+        term = self.currentTerm
+        is_leader = (self.currentState == RaftConfig.LEADER)
+        return term, is_leader
 
     def get_leader_url(self):
         return f'''http://{ORDER_SERVER_HOST}:{ORDER_SERVER_PORTS[str(self.leaderId)]}''' if self.leaderId else None
 
+    def get_status(self):
+        '''
+        Return a snapshot of the Raft state and metrics of this server.
+        '''
+        last_log_index = len(self.logs)
+        peers = {}
+        for id, url in self.peers:
+            if id != self.me:
+                peers[id] = {
+                    'nextIndex': self.nextIndex[id],
+                    'matchIndex': self.matchIndex[id],
+                    'lag': last_log_index - self.matchIndex[id],
+                }
+        return {
+            'id': self.me,
+            'role': RaftConfig.STATE_NAMES[self.currentState],
+            'term': self.currentTerm,
+            'leader': self.leaderId,
+            'commitIndex': self.commitIndex,
+            'lastApplied': self.lastApplied,
+            'lastLogIndex': last_log_index,
+            'persistedIndex': self.persistedIndex,
+            'peers': peers,
+            'metrics': self.metrics.to_dict(),
+        }
+
+    async def persist_term(self):
+        '''
+        Persist currentTerm and votedFor. The caller holds self.mu.
+        '''
+        await self.loop.run_in_executor(self.disk, self.server_state.update_term, self.currentTerm, self.votedFor)
+
+    async def step_down(self, term):
+        '''
+        Adopt a higher term seen in an RPC and change to follower. The caller holds self.mu.
+        '''
+        log_event(election_logger, logging.INFO, "higher term seen, change to follower",
+                  server=self.me, term=self.currentTerm, new_term=term)
+        self.currentTerm = term
+        self.votedFor = None
+        self.currentState = RaftConfig.FOLLOWER
+        await self.persist_term()
+        # Proposals waiting on this server can no longer be committed by it
+        for waiter in self.commit_waiters.values():
+            if not waiter.done():
+                waiter.set_result(None)
+        self.commit_waiters.clear()
+
+    def become_leader(self):
+        '''
+        Take over as leader for the current term. The caller holds self.mu.
+        '''
+        log_event(election_logger, logging.INFO, "became leader", server=self.me, term=self.currentTerm)
+        self.currentState = RaftConfig.LEADER
+        self.leaderId = self.me
+        for id, url in self.peers:
+            self.nextIndex[id] = len(self.logs) + 1
+            self.matchIndex[id] = 0
+        self.metrics.elections_won.inc()
+        # Append an entry of the new term right away, so the entries of earlier terms are committed,
+        # or replaced, without waiting for the next order, and their pending proposals are resolved
+        self.logs.append({'index': len(self.logs) + 1, 'term': self.currentTerm, 'command': RaftConfig.NOOP_COMMAND, 'order': None})
+        if self.persist_task is None or self.persist_task.done():
+            self.persist_task = self.loop.create_task(self.persist_local())
+        for id, url in self.peers:
+            if id != self.me:
+                self.loop.create_task(self.peer_replicator(id, url, self.currentTerm))
     
-    def ticker(self):
+    async def ticker(self):
         '''
-        This function is called periodically to check if the server has timed out and needs to start a new election.
+        This coroutine runs periodically to check if the server has timed out and needs to start a new election.
         '''
-        while not self.dead and self.currentState != RaftConfig.LEADER:
-            time.sleep(RaftConfig.ELECT_TIMEOUT_CHECK_INTERVAL.total_seconds())
-            with self.mu:
-                elapsed_time = time.time() - self.lastHeartbeatTime
-                random_timeout = RaftConfig.ELECT_TIMEOUT_BASE.total_seconds() + random.randint(0, 250) / 1000.0
+        while not self.dead:
+            await asyncio.sleep(RaftConfig.ELECT_TIMEOUT_CHECK_INTERVAL.total_seconds())
+            if self.currentState == RaftConfig.LEADER:
+                continue
+            elapsed_time = time.time() - self.lastHeartbeatTime
+            random_timeout = RaftConfig.ELECT_TIMEOUT_BASE.total_seconds() + random.randint(0, 250) / 1000.0
             if elapsed_time >= random_timeout:
-                print(f"Server {self.me} election timeout, start new election")
-                self.start_election()
+                log_event(election_logger, logging.INFO, "election timeout", server=self.me, elapsed=round(elapsed_time, 3))
+                await self.start_election()
     
-    def send_request_vote(self, server_url, args, reply):
+    async def send_request_vote(self, server_url, args, reply):
         url = f"{server_url}/vote/"
         data = {
             'Term': args.Term,
@@ -104,104 +279,216 @@ class Raft:
         }
         
         try:
-            response = requests.post(url, json=data)
+            response = await self.client.post(url, json=data)
             response_data = response.json()
             
             reply.VoteGranted = response_data.get('VoteGranted', False)
             reply.Term = response_data.get('Term', args.Term)
-            print(f'''VoteGranted: {reply.VoteGranted}, Term: {reply.Term}''')
+            log_event(election_logger, logging.DEBUG, "vote reply", peer=server_url, granted=reply.VoteGranted, term=reply.Term)
             return response.status_code == 200
-        except requests.RequestException as e:
-            print(f"Request failed: {e}")
+        except (httpx.HTTPError, ValueError) as e:
+            log_event(rpc_logger, logging.DEBUG, "RequestVote failed", peer=server_url, error=e)
             return False
 
-    def start_election(self):
+    async def start_election(self):
         '''
         Start a new election by incrementing the current term and requesting votes from other servers.
         '''
-        with self.mu:
+        async with self.mu:
             self.currentTerm += 1
             self.votedFor = self.me
-            self.server_state.update_term(self.currentTerm, self.me)
             self.currentState = RaftConfig.CANDIDATE
             self.lastHeartbeatTime = time.time()
-            votesReceived = 1
-        print(f"Server {self.me} starting an election in term {self.currentTerm}.")
-
-        def request_vote(server_url):
-            args = RequestVoteArgs(self.currentTerm, self.me, len(self.logs) - 1,
+            await self.persist_term()
+            term = self.currentTerm
+            args = RequestVoteArgs(term, self.me, len(self.logs) - 1,
                                     self.logs[-1]['term'] if self.logs else 0)
+        log_event(election_logger, logging.INFO, "starting election", server=self.me, term=term)
+        self.metrics.elections_started.inc()
+        election_start_time = time.time()
+        votesReceived = 1
+
+        async def request_vote(server_url):
+            nonlocal votesReceived
             reply = RequestVoteReply()
-            ok = self.send_request_vote(server_url, args, reply)
-            print(f'''ok: {ok}, reply.VoteGranted: {reply.VoteGranted}''')
-            if ok and reply.VoteGranted:
-                nonlocal votesReceived
-                with self.mu:
-                    votesReceived += 1
-                print(f'''votesReceived {votesReceived}, majority requirement {len(self.peers) / 2}''')
-                if votesReceived > len(self.peers) / 2 and self.currentState != RaftConfig.LEADER:
-                    with self.mu:
-                        self.currentState = RaftConfig.LEADER
-                        self.leaderId = self.me
-                    self.send_heart_beats()
-                    
-        threads = []
-        # Send request vote to all peers
-        for i, url in self.peers:
-            if i != self.me:
-                print(f'''Sending request vote to server {i} at {url}''')
-                thread = threading.Thread(target=request_vote, args=(url,))
-                threads.append(thread)
-                thread.start()
-        
-        # Wait for all threads to finish
-        for thread in threads:
-            thread.join()
-    
-    def send_heart_beats(self):
-        '''Send heartbeats to all peers to maintain leadership status.'''
-        print(f"Server {self.me} is now the leader, sending heartbeats.")
-
-        def heartbeat_loop():
-            while self.currentState == RaftConfig.LEADER:
-                args = AppendEntriesArgs(
-                    term=self.currentTerm,
-                    leader_id=self.me,
-                    prev_log_index=len(self.logs) - 1,
-                    prev_log_term=self.logs[-1]['term'] if self.logs else 0,
-                    entries=[],
-                    leader_commit=self.commitIndex
-                )
-                replies = []
-                threads = []
-                for i, peer in self.peers:
-                    if i != self.me:
-                        reply = AppendEntriesReply()
-                        thread = threading.Thread(target=self.send_append_entries, args=(peer, args, reply))
-                        threads.append(thread)
-                        replies.append(reply)
-                        thread.start()
-                for thread in threads:
-                    thread.join()
-                
-                # Check replies for higher term to step down as leader
-                for reply in replies:
-                    if reply.term > self.currentTerm:
-                        print(f'''reply.term: {reply.term}, self.currentTerm: {self.currentTerm}''')
-                        with self.mu:
-                            self.currentTerm = reply.term
-                            self.votedFor = None
-                            self.currentState = RaftConfig.FOLLOWER
-                            self.server_state.update_term(self.currentTerm, None)
-                            print(f"Server {self.me} find higher term. Change to follower")
-                            return
-
-                time.sleep(RaftConfig.HEARTBEAT_TIMEOUT.total_seconds())
-
-        # Start the heartbeat loop in a new thread
-        threading.Thread(target=heartbeat_loop).start()
+            ok = await self.send_request_vote(server_url, args, reply)
+            async with self.mu:
+                if reply.Term > self.currentTerm:
+                    await self.step_down(reply.Term)
+                    return
+                if not (ok and reply.VoteGranted):
+                    return
+                votesReceived += 1
+                log_event(election_logger, logging.DEBUG, "vote received", term=term, votes=votesReceived, servers=len(self.peers))
+                if votesReceived > len(self.peers) / 2 and self.currentState == RaftConfig.CANDIDATE and self.currentTerm == term:
+                    self.become_leader()
+
+        # Send request vote to all peers concurrently
+        await asyncio.gather(*(request_vote(url) for i, url in self.peers if i != self.me))
+        self.metrics.election_duration.observe(time.time() - election_start_time)
+
+    async def peer_replicator(self, id, peer, term):
+        '''
+        Keep one peer's log in sync while this server is the leader for the given term. Every
+        round sends the entries from the peer's nextIndex, which doubles as the heartbeat when
+        there is nothing to send. A lagging or diverged follower is caught up by consecutive
+        rounds without waiting, so it converges in the background instead of inside the latency
+        of the next client order.
+        '''
+        event = self.replicate_events[id]
+        while not self.dead and self.currentState == RaftConfig.LEADER and self.currentTerm == term:
+            event.clear()
+            caught_up = await self.replicate_to(id, peer, term)
+            if caught_up:
+                # Wait for new entries, or send a heartbeat once the interval elapses
+                try:
+                    await asyncio.wait_for(event.wait(), RaftConfig.HEARTBEAT_TIMEOUT.total_seconds())
+                except asyncio.TimeoutError:
+                    pass
+
+    async def replicate_to(self, id, peer, term):
+        '''
+        Send one AppendEntries RPC to a peer and process the reply. Returns whether the peer
+        is known to hold the whole log, or is unreachable and should only be retried on the
+        next heartbeat.
+        '''
+        async with self.mu:
+            if self.currentState != RaftConfig.LEADER or self.currentTerm != term:
+                return True
+            prev_log_index = self.nextIndex[id] - 1
+            args = AppendEntriesArgs(
+                term=term,
+                leader_id=self.me,
+                prev_log_index=prev_log_index,
+                prev_log_term=self.logs[prev_log_index - 1]['term'] if prev_log_index >= 1 else 0,
+                entries=self.logs[prev_log_index:prev_log_index + RaftConfig.MAX_ENTRIES_PER_RPC], # Send log entries starting from nextIndex
+                leader_commit=self.commitIndex
+            )
+        if args.entries:
+            self.metrics.batch_size.observe(len(args.entries))
+
+        reply = AppendEntriesReply()
+        ok = await self.send_append_entries(peer, args, reply)
+
+        async with self.mu:
+            if self.currentState != RaftConfig.LEADER or self.currentTerm != term:
+                return True
+            if reply.term > self.currentTerm:
+                await self.step_down(reply.term)
+                return True
+            if not ok:
+                return True
+            if reply.success:
+                self.nextIndex[id] = max(self.nextIndex[id], args.prev_log_index + len(args.entries) + 1)
+                self.matchIndex[id] = max(self.matchIndex[id], self.nextIndex[id] - 1)
+                await self.advance_commit_index()
+                return self.nextIndex[id] > len(self.logs)
+            # Back up nextIndex, skipping straight to the follower's hint when it sent one
+            next_index = self.nextIndex[id] - 1
+            if reply.next_index:
+                next_index = min(next_index, reply.next_index)
+            self.nextIndex[id] = max(next_index, 1)
+            return False
+
+    async def advance_commit_index(self):
+        '''
+        Commit the highest entry of the current term stored on a majority of servers, then apply it.
+        The caller holds self.mu.
+        '''
+        for index in range(len(self.logs), self.commitIndex, -1):
+            if self.logs[index - 1]['term'] != self.currentTerm:
+                break
+            # The leader only counts itself once its own copy of the entry is durable
+            replicas = (1 if self.persistedIndex >= index else 0) + \
+                sum(1 for i, peer in self.peers if i != self.me and self.matchIndex[i] >= index)
+            if replicas > len(self.peers) / 2:
+                self.commitIndex = index
+                break
+        await self.apply_committed()
+
+    async def apply_committed(self):
+        '''
+        Apply the entries between lastApplied and commitIndex to the state machine and wake up
+        the proposals waiting on them. The caller holds self.mu.
+        '''
+        entries = self.logs[self.lastApplied:self.commitIndex]
+        if not entries:
+            return
+        orders = await self.loop.run_in_executor(self.disk, self.apply_entries, entries)
+        self.lastApplied = self.commitIndex
+        log_event(apply_logger, logging.DEBUG, "applied entries", count=len(entries), last_applied=self.lastApplied)
+        for entry, order in zip(entries, orders):
+            waiter = self.commit_waiters.pop(entry['index'], None)
+            if waiter and not waiter.done():
+                waiter.set_result(order)
+        self.resolve_proposals()
+
+    def resolve_proposals(self):
+        '''
+        Settle the proposals whose outcome was not known when they returned, once the index of
+        their first entry is applied. They were committed if the applied entry has their term,
+        since then so do all entries before it, otherwise a later leader replaced them. The
+        callbacks run on worker threads. The caller holds self.mu.
+        '''
+        pending = []
+        for first_index, term, on_resolved in self.unresolved_proposals:
+            if self.lastApplied < first_index:
+                pending.append((first_index, term, on_resolved))
+                continue
+            committed = self.logs[first_index - 1]['term'] == term
+            log_event(replication_logger, logging.INFO, "proposal resolved", first_index=first_index, term=term, committed=committed)
+            self.loop.run_in_executor(None, on_resolved, committed)
+        self.unresolved_proposals = pending
+
+    def apply_entries(self, entries):
+        '''
+        Save the orders of committed entries to the database and link them to their log entries.
+        Returns the stored order of each entry, None for the no-op entries. Runs on the disk thread.
+        '''
+        ordered = [entry for entry in entries if entry['order'] is not None]
+        if not ordered:
+            return [None] * len(entries)
+        with order_store.atomic():
+            # Store and count the orders of the batch, then link them to their entries in the same transaction
+            orders = order_store.add([(None, entry['order']['product_name'], entry['order']['quantity']) for entry in ordered])
+            order_store.link_log_entries(ordered, orders)
+        # Serve read-after-write lookups of the new orders from memory
+        order_cache.put_orders(orders)
+        merkle_tree.mark_dirty([order.order_number for order in orders])
+        stored = iter(orders)
+        return [next(stored) if entry['order'] is not None else None for entry in entries]
+
+    def persist_entries(self, entries):
+        '''
+        Save log entries to the database before they are committed, replacing any uncommitted
+        entries from the same index on. Runs on the disk thread.
+        '''
+        start_time = time.time()
+        order_store.persist_log_entries(entries)
+        self.metrics.disk_write_latency.observe(time.time() - start_time)
+
+    async def persist_local(self):
+        '''
+        Write the leader's not yet durable entries to disk while they are being replicated, and
+        count the leader towards the quorum of each entry once its write completes. Entries
+        proposed during a write are grouped into the next one.
+        '''
+        while True:
+            async with self.mu:
+                entries = self.logs[self.persistedIndex:]
+                if not entries:
+                    return
+            await self.loop.run_in_executor(self.disk, self.persist_entries, entries)
+            async with self.mu:
+                last = entries[-1]
+                # Skip entries that were replaced by another leader while being written
+                if len(self.logs) < last['index'] or self.logs[last['index'] - 1] is not last:
+                    return
+                self.persistedIndex = max(self.persistedIndex, last['index'])
+                if self.currentState == RaftConfig.LEADER:
+                    await self.advance_commit_index()
             
-    def send_append_entries(self, peer, args, reply):
+    async def send_append_entries(self, peer, args, reply):
         url = f"{peer}/append_entries/"
         data = {
             'Term': args.term,
@@ -212,111 +499,174 @@ class Raft:
             'LeaderCommit': args.leader_commit
         }
         try:
-            response = requests.post(url, json=data)
+            start_time = time.time()
+            response = await self.client.post(url, json=data)
+            rtt = self.metrics.append_entries_rtt.get(self.peer_ids.get(peer))
+            if rtt:
+                rtt.observe(time.time() - start_time)
             response_data = response.json()
             
             reply.success = response_data.get('success', False)
             reply.term = response_data.get('term', args.term)
+            reply.next_index = response_data.get('next_index')
             return response.status_code == 200
         
-        except requests.RequestException as e:
-            # print(f"Network error when sending heartbeat to {peer}: {e}")
-            pass
+        except (httpx.HTTPError, ValueError) as e:
+            log_event(rpc_logger, logging.DEBUG, "AppendEntries failed", peer=peer, error=e)
+            return False
     
-    def append_entry(self, term, command, order_data):
-        print("leader logs", self.logs)
-        print("commitIndex", self.commitIndex)
-        print("lastApplied", self.lastApplied)
-        print("nextIndex", self.nextIndex)
-        print("matchIndex", self.matchIndex)
-
-        index = len(self.logs) + 1
-        entry = {
-            'index': index,
-            'term': term,
-            'command': command,
-            'order': {
-                'product_name': order_data['name'],
-                'quantity': order_data['quantity']
-            }
-        }
-        self.logs.append(entry) # append entry to local log
+    async def append_entry(self, term, command, order_data, on_resolved=None):
+        '''
+        Propose an order as a new log entry and wait until it is committed and applied.
+        Returns whether the entry was committed and the stored order, see append_batch().
+        '''
+        ok, orders = await self.append_batch(term, [(command, order_data)], on_resolved)
+        return ok, orders[0] if ok else None
+
+    async def append_batch(self, term, proposals, on_resolved=None):
+        '''
+        Propose several orders, given as (command, order_data) pairs, as consecutive log entries
+        and wait until all of them are committed and applied. The entries are persisted and sent
+        to the peers together. Returns whether all entries were committed and the stored orders.
+        Whether they were committed is None when it is not known yet: the proposal timed out, or
+        this server stepped down, but a later leader may still commit the entries. Once this
+        server learns the outcome, `on_resolved(committed)` is called.
+        '''
+        proposal_time = time.time()
+        async with self.mu:
+            if self.currentState != RaftConfig.LEADER or self.currentTerm != term:
+                return False, None
+            entries, waiters = [], []
+            for command, order_data in proposals:
+                entry = {
+                    'index': len(self.logs) + 1,
+                    'term': term,
+                    'command': command,
+                    'order': {
+                        'product_name': order_data['name'],
+                        'quantity': order_data['quantity']
+                    }
+                }
+                self.logs.append(entry) # append entry to local log
+                waiter = self.loop.create_future()
+                self.commit_waiters[entry['index']] = waiter
+                entries.append(entry)
+                waiters.append(waiter)
+            # Write the entries to disk at the same time as they are sent to the peers
+            if self.persist_task is None or self.persist_task.done():
+                self.persist_task = self.loop.create_task(self.persist_local())
         if USE_DELAY:
-            time.sleep(5)
-
-        replies = []
-        threads = []
-        for i, peer in self.peers:
-            if i != self.me:
-                # Send append entry to all peers
-                args = AppendEntriesArgs(
-                    term=self.currentTerm,
-                    leader_id=self.me,
-                    prev_log_index=self.nextIndex[i] - 1,
-                    prev_log_term=self.logs[self.nextIndex[i] - 1]['term'],
-                    entries=self.logs[self.nextIndex[i]-1:], # Send log entries starting from nextIndex
-                    leader_commit=self.commitIndex
-                )
-                num_entries_to_send = len(args.entries)
-                reply = AppendEntriesReply()
-                thread = threading.Thread(target=self.send_append_entries, args=(peer, args, reply))
-                threads.append(thread)
-                replies.append((i, reply, num_entries_to_send))
-                thread.start()
-
-        for thread in threads:
-            thread.join() # Wait for all threads to finish
-        
+            await asyncio.sleep(5)
+        for event in self.replicate_events.values():
+            event.set()
+
         try:
-            # Check if majority of peers accept the entry and if higher term to step down as leader
-            success_count = 1
-            for id, reply, num_entries_to_send in replies:
-                if reply.term > self.currentTerm:
-                    print(f'''reply.term: {reply.term}, self.currentTerm: {self.currentTerm}''')
-                    with self.mu:
-                        self.currentTerm = reply.term
-                        self.votedFor = None
-                        self.currentState = RaftConfig.FOLLOWER
-                        self.server_state.update_term(self.currentTerm, None)
-
-                        print(f"Server {self.me} find higher term. Change to follower")
-                        self.logs.pop() # Remove the entry from the log
-                        return False, None
-                print(id, reply.success)
-                if reply.success:
-                    with self.mu:
-                        self.nextIndex[id] = self.nextIndex[id] + num_entries_to_send
-                        self.matchIndex[id] = self.nextIndex[id] - 1
-                    success_count += 1
-                else:
-                    # Decrement nextIndex on failure to find the match
-                    with self.mu:
-                        self.nextIndex[id] = max(self.nextIndex[id] - 1, 1)
-
-            if success_count > len(self.peers) / 2:
-                with self.mu:
-                    self.commitIndex = entry['index']
-                    self.lastApplied = entry['index']
-
-                with transaction.atomic():
-                    order = Order.objects.create(
-                        product_name=order_data['name'],
-                        quantity=order_data['quantity']
-                    )
-                    log_entry = LogEntry(
-                        index=entry['index'],
-                        term=entry['term'],
-                        command=entry['command'],
-                        order=order
-                    )
-                    log_entry.save()
-                print(f'''Server {self.me} append {entry} success''')
-                print(order)
-                return True, order
-            self.logs.pop()
-            return False, None
-        except Exception as e:
-            print(e)
-            print(f"Error when appending entry: {e}")
-            self.logs.pop()
-            return False, None
\ No newline at end of file
+            orders = await asyncio.wait_for(asyncio.shield(asyncio.gather(*waiters)), RaftConfig.PROPOSAL_TIMEOUT.total_seconds())
+        except asyncio.TimeoutError:
+            log_event(replication_logger, logging.WARNING, "entries not committed in time",
+                      first_index=entries[0]['index'], last_index=entries[-1]['index'], term=term)
+            orders = None
+        if orders is None or any(order is None for order in orders):
+            if on_resolved is not None:
+                async with self.mu:
+                    self.unresolved_proposals.append((entries[0]['index'], term, on_resolved))
+                    # The entries may have been applied in the meantime
+                    self.resolve_proposals()
+            return None, None
+        self.metrics.commit_latency.observe(time.time() - proposal_time)
+        log_event(replication_logger, logging.DEBUG, "entries committed",
+                  first_index=entries[0]['index'], last_index=entries[-1]['index'], term=term)
+        return True, orders
+
+    async def handle_vote(self, data):
+        '''
+        Handle a RequestVote RPC and return the reply.
+        '''
+        term = data['Term']
+        candidate_id = data['CandidateId']
+        last_log_index = data['LastLogIndex']
+        last_log_term = data['LastLogTerm']
+
+        async with self.mu:
+            log_event(election_logger, logging.DEBUG, "vote request", term=self.currentTerm, candidate=candidate_id, candidate_term=term)
+    
+            # If the candidate's term is less than the current term, reject the vote
+            if term < self.currentTerm:
+                return {'VoteGranted': False, 'Term': self.currentTerm}
+            # If the candidate's term is greater than the current term, update the current term and vote for the candidate
+            if term > self.currentTerm:
+                await self.step_down(term)
+
+            is_logs =  (last_log_index >= len(self.logs) - 1) and \
+                            (last_log_term >= self.logs[-1]['term'] if self.logs else True)
+            
+            # If the term is the same and the candidate's log is at least as up-to-date as the receiver's log, grant the vote
+            if (self.votedFor is None or self.votedFor == candidate_id) and is_logs:
+                self.votedFor = candidate_id
+                self.currentState = RaftConfig.FOLLOWER
+                self.lastHeartbeatTime = time.time()
+                await self.persist_term()
+                log_event(election_logger, logging.INFO, "vote granted", term=self.currentTerm, candidate=candidate_id)
+                return {'VoteGranted': True, 'Term': self.currentTerm}
+            else:
+                return {'VoteGranted': False, 'Term': self.currentTerm}
+
+    async def handle_append_entries(self, data):
+        '''
+        Handle an AppendEntries RPC and return the reply.
+        '''
+        term = data['Term']
+        leader_id = data['LeaderId']
+        prev_log_index = data['PrevLogIndex']
+        prev_log_term = data['PrevLogTerm']
+        entries = data.get('Entries', [])
+        leader_commit = data['LeaderCommit']
+
+        async with self.mu:
+            if term < self.currentTerm:
+                return {'success': False, 'term': self.currentTerm}
+            log_event(replication_logger, logging.DEBUG, "append entries request", leader=leader_id, term=term,
+                      prev_log_index=prev_log_index, entries=len(entries), leader_commit=leader_commit,
+                      last_log_index=len(self.logs), commit_index=self.commitIndex)
+            if term > self.currentTerm:
+                await self.step_down(term)
+            self.currentState = RaftConfig.FOLLOWER
+
+            self.lastHeartbeatTime = time.time()
+            self.leaderId = leader_id
+
+            # Check if the previous log matches, otherwise hint where the leader should back up to
+            if prev_log_index > len(self.logs):
+                return {'success': False, 'term': self.currentTerm, 'next_index': len(self.logs) + 1}
+            if prev_log_index >= 1:
+                log_term = self.logs[prev_log_index - 1]['term']
+                if log_term != prev_log_term:
+                    # Skip the whole conflicting term at once
+                    next_index = prev_log_index
+                    while next_index > 1 and self.logs[next_index - 2]['term'] == log_term:
+                        next_index -= 1
+                    return {'success': False, 'term': self.currentTerm, 'next_index': next_index}
+                
+            # Append entries to the log, only truncating it where an entry conflicts with the leader's
+            new_entries = []
+            for entry in entries:
+                if entry['index'] <= len(self.logs):
+                    if self.logs[entry['index'] - 1]['term'] == entry['term']:
+                        continue
+                    self.logs = self.logs[:entry['index'] - 1]
+                    self.persistedIndex = min(self.persistedIndex, len(self.logs))
+                self.logs.append(entry)
+                new_entries.append(entry)
+
+            # The new entries must be durable before the leader may count this server
+            if new_entries:
+                await self.loop.run_in_executor(self.disk, self.persist_entries, new_entries)
+                self.persistedIndex = len(self.logs)
+
+            # Update commitIndex and apply to state machine
+            last_new_index = prev_log_index + len(entries)
+            if leader_commit > self.commitIndex:
+                self.commitIndex = max(self.commitIndex, min(leader_commit, last_new_index))
+                await self.apply_committed()
+
+        return {'success': True, 'term': self.currentTerm}
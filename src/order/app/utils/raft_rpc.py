@@ -0,0 +1,79 @@
+import asyncio
+import json
+import logging
+from http import HTTPStatus
+from app.utils.log import log_event, rpc_logger
+
+
+class RaftRPCServer:
+    """
+    A dedicated HTTP listener for the Raft RPCs, served on the Raft event loop.
+
+    Heartbeats and votes never queue behind client orders in Django's worker threads and
+    skip the client middleware, so the cluster stays stable when the order endpoints are
+    overloaded. Connections are kept alive, as the peers reuse them for every RPC.
+    """
+
+    def __init__(self, raft):
+        self.raft = raft
+        self.server = None
+        self.routes = {
+            ('POST', '/vote/'): raft.handle_vote,
+            ('POST', '/append_entries/'): raft.handle_append_entries,
+        }
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        log_event(rpc_logger, logging.INFO, "RPC listener started", server=self.raft.me, host=host, port=port)
+        return self
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+
+                # Read the headers and the body of the request
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, reply = await self.dispatch(method, path, body)
+                payload = json.dumps(reply).encode()
+                writer.write(
+                    f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\n\r\n".encode('latin-1') + payload
+                )
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close' or version == 'HTTP/1.0':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, path, body):
+        handler = self.routes.get((method, path))
+        if handler is None:
+            return HTTPStatus.NOT_FOUND, {'error': f'{method} {path} not found'}
+        try:
+            data = json.loads(body)
+            return HTTPStatus.OK, await handler(data)
+        except json.JSONDecodeError:
+            return HTTPStatus.BAD_REQUEST, {'error': 'Invalid JSON'}
+        except Exception as e:
+            log_event(rpc_logger, logging.WARNING, "RPC handler failed", method=method, path=path, error=e)
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {'error': str(e)}
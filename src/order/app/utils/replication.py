@@ -0,0 +1,211 @@
+import bisect
+import logging
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from .constants import ORDER_SERVER_HOST, ORDER_SERVER_PORTS
+from .log import log_event, sync_logger
+from .metrics import Counter, Histogram, BATCH_SIZE_BUCKETS
+
+
+# Maximum number of orders shipped to a replica per request
+REPLICATION_BATCH_SIZE = 256
+# Maximum number of shipped orders kept in memory, replicas further behind are served from the database
+REPLICATION_BUFFER_SIZE = 100000
+# Seconds to wait before retrying a replica that failed, doubled up to the maximum
+REPLICATION_RETRY_DELAY = 0.5
+REPLICATION_MAX_RETRY_DELAY = 5
+# Seconds to wait for a replica to accept a batch
+REPLICATION_TIMEOUT = (3, 10)
+
+
+class ReplicaState:
+    """
+    Replication progress of one backup replica.
+    """
+
+    def __init__(self, id, port):
+        self.id = id
+        self.port = port
+        self.acked = None  # order number up to which the replica confirmed every order, unknown until it is asked
+        self.backfill = False  # set when a batch did not advance `acked`, the next one is read from the database
+        self.connected = False
+        self.batches = Counter()
+        self.failures = Counter()
+        self.batch_size = Histogram(BATCH_SIZE_BUCKETS)
+        self.rtt = Histogram()  # round trip time of a shipped batch
+
+    def to_dict(self, last_seq):
+        return {
+            "acked": self.acked,
+            "lag": last_seq - self.acked if self.acked is not None else None,
+            "backfill": self.backfill,
+            "connected": self.connected,
+            "batches": self.batches.to_dict(),
+            "failures": self.failures.to_dict(),
+            "batch_size": self.batch_size.to_dict(),
+            "rtt_seconds": self.rtt.to_dict(),
+        }
+
+
+class Replicator:
+    """
+    Asynchronous primary-backup replication for the order servers when Raft is not used.
+
+    The primary queues the orders it commits and replies to the client right away. One shipper
+    thread per backup sends the queued orders in batches over a persistent connection. The
+    order number is the sequence number of a record: each backup acknowledges the number up to
+    which it has stored every order, rather than its highest one, and is sent the orders after
+    it, so an order it missed is sent again and a retried batch is harmless. An order that was
+    never queued, e.g. one stored before a restart or by a sync or repair, leaves a gap the
+    backup's number stops at; once a batch does not advance it, the orders after it are read
+    from the database instead of the queue. After a failure the shipper reconnects, asks the
+    backup how far it got, and resumes from there.
+    """
+
+    def __init__(self, server_id, peers):
+        self.me = server_id
+        self.cond = threading.Condition()
+        self.seqs = []  # order numbers of the queued records, ascending
+        self.records = []  # queued records, in the same order
+        self.last_seq = 0  # highest order number committed on the primary
+        # A server without an ID is not one of the replicas and has no backups
+        self.replicas = {id: ReplicaState(id, port) for id, port in peers.items() if server_id and id != server_id}
+        self.started = False
+        self.stopped = False
+
+    def start(self):
+        '''
+        Start one shipper thread per backup, once.
+        '''
+        from .store import order_store
+        with self.cond:
+            if self.started:
+                return
+            self.started = True
+            # Orders committed before the start are shipped to the backups that miss them too.
+            # The callers of enqueue() hold orders_lock already, so it is not taken here.
+            self.last_seq = max(self.last_seq, order_store.latest())
+        for state in self.replicas.values():
+            threading.Thread(target=self.ship, args=(state,), name=f'replicator-{state.id}', daemon=True).start()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    def enqueue(self, orders):
+        '''
+        Queue committed orders for replication. Callers hold orders_lock, so the orders are
+        queued in the order of their numbers.
+        '''
+        if not self.replicas:
+            return
+        if not self.started:
+            self.start()
+        with self.cond:
+            for order in orders:
+                self.seqs.append(order.order_number)
+                self.records.append({"order_number": order.order_number, "name": order.product_name, "quantity": order.quantity})
+                self.last_seq = max(self.last_seq, order.order_number)
+            self.trim()
+            self.cond.notify_all()
+
+    def trim(self):
+        '''
+        Drop the records every backup has acknowledged, and the oldest ones beyond the buffer
+        size. The caller holds self.cond.
+        '''
+        acked = [state.acked or 0 for state in self.replicas.values()]
+        drop = bisect.bisect_right(self.seqs, min(acked)) if acked else len(self.seqs)
+        drop = max(drop, len(self.seqs) - REPLICATION_BUFFER_SIZE)
+        if drop > 0:
+            del self.seqs[:drop]
+            del self.records[:drop]
+
+    def next_batch(self, acked, backfill=False):
+        '''
+        Wait for orders numbered above `acked` and return up to a batch of them, from memory if
+        they are still queued, otherwise from the database. With `backfill` they are read from
+        the database right away, since the queue misses some of them.
+        '''
+        with self.cond:
+            if self.stopped:
+                return []
+            if not backfill:
+                if self.last_seq <= acked:
+                    self.cond.wait(timeout=1)
+                if self.last_seq <= acked or self.stopped:
+                    return []
+                if self.seqs and self.seqs[0] <= acked + 1:
+                    start = bisect.bisect_right(self.seqs, acked)
+                    return self.records[start:start + REPLICATION_BATCH_SIZE]
+
+        from ..views import iter_order_pages
+        page = next(iter_order_pages(start=acked + 1, page_size=REPLICATION_BATCH_SIZE), [])
+        return [{"order_number": number, "name": name, "quantity": quantity} for number, name, quantity in page]
+
+    def ship(self, state):
+        '''
+        Ship the queued orders to one backup until stopped.
+        '''
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        base_url = f"http://{ORDER_SERVER_HOST}:{state.port}"
+        retry_delay = REPLICATION_RETRY_DELAY
+        while not self.stopped:
+            try:
+                if state.acked is None:
+                    # (Re)connect and resume after the last order the backup has
+                    response = session.get(f"{base_url}/sync/status/", timeout=REPLICATION_TIMEOUT)
+                    response.raise_for_status()
+                    with self.cond:
+                        state.acked = response.json()["data"]["contiguous_order_number"]
+                        self.trim()
+                    state.connected = True
+                    log_event(sync_logger, logging.INFO, "replica connected", replica=state.id, acked=state.acked)
+
+                batch = self.next_batch(state.acked, state.backfill)
+                if not batch:
+                    state.backfill = False
+                    continue
+                start_time = time.time()
+                response = session.post(f"{base_url}/replicas/orders/batch/", json={"orders": batch}, timeout=REPLICATION_TIMEOUT)
+                response.raise_for_status()
+                state.rtt.observe(time.time() - start_time)
+                state.batches.inc()
+                state.batch_size.observe(len(batch))
+                acked = response.json()["data"]["acked"]
+                if acked <= state.acked:
+                    if state.backfill:
+                        # The database does not have the missing order either, do not resend it in a tight loop
+                        time.sleep(retry_delay)
+                    else:
+                        log_event(sync_logger, logging.WARNING, "replica stalled at a gap, backfilling from the database", replica=state.id, acked=state.acked)
+                state.backfill = acked <= state.acked
+                with self.cond:
+                    state.acked = max(state.acked, acked)
+                    self.trim()
+                retry_delay = REPLICATION_RETRY_DELAY
+            except Exception as e:
+                state.failures.inc()
+                if state.connected:
+                    log_event(sync_logger, logging.WARNING, "replica disconnected", replica=state.id, acked=state.acked, error=e)
+                state.connected = False
+                state.acked = None
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, REPLICATION_MAX_RETRY_DELAY)
+
+    def get_status(self):
+        with self.cond:
+            return {
+                "last_seq": self.last_seq,
+                "queued": len(self.records),
+                "replicas": {id: state.to_dict(self.last_seq) for id, state in self.replicas.items()},
+            }
+
+
+# Replicator of this order server, used while it is the primary without Raft
+replicator = Replicator(os.getenv('ORDER_SERVER_ID'), ORDER_SERVER_PORTS)
@@ -0,0 +1,429 @@
+import bisect
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from django.db import connections, transaction
+from django.db.backends.signals import connection_created
+from .aggregates import count_orders
+
+
+# An order as returned by OrderStore.add(), also usable as a (number, name, quantity) row
+StoredOrder = namedtuple("StoredOrder", ["order_number", "product_name", "quantity"])
+
+# Upper bound of the order numbers, for range reads without an end
+MAX_ORDER_NUMBER = 2 ** 63 - 1
+
+
+def log_entry_order(entry):
+    '''
+    Return the product name and quantity of the order of a Raft log entry, both None for a
+    no-op entry.
+    '''
+    if entry['order'] is None:
+        return None, None
+    return entry['order']['product_name'], entry['order']['quantity']
+
+
+class OrderStore(ABC):
+    """
+    Storage of the orders of a replica and of the counters of their products. Orders are read
+    as (number, name, quantity) rows sorted by number. Writes of one call are atomic, and
+    several calls can be grouped with `atomic()`. A backend must implement every method to be
+    instantiated.
+    """
+
+    @abstractmethod
+    def atomic(self):
+        '''
+        Context manager grouping the writes made inside it into one transaction.
+        '''
+
+    @abstractmethod
+    def get(self, order_number):
+        '''
+        Return the row of an order, or None.
+        '''
+
+    @abstractmethod
+    def get_many(self, numbers):
+        '''
+        Return the rows of the stored orders among `numbers`.
+        '''
+
+    @abstractmethod
+    def read_range(self, start, end=None, limit=None):
+        '''
+        Return up to `limit` rows of the orders numbered from start to end, both inclusive.
+        '''
+
+    @abstractmethod
+    def read_product(self, product_name, after, limit):
+        '''
+        Return up to `limit` rows of the orders of a product numbered above `after`.
+        '''
+
+    @abstractmethod
+    def latest(self):
+        '''
+        Return the highest stored order number, 0 if there are no orders.
+        '''
+
+    @abstractmethod
+    def numbers(self, start, end):
+        '''
+        Return the set of stored order numbers from start to end, both inclusive.
+        '''
+
+    @abstractmethod
+    def first_missing(self, start):
+        '''
+        Return the lowest order number from `start` on that is not stored.
+        '''
+
+    @abstractmethod
+    def add(self, rows):
+        '''
+        Store new orders given as (number, name, quantity) rows, and count them for their
+        products. Orders without a number are numbered in turn after every stored order, orders
+        whose number is stored already are skipped. Returns the stored orders as StoredOrder.
+        '''
+
+    @abstractmethod
+    def replace(self, rows):
+        '''
+        Store orders over any stored order with the same number. Product counters are not
+        changed, rebuild them afterwards.
+        '''
+
+    @abstractmethod
+    def delete(self, numbers):
+        '''
+        Delete the stored orders among `numbers`. Product counters are not changed.
+        '''
+
+    @abstractmethod
+    def persist_log_entries(self, entries):
+        '''
+        Store Raft log entries, given as dicts of the Raft log, before they are committed.
+        Uncommitted entries from the index of the first one on are replaced.
+        '''
+
+    @abstractmethod
+    def link_log_entries(self, entries, orders):
+        '''
+        Link committed Raft log entries to the orders stored for them. Entries that were not
+        persisted before are stored.
+        '''
+
+    @abstractmethod
+    def product_stats(self):
+        '''
+        Return the counters of every product as dicts, sorted by product name.
+        '''
+
+    @abstractmethod
+    def count_products(self):
+        '''
+        Count the stored orders of every product as {product name: [orders, units, last order number]}.
+        '''
+
+    @abstractmethod
+    def replace_product_stats(self, counts):
+        '''
+        Replace the counters of every product with `counts`, as returned by count_products().
+        '''
+
+
+class SQLiteOrderStore(OrderStore):
+    """
+    Orders stored with plain SQL on the raw sqlite3 connection of a Django database, bypassing
+    the ORM. Django keeps one connection per thread, so every worker thread reuses its own, and
+    sqlite3 caches the prepared statement of every query on it. Transactions are Django's, so
+    orders are committed together with the ORM writes of the same `atomic()` block, such as the
+    Raft log entries.
+    """
+
+    GET = "SELECT order_number, product_name, quantity FROM orders WHERE order_number = ?"
+    GET_MANY = "SELECT order_number, product_name, quantity FROM orders WHERE order_number IN (SELECT value FROM json_each(?)) ORDER BY order_number"
+    READ_RANGE = "SELECT order_number, product_name, quantity FROM orders WHERE order_number >= ? AND order_number <= ? ORDER BY order_number LIMIT ?"
+    READ_PRODUCT = "SELECT order_number, product_name, quantity FROM orders WHERE product_name = ? AND order_number > ? ORDER BY order_number LIMIT ?"
+    LATEST = "SELECT MAX(order_number) FROM orders"
+    NUMBERS = "SELECT order_number FROM orders WHERE order_number >= ? AND order_number <= ?"
+    # Walks the primary key from the start, up to the first order not followed by the next number
+    FIRST_MISSING = (
+        "SELECT order_number + 1 FROM orders AS o WHERE order_number >= ? "
+        "AND NOT EXISTS (SELECT 1 FROM orders WHERE order_number = o.order_number + 1) ORDER BY order_number LIMIT 1"
+    )
+    INSERT = "INSERT INTO orders (order_number, product_name, quantity) VALUES (?, ?, ?)"
+    INSERT_NEW = "INSERT INTO orders (product_name, quantity) SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(?) ORDER BY key"
+    REPLACE = "INSERT INTO orders (order_number, product_name, quantity) VALUES (?, ?, ?) ON CONFLICT (order_number) DO UPDATE SET product_name = excluded.product_name, quantity = excluded.quantity"
+    DELETE = "DELETE FROM orders WHERE order_number IN (SELECT value FROM json_each(?))"
+    ADD_STATS = (
+        "INSERT INTO product_stats (product_name, orders, units, last_order_number) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (product_name) DO UPDATE SET orders = orders + excluded.orders, units = units + excluded.units, "
+        "last_order_number = MAX(COALESCE(last_order_number, excluded.last_order_number), excluded.last_order_number)"
+    )
+    PRODUCT_STATS = "SELECT product_name, orders, units, last_order_number FROM product_stats ORDER BY product_name"
+    COUNT_PRODUCTS = "SELECT product_name, COUNT(*), SUM(quantity), MAX(order_number) FROM orders GROUP BY product_name"
+    INSERT_STATS = "INSERT INTO product_stats (product_name, orders, units, last_order_number) VALUES (?, ?, ?, ?)"
+    DELETE_UNCOMMITTED = 'DELETE FROM log_entries WHERE "index" >= ? AND order_id IS NULL'
+    INSERT_LOG_ENTRY = 'INSERT INTO log_entries ("index", term, command, product_name, quantity) VALUES (?, ?, ?, ?, ?)'
+    LINK_LOG_ENTRIES = (
+        "UPDATE log_entries SET order_id = json_extract(link.value, '$[1]') FROM json_each(?) AS link "
+        "WHERE log_entries.\"index\" = json_extract(link.value, '$[0]') AND log_entries.order_id IS NULL"
+    )
+    INSERT_LINKED_LOG_ENTRY = (
+        'INSERT INTO log_entries ("index", term, command, order_id, product_name, quantity) '
+        'SELECT ?, ?, ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM log_entries WHERE "index" = ?)'
+    )
+
+    def __init__(self, using="default"):
+        self.using = using
+
+    def connection(self):
+        wrapper = connections[self.using]
+        wrapper.ensure_connection()
+        return wrapper.connection
+
+    def atomic(self):
+        # Joins the transaction of an enclosing atomic() block, without a savepoint
+        return transaction.atomic(using=self.using, savepoint=False)
+
+    def get(self, order_number):
+        return self.connection().execute(self.GET, (order_number,)).fetchone()
+
+    def get_many(self, numbers):
+        return self.connection().execute(self.GET_MANY, (json.dumps(list(numbers)),)).fetchall()
+
+    def read_range(self, start, end=None, limit=None):
+        end = MAX_ORDER_NUMBER if end is None else end
+        # A negative LIMIT is no limit in SQLite
+        return self.connection().execute(self.READ_RANGE, (start, end, -1 if limit is None else limit)).fetchall()
+
+    def read_product(self, product_name, after, limit):
+        return self.connection().execute(self.READ_PRODUCT, (product_name, after, limit)).fetchall()
+
+    def latest(self):
+        return self.connection().execute(self.LATEST).fetchone()[0] or 0
+
+    def numbers(self, start, end):
+        return {number for number, in self.connection().execute(self.NUMBERS, (start, end))}
+
+    def first_missing(self, start):
+        if self.get(start) is None:
+            return start
+        return self.connection().execute(self.FIRST_MISSING, (start,)).fetchone()[0]
+
+    def add(self, rows):
+        numbered = [row for row in rows if row[0] is not None]
+        with self.atomic():
+            connection = self.connection()
+            stored = self.numbers(min(row[0] for row in numbered), max(row[0] for row in numbered)) if numbered else set()
+            orders = []
+            for number, name, quantity in rows:
+                if number in stored:
+                    continue
+                if number is not None:
+                    stored.add(number)
+                orders.append(StoredOrder(number, name, quantity))
+            # Orders numbered by the caller are inserted with one batched statement
+            connection.executemany(self.INSERT, [order for order in orders if order.order_number is not None])
+            new = [i for i, order in enumerate(orders) if order.order_number is None]
+            if new:
+                # The others with one statement, in which SQLite numbers them consecutively in list order
+                last = connection.execute(self.INSERT_NEW, (json.dumps([orders[i][1:] for i in new]),)).lastrowid
+                for number, i in enumerate(new, last - len(new) + 1):
+                    orders[i] = orders[i]._replace(order_number=number)
+            connection.executemany(self.ADD_STATS, [(name, *count) for name, count in count_orders(orders).items()])
+        return orders
+
+    def replace(self, rows):
+        with self.atomic():
+            self.connection().executemany(self.REPLACE, rows)
+
+    def delete(self, numbers):
+        with self.atomic():
+            self.connection().execute(self.DELETE, (json.dumps(list(numbers)),))
+
+    def persist_log_entries(self, entries):
+        with self.atomic():
+            connection = self.connection()
+            connection.execute(self.DELETE_UNCOMMITTED, (entries[0]['index'],))
+            connection.executemany(self.INSERT_LOG_ENTRY, [
+                (entry['index'], entry['term'], entry['command'], *log_entry_order(entry))
+                for entry in entries
+            ])
+
+    def link_log_entries(self, entries, orders):
+        with self.atomic():
+            connection = self.connection()
+            links = [[entry['index'], order.order_number] for entry, order in zip(entries, orders)]
+            connection.execute(self.LINK_LOG_ENTRIES, (json.dumps(links),))
+            connection.executemany(self.INSERT_LINKED_LOG_ENTRY, [
+                (entry['index'], entry['term'], entry['command'], order.order_number, order.product_name, order.quantity, entry['index'])
+                for entry, order in zip(entries, orders)
+            ])
+
+    def product_stats(self):
+        return [
+            {"name": name, "orders": orders, "units": units, "last_order_number": last}
+            for name, orders, units, last in self.connection().execute(self.PRODUCT_STATS)
+        ]
+
+    def count_products(self):
+        return {name: [orders, units, last] for name, orders, units, last in self.connection().execute(self.COUNT_PRODUCTS)}
+
+    def replace_product_stats(self, counts):
+        with self.atomic():
+            connection = self.connection()
+            connection.execute("DELETE FROM product_stats")
+            connection.executemany(self.INSERT_STATS, [(name, *count) for name, count in counts.items()])
+
+
+class MemoryOrderStore(OrderStore):
+    """
+    Orders kept in memory, for tests. `atomic()` only serializes the writes of its block, they
+    are not rolled back on errors.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.orders = {}  # order number -> (name, quantity)
+        self.sorted_numbers = []
+        self.stats = {}  # product name -> [orders, units, last order number]
+        self.log_entries = {}  # index -> [term, command, order number, name, quantity]
+        self.next_number = 1  # numbers are not reused, like SQLite's AUTOINCREMENT
+
+    def atomic(self):
+        return self.lock
+
+    def get(self, order_number):
+        with self.lock:
+            value = self.orders.get(int(order_number))
+            return (int(order_number), *value) if value is not None else None
+
+    def get_many(self, numbers):
+        with self.lock:
+            return [(number, *self.orders[number]) for number in sorted(set(numbers)) if number in self.orders]
+
+    def read_range(self, start, end=None, limit=None):
+        with self.lock:
+            i = bisect.bisect_left(self.sorted_numbers, start)
+            j = bisect.bisect_right(self.sorted_numbers, MAX_ORDER_NUMBER if end is None else end)
+            if limit is not None:
+                j = min(j, i + limit)
+            return [(number, *self.orders[number]) for number in self.sorted_numbers[i:j]]
+
+    def read_product(self, product_name, after, limit):
+        with self.lock:
+            i = bisect.bisect_right(self.sorted_numbers, after)
+            rows = ((number, *self.orders[number]) for number in self.sorted_numbers[i:])
+            return [row for row in rows if row[1] == product_name][:limit]
+
+    def latest(self):
+        with self.lock:
+            return self.sorted_numbers[-1] if self.sorted_numbers else 0
+
+    def numbers(self, start, end):
+        return {row[0] for row in self.read_range(start, end)}
+
+    def first_missing(self, start):
+        with self.lock:
+            i = bisect.bisect_left(self.sorted_numbers, start)
+            while i < len(self.sorted_numbers) and self.sorted_numbers[i] == start:
+                start += 1
+                i += 1
+            return start
+
+    def add(self, rows):
+        with self.lock:
+            def store(number, name, quantity):
+                self.orders[number] = (name, quantity)
+                bisect.insort(self.sorted_numbers, number)
+                self.next_number = max(self.next_number, number + 1)
+
+            orders = []
+            for number, name, quantity in rows:
+                if number in self.orders:
+                    continue
+                if number is not None:
+                    store(number, name, quantity)
+                orders.append(StoredOrder(number, name, quantity))
+            # Orders without a number after those numbered by the caller, as in SQLite
+            for i, order in enumerate(orders):
+                if order.order_number is None:
+                    orders[i] = order._replace(order_number=self.next_number)
+                    store(*orders[i])
+            for name, (count, units, last) in count_orders(orders).items():
+                stats = self.stats.setdefault(name, [0, 0, last])
+                stats[0] += count
+                stats[1] += units
+                stats[2] = max(stats[2], last)
+            return orders
+
+    def replace(self, rows):
+        with self.lock:
+            for number, name, quantity in rows:
+                if number not in self.orders:
+                    bisect.insort(self.sorted_numbers, number)
+                self.orders[number] = (name, quantity)
+                self.next_number = max(self.next_number, number + 1)
+
+    def delete(self, numbers):
+        with self.lock:
+            for number in numbers:
+                if self.orders.pop(number, None) is not None:
+                    del self.sorted_numbers[bisect.bisect_left(self.sorted_numbers, number)]
+
+    def persist_log_entries(self, entries):
+        with self.lock:
+            for index in [index for index, entry in self.log_entries.items() if index >= entries[0]['index'] and entry[2] is None]:
+                del self.log_entries[index]
+            for entry in entries:
+                self.log_entries[entry['index']] = [entry['term'], entry['command'], None, *log_entry_order(entry)]
+
+    def link_log_entries(self, entries, orders):
+        with self.lock:
+            for entry, order in zip(entries, orders):
+                stored = self.log_entries.setdefault(entry['index'], [entry['term'], entry['command'], None, order.product_name, order.quantity])
+                if stored[2] is None:
+                    stored[2] = order.order_number
+
+    def product_stats(self):
+        with self.lock:
+            return [
+                {"name": name, "orders": orders, "units": units, "last_order_number": last}
+                for name, (orders, units, last) in sorted(self.stats.items())
+            ]
+
+    def count_products(self):
+        with self.lock:
+            return count_orders((number, *value) for number, value in self.orders.items())
+
+    def replace_product_stats(self, counts):
+        with self.lock:
+            self.stats = {name: list(count) for name, count in counts.items()}
+
+
+def configure_connection(sender, connection, **kwargs):
+    '''
+    Tune every new SQLite connection: with write-ahead logging, readers never wait for the
+    writer. Without Raft the connections only write orders, so commits only sync the log at
+    checkpoints (NORMAL), which can lose the last commits on power loss but never corrupts the
+    database. With Raft the same connections write the log entries and the term and vote, and
+    a server counts an entry towards the quorum once its write returns, so every commit is
+    synced (FULL).
+    '''
+    if connection.vendor == "sqlite":
+        use_raft = os.environ.get("USE_RAFT") == "True"
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode = WAL")
+            cursor.execute("PRAGMA synchronous = FULL" if use_raft else "PRAGMA synchronous = NORMAL")
+
+
+connection_created.connect(configure_connection)
+
+# Orders of this replica, in its database
+order_store = SQLiteOrderStore()
@@ -1,16 +1,23 @@
 import json
+import logging
+import zlib
 import requests
-import time
 import os
-from concurrent.futures import ThreadPoolExecutor
-from django.http import HttpResponse, JsonResponse
-from django.forms.models import model_to_dict
-from django.views.decorators.http import require_GET, require_POST
-from django.db import transaction
-from .models import Order, LogEntry
+import threading
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET, require_POST, require_http_methods
 from .utils.locks import ReadWriteLock
 from .utils.leader import get_current_leader
 from .utils.raft import Raft, RaftConfig
+from .utils.log import log_event, views_logger, get_recent_events
+from .utils.cache import order_cache
+from .utils.replication import replicator
+from .utils.merkle import MERKLE_LEVELS, MERKLE_FANOUT, merkle_tree, repair_from_peer
+from .utils.aggregates import rebuild_product_stats
+from .utils.archive import order_archive
+from .utils.store import order_store
+from common.admission import AdmissionExecutor
+from common.startup import Readiness
 
 
 # Define the host and port for the catalog server
@@ -22,88 +29,396 @@ ORDER_SERVER_PORTS = {
     "2": "8003",
     "1": "8004",
 }
-order_leader_ID, order_leader_port = get_current_leader()
+# Set by the front-end through /replicas/leaders/, or looked up once the server has started
+order_leader_ID, order_leader_port = None, None
+
+# Maximum number of line items accepted by one batch order request
+MAX_BATCH_ORDERS = 100
+# Seconds the catalog server holds the stock of an order until it is committed
+RESERVATION_TTL = 30
+# Seconds between renewals of a reservation whose orders have an unknown Raft outcome
+RESERVATION_RENEW_INTERVAL = 10
+# Seconds before a failed reservation confirm is retried, doubled after every attempt up to the maximum
+CONFIRM_RETRY_DELAY = 0.5
+CONFIRM_RETRY_MAX_DELAY = 5
+# Number of orders read per query when streaming a bulk order lookup
+BULK_LOOKUP_PAGE_SIZE = 500
+# Default and maximum number of orders per page of a product history lookup
+PRODUCT_ORDERS_DEFAULT_LIMIT = 100
+PRODUCT_ORDERS_MAX_LIMIT = 1000
+# Number of orders read per query, and the default and maximum number of orders per
+# response, when streaming orders to a replica that synchronizes
+SYNC_PAGE_SIZE = 1000
+SYNC_DEFAULT_LIMIT = 100000
+SYNC_MAX_LIMIT = 1000000
 
 # Create a read-write lock for accessing order data
 orders_lock = ReadWriteLock()
 
-# Create a thread pool executor for concurrent task execution
-executor = ThreadPoolExecutor()
+# Bounds of the work queue in tasks and in seconds of waiting, beyond which requests are shed
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", "100"))
+ADMISSION_MAX_QUEUE_TIME = float(os.environ.get("ADMISSION_MAX_QUEUE_TIME", "1.0"))
+# Most requests of an endpoint served at once, so slow writes and maintenance cannot take all workers
+ENDPOINT_CONCURRENCY_LIMITS = {
+    "process_post_order_request": 16,
+    "process_post_batch_order_request": 8,
+    "process_get_orders_request": 4,
+    "process_get_sync_orders_stream_request": 4,
+    "process_post_merkle_repair_request": 1,
+    "process_post_product_stats_rebuild_request": 1,
+}
+
+# Workers of the separate pools serving reads, writes and internal traffic
+READ_POOL_WORKERS = int(os.environ.get("READ_POOL_WORKERS", "8"))
+WRITE_POOL_WORKERS = int(os.environ.get("WRITE_POOL_WORKERS", "8"))
+INTERNAL_POOL_WORKERS = int(os.environ.get("INTERNAL_POOL_WORKERS", "4"))
+
+# Create thread pool executors for concurrent task execution, with admission control. Views
+# submit order lookups and product stats to the read pool, orders to the write pool, and replication, sync, Raft and maintenance requests
+# to the internal pool, so a stall in one of them cannot take the workers of the others.
+read_executor = AdmissionExecutor(READ_POOL_WORKERS, ADMISSION_MAX_QUEUE, ADMISSION_MAX_QUEUE_TIME, ENDPOINT_CONCURRENCY_LIMITS, name="read")
+write_executor = AdmissionExecutor(WRITE_POOL_WORKERS, ADMISSION_MAX_QUEUE, ADMISSION_MAX_QUEUE_TIME, ENDPOINT_CONCURRENCY_LIMITS, name="write")
+internal_executor = AdmissionExecutor(INTERNAL_POOL_WORKERS, ADMISSION_MAX_QUEUE, ADMISSION_MAX_QUEUE_TIME, ENDPOINT_CONCURRENCY_LIMITS, name="internal")
+executors = (read_executor, write_executor, internal_executor)
+
+# Startup tasks of this order server
+readiness = Readiness()
     
 
 def process_get_order_request(order_number):
     try:
+        # Committed orders never change, so a cached order can be returned without the database
+        cached = order_cache.get(int(order_number)) if str(order_number).isdigit() else None
+        if cached is not None:
+            name, quantity = cached
+            return JsonResponse(status=200, data={"data": {"number": int(order_number), "name": name, "quantity": quantity}})
+
         # Get the order detail from the database
         with orders_lock:
-            order = Order.objects.get(order_number=order_number)
+            order = order_store.get(order_number)
+        if order is None:
+            # Old orders are moved out of the database into the archive
+            order = order_archive.get(int(order_number)) if str(order_number).isdigit() else None
+            if order is None:
+                return JsonResponse(status=404, data={"error": {"code": 404, "message": "Order not found"}})
+        number, name, quantity = order
+        order_cache.put(number, name, quantity)
         response = {
-            "number": order.order_number,
-            "name": order.product_name,
-            "quantity": order.quantity
+            "number": number,
+            "name": name,
+            "quantity": quantity
         }
         return JsonResponse(status=200, data={"data": response})
-    except Order.DoesNotExist:
-        return JsonResponse(status=404, data={"error": {"code": 404, "message": "Order not found"}})
     except Exception as e:
         return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
 
 
+def merge_archived(page, archived):
+    '''
+    Merge rows from the database and the archive, both sorted by number. An order in both is
+    taken from the database.
+    '''
+    if not archived:
+        return page
+    numbers = {row[0] for row in page}
+    return sorted(page + [row for row in archived if row[0] not in numbers])
+
+
+def iter_order_pages(numbers=None, start=None, end=None, page_size=None):
+    '''
+    Yield the orders with the given numbers, or within the inclusive range from start to end,
+    as pages of (number, name, quantity) sorted by number. Each page is read with one indexed
+    query, and orders_lock is only held while a page is read. Archived orders are included.
+    '''
+    page_size = page_size or BULK_LOOKUP_PAGE_SIZE
+    if numbers is not None:
+        numbers = sorted(set(numbers))
+        for i in range(0, len(numbers), page_size):
+            with orders_lock:
+                page = order_store.get_many(numbers[i:i + page_size])
+            found = {row[0] for row in page}
+            archived = [order_archive.get(number) for number in numbers[i:i + page_size] if number not in found and number <= order_archive.archived_upto]
+            page = merge_archived(page, [row for row in archived if row is not None])
+            if page:
+                yield page
+        return
+
+    last = (start or 1) - 1
+    while True:
+        with orders_lock:
+            page = order_store.read_range(last + 1, end, page_size)
+        if last < order_archive.archived_upto:
+            # Read the same number of archived orders up to the last order of a full page
+            bound = page[-1][0] if len(page) == page_size else end
+            archived = order_archive.read_range(last + 1, bound if bound is not None else order_archive.archived_upto, page_size)
+            page = merge_archived(page, archived)[:page_size]
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        last = page[-1][0]
+
+
+def process_get_orders_request(numbers=None, start=None, end=None):
+    def stream_orders():
+        # Write the JSON reply page by page, so it never has to be built in memory as a whole
+        yield '{"data": {"orders": ['
+        separator = ''
+        for page in iter_order_pages(numbers, start, end):
+            yield separator + ', '.join(json.dumps({"number": number, "name": name, "quantity": quantity}) for number, name, quantity in page)
+            separator = ', '
+        yield ']}}'
+
+    return StreamingHttpResponse(stream_orders(), status=200, content_type='application/json')
+
+
+def process_get_product_orders_request(product_name, after, limit):
+    '''
+    Return a page of the orders of a product numbered above the cursor `after`, read from the
+    (product_name, order_number) index, and the cursor of the next page if there is one.
+    '''
+    with orders_lock:
+        page = order_store.read_product(product_name, after, limit + 1)
+    orders = [{"number": number, "name": name, "quantity": quantity} for number, name, quantity in page[:limit]]
+    next_cursor = orders[-1]["number"] if len(page) > limit else None
+    return JsonResponse(status=200, data={"data": {"orders": orders, "next_cursor": next_cursor}})
+
+
+def reserve_stock(items):
+    '''
+    Reserve the stock of line items on the catalog server, all of them or none. Returns the
+    reservation ID, or an error response if the stock cannot be reserved.
+    '''
+    response = requests.post(f"http://{CATALOG_SERVER_HOST}:{CATALOG_SERVER_PORT}/reservations/", json={"orders": items, "ttl": RESERVATION_TTL})
+    if response.status_code == 200:
+        return response.json()["data"]["reservation_id"], None
+    if response.status_code in (400, 404):
+        # Unknown product or not enough stock
+        return None, JsonResponse(status=response.status_code, data=response.json())
+    return None, JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+
+def post_reservation_action(reservation_id, action, data=None):
+    '''
+    Confirm, renew or release a reservation on the catalog server. Returns the status code, or
+    None if the catalog server could not be reached.
+    '''
+    try:
+        response = requests.post(f"http://{CATALOG_SERVER_HOST}:{CATALOG_SERVER_PORT}/reservations/{reservation_id}/{action}/", json=data)
+    except requests.RequestException as e:
+        log_event(views_logger, logging.ERROR, f"failed to {action} stock reservation", reservation=reservation_id, error=e)
+        return None
+    if response.status_code != 200:
+        log_event(views_logger, logging.ERROR, f"failed to {action} stock reservation", reservation=reservation_id, status=response.status_code)
+    return response.status_code
+
+
+def retry_confirm_reservation(reservation_id, delay):
+    '''
+    Confirm a reservation after `delay` seconds on a timer thread, and again with a doubled delay
+    until the catalog server accepts it or no longer knows the reservation.
+    '''
+    def confirm():
+        status = post_reservation_action(reservation_id, "confirm")
+        if status == 200:
+            log_event(views_logger, logging.INFO, "stock reservation confirmed after retrying", reservation=reservation_id)
+        elif status == 404:
+            # Expired already, its stock is on sale again
+            log_event(views_logger, logging.ERROR, "stock reservation expired before it was confirmed", reservation=reservation_id)
+        else:
+            retry_confirm_reservation(reservation_id, min(delay * 2, CONFIRM_RETRY_MAX_DELAY))
+
+    timer = threading.Timer(delay, confirm)
+    timer.daemon = True
+    timer.start()
+
+
+def hold_reservation(reservation_id, resolved):
+    '''
+    Renew a reservation every RESERVATION_RENEW_INTERVAL seconds on a timer thread until
+    `resolved` is set, so its stock is not given back while a later Raft leader may still
+    commit its orders.
+    '''
+    def renew():
+        if resolved.is_set():
+            return
+        status = post_reservation_action(reservation_id, "renew", {"ttl": RESERVATION_TTL})
+        if status == 404:
+            log_event(views_logger, logging.ERROR, "stock reservation expired before its orders were resolved", reservation=reservation_id)
+            return
+        hold_reservation(reservation_id, resolved)
+
+    timer = threading.Timer(RESERVATION_RENEW_INTERVAL, renew)
+    timer.daemon = True
+    timer.start()
+
+
+def resolve_held_reservation(reservation_id, resolved, committed):
+    '''
+    Stop renewing a held reservation and finish it, once the outcome of its orders is known.
+    '''
+    resolved.set()
+    finish_reservation(reservation_id, committed)
+
+
+def finish_reservation(reservation_id, confirm):
+    '''
+    Confirm the reservation of committed orders, or release the reservation of orders that
+    were not placed, so its stock is available again. A failed confirm is retried in the
+    background, otherwise the reservation would expire and its stock be sold twice. A
+    reservation that could not be released expires on the catalog server.
+    '''
+    status = post_reservation_action(reservation_id, "confirm" if confirm else "release")
+    if confirm and status not in (200, 404):
+        retry_confirm_reservation(reservation_id, CONFIRM_RETRY_DELAY)
+
+
 def process_post_order_request(order_data):
-    # Ask for the product detail from the catalog server
-    product_response = requests.get(f"http://{CATALOG_SERVER_HOST}:{CATALOG_SERVER_PORT}/products/{order_data['name']}/")
-    if product_response.status_code == 200:
-        # Check whether the stock quantity is adequate
-        if order_data["quantity"] > product_response.json()["data"]["quantity"]:
-            return JsonResponse(status=400, data={"error": {"code": 400, "message": "No sufficient stock"}})
-    if product_response.status_code == 404:
-        return JsonResponse(status = 404, data = {"error": {"code": 404, "message": "Product not found"}})
-    
     USE_RAFT = True if os.environ.get("USE_RAFT") == "True" else False
+    if USE_RAFT:
+        from order.raft_node import raft_instance
+        if raft_instance.currentState != RaftConfig.LEADER:
+            return JsonResponse(status=503, data={"error": {"code": 503, "message": "Not Leader can't accept request"}})
+
+    elif readiness.is_pending("sync"):
+        return JsonResponse(status=503, data={"error": {"code": 503, "message": "Catching up with the other replicas"}})
+
+    # Hold the stock of the order on the catalog server until the order is committed
+    reservation_id, error_response = reserve_stock([{"name": order_data["name"], "quantity": order_data["quantity"]}])
+    if error_response is not None:
+        return error_response
+
     if not USE_RAFT:
-        # Send the order request to the catalog server
-        order_response = requests.post(f"http://{CATALOG_SERVER_HOST}:{CATALOG_SERVER_PORT}/orders/", json=order_data)
-        if order_response.status_code == 200:
-            # Create the order log
+        try:
+            # Create the order log and count it for its product
             with orders_lock:
-                order = Order.objects.create(
-                    product_name=order_data["name"],
-                    quantity=order_data["quantity"]
-                )
-
-            # Send order data to other replicas for synchronizing order log
-            for id, port in ORDER_SERVER_PORTS.items():
-                if id is not order_leader_ID:
-                    try:
-                        replica_order_response = requests.post(f"http://{ORDER_SERVER_HOST}:{port}/replicas/orders/", json=order_data)
-                    except Exception as e:
-                        pass
-            return JsonResponse(status=200, data={"data": model_to_dict(order, exclude=['product_name', 'quantity'])})
-        else:
+                order, = order_store.add([(None, order_data["name"], order_data["quantity"])])
+                # Queue the order for the replicas, they are sent it in the background
+                replicator.enqueue([order])
+        except Exception as e:
+            finish_reservation(reservation_id, confirm=False)
             return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+        finish_reservation(reservation_id, confirm=True)
+        order_cache.put(order.order_number, order.product_name, order.quantity)
+        merkle_tree.mark_dirty([order.order_number])
+        return JsonResponse(status=200, data={"data": {"order_number": order.order_number}})
     else:
         '''
         If raft is enabled, do the following steps:
         1. Check if the current server is the leader, only leader can accept the request.
-        2. Use order_data to create order object, but don't save it to the database at this point.
-        3. Append order object, term and command to the log.
-        4. Send append_entries RPC to all other servers.
-        5. Check success replies is majority or not.
-        6. If majority, save order, log object to the database (committed), and send success response to the client.
-        7. If not majority, send error response to the client.
-        8. Update commitIndex and lastApplied, and send append_entries RPC to all other servers.
+        2. Reserve the stock of the order on the catalog server.
+        3. Use order_data to create order object, but don't save it to the database at this point.
+        4. Append order object, term and command to the log.
+        5. Send append_entries RPC to all other servers.
+        6. Check success replies is majority or not.
+        7. If majority, save order, log object to the database (committed), confirm the reservation, and send success response to the client.
+        8. If not majority, send error response to the client. The reservation is released if the entry was never appended, otherwise it is
+           renewed until the server knows whether the entry was committed, and then confirmed or released.
+        9. Update commitIndex and lastApplied, and send append_entries RPC to all other servers.
         '''
-        
-        from order.wsgi import raft_instance
+        term = raft_instance.currentTerm
+        resolved = threading.Event()
+        # Propose the order on the Raft event loop and wait until it is committed. If the outcome
+        # is not known yet, the reservation is held and finished once it is, it must not be released before
+        ok, order = raft_instance.run(raft_instance.append_entry(term, f'''Buy {order_data["quantity"]} {order_data["name"]}''', order_data,
+                                                                 on_resolved=lambda committed: resolve_held_reservation(reservation_id, resolved, committed)))
+        if ok is None:
+            hold_reservation(reservation_id, resolved)
+        else:
+            finish_reservation(reservation_id, confirm=ok)
+        if ok:
+            return JsonResponse(status=200, data={"data": {"order_number": order.order_number}})
+        else:
+            return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+def validate_batch_order(batch_data):
+    '''
+    Check the line items of a batch order. Returns an error response, or None if they are
+    valid. Their stock is checked when it is reserved.
+    '''
+    items = batch_data.get("orders") if isinstance(batch_data, dict) else None
+    if not items or not isinstance(items, list):
+        return JsonResponse(status=400, data={"error": {"code": 400, "message": "No orders in the batch"}})
+    if len(items) > MAX_BATCH_ORDERS:
+        return JsonResponse(status=400, data={"error": {"code": 400, "message": f"At most {MAX_BATCH_ORDERS} orders per batch"}})
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get("name"), str) or not isinstance(item.get("quantity"), int) or item["quantity"] <= 0:
+            return JsonResponse(status=400, data={"error": {"code": 400, "message": "Invalid order in the batch"}})
+    return None
+
+
+def process_post_batch_order_request(batch_data):
+    error_response = validate_batch_order(batch_data)
+    if error_response is not None:
+        return error_response
+    items = [{"name": item["name"], "quantity": item["quantity"]} for item in batch_data["orders"]]
+
+    USE_RAFT = True if os.environ.get("USE_RAFT") == "True" else False
+    if USE_RAFT:
+        from order.raft_node import raft_instance
         if raft_instance.currentState != RaftConfig.LEADER:
             return JsonResponse(status=503, data={"error": {"code": 503, "message": "Not Leader can't accept request"}})
-        
+
+    elif readiness.is_pending("sync"):
+        return JsonResponse(status=503, data={"error": {"code": 503, "message": "Catching up with the other replicas"}})
+
+    # Reserve the stock of all items with a single catalog request, either all of them or none
+    reservation_id, error_response = reserve_stock(items)
+    if error_response is not None:
+        return error_response
+
+    if not USE_RAFT:
+        try:
+            # Create the order logs in one transaction
+            with orders_lock:
+                orders = order_store.add([(None, item["name"], item["quantity"]) for item in items])
+                # Queue the orders for the replicas, they are sent them in the background
+                replicator.enqueue(orders)
+        except Exception as e:
+            finish_reservation(reservation_id, confirm=False)
+            return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+        finish_reservation(reservation_id, confirm=True)
+        order_cache.put_orders(orders)
+        merkle_tree.mark_dirty([order.order_number for order in orders])
+    else:
         term = raft_instance.currentTerm
-        ok, order = raft_instance.append_entry(term, f'''Buy {order_data["quantity"]} {order_data["name"]}''', order_data)
-        print('ok', ok, order, model_to_dict(order))
-        if ok:
-            return JsonResponse(status=200, data={"data": model_to_dict(order, exclude=['product_name', 'quantity'])})
+        # Propose all orders as consecutive log entries, replicated and committed together
+        proposals = [(f'''Buy {item["quantity"]} {item["name"]}''', item) for item in items]
+        resolved = threading.Event()
+        ok, orders = raft_instance.run(raft_instance.append_batch(term, proposals, on_resolved=lambda committed: resolve_held_reservation(reservation_id, resolved, committed)))
+        if ok is None:
+            hold_reservation(reservation_id, resolved)
         else:
+            finish_reservation(reservation_id, confirm=ok)
+        if not ok:
             return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+    return JsonResponse(status=200, data={"data": {"order_numbers": [order.order_number for order in orders]}})
+
+
+def discover_leader():
+    '''
+    Ask the front-end for the leader, unless it has told this server already.
+    '''
+    global order_leader_ID, order_leader_port
+    leader_ID, leader_port = get_current_leader()
+    if order_leader_ID is None:
+        order_leader_ID, order_leader_port = leader_ID, leader_port
+
+
+def process_get_ready_request():
+    checks = readiness.to_dict()
+    USE_RAFT = True if os.environ.get("USE_RAFT") == "True" else False
+    if USE_RAFT:
+        from order.raft_node import raft_instance
+        checks["raft"] = {
+            "ready": raft_instance is not None and raft_instance.loaded.is_set(),
+            "error": None if raft_instance is not None else "ORDER_SERVER_ID is not set",
+            "seconds": raft_instance.load_seconds if raft_instance is not None else None,
+        }
+    ready = all(check["ready"] for check in checks.values())
+    return JsonResponse(status=200 if ready else 503, data={"data": {"ready": ready, "checks": checks}})
+
 
 def process_post_replicas_leader_request(leader_data):
     global order_leader_ID, order_leader_port
@@ -118,33 +433,184 @@ def process_post_replicas_leader_request(leader_data):
 
 def process_post_replicas_order_request(order_data):
     try:
-        # Create the order log
+        # Create the order log and count it for its product
         with orders_lock:
-            order = Order.objects.create(
-                product_name=order_data["name"],
-                quantity=order_data["quantity"]
-            )
+            order, = order_store.add([(None, order_data["name"], order_data["quantity"])])
+        order_cache.put(order.order_number, order.product_name, order.quantity)
+        merkle_tree.mark_dirty([order.order_number])
         return HttpResponse(status=204)
     except Exception as e:
         return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
-    
+
+def process_post_replicas_batch_order_request(batch_data):
+    try:
+        # Store the orders shipped by the primary under the primary's order numbers, in one
+        # transaction. Orders already stored are skipped, so a batch can safely be sent again.
+        rows = [(item["order_number"], item["name"], item["quantity"]) for item in batch_data["orders"]]
+        with orders_lock:
+            # Only the orders not stored yet are stored and counted for their products
+            order_store.add(rows)
+            # The batch holds every order of the primary up to its last one, so this replica has
+            # them all up to there, and up to the next gap after it
+            acked = order_store.first_missing(max(row[0] for row in rows) + 1) - 1
+        merkle_tree.mark_dirty([row[0] for row in rows])
+        return JsonResponse(status=200, data={"data": {"acked": acked}})
+    except Exception as e:
+        return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+def process_get_merkle_node_request(level, index):
+    if not 0 <= level <= MERKLE_LEVELS or not 0 <= index < MERKLE_FANOUT ** (MERKLE_LEVELS - level):
+        return JsonResponse(status=400, data={"error": {"code": 400, "message": "No such node in the Merkle tree"}})
+    return JsonResponse(status=200, data={"data": merkle_tree.get_node(level, index)})
+
+
+def process_post_merkle_repair_request(repair_data):
+    USE_RAFT = True if os.environ.get("USE_RAFT") == "True" else False
+    if USE_RAFT:
+        # With Raft the orders are only changed through the log, never repaired in place
+        return JsonResponse(status=409, data={"error": {"code": 409, "message": "Repair is not available with Raft"}})
+    peer_id = str(repair_data.get("peer"))
+    if peer_id not in ORDER_SERVER_PORTS:
+        return JsonResponse(status=400, data={"error": {"code": 400, "message": "Unknown peer"}})
+    try:
+        result = repair_from_peer(merkle_tree, peer_id)
+    except requests.RequestException as e:
+        return JsonResponse(status=502, data={"error": {"code": 502, "message": f"Peer {peer_id} unreachable"}})
+    return JsonResponse(status=200, data={"data": result})
+
+
+def process_get_replication_status_request():
+    return JsonResponse(status=200, data={"data": replicator.get_status()})
+
+
+def process_get_raft_status_request():
+    from order.raft_node import raft_instance
+    if raft_instance is None:
+        return JsonResponse(status=404, data={"error": {"code": 404, "message": "Raft is not enabled"}})
+    return JsonResponse(status=200, data={"data": raft_instance.get_status()})
+
+
+def process_get_cache_stats_request():
+    return JsonResponse(status=200, data={"data": order_cache.to_dict()})
+
+
+def process_get_archive_stats_request():
+    return JsonResponse(status=200, data={"data": order_archive.to_dict()})
+
+
+def process_get_product_stats_request():
+    # One row per product, maintained as orders are stored, instead of a scan of the orders
+    products = order_store.product_stats()
+    return JsonResponse(status=200, data={"data": {"products": products}})
+
+
+def process_post_product_stats_rebuild_request():
+    USE_RAFT = True if os.environ.get("USE_RAFT") == "True" else False
+    if USE_RAFT:
+        # Rebuild on the disk thread, so no committed entries are applied meanwhile
+        from order.raft_node import raft_instance
+        products = raft_instance.disk.submit(rebuild_product_stats).result()
+    else:
+        with orders_lock:
+            products = rebuild_product_stats()
+    return JsonResponse(status=200, data={"data": {"products": products}})
+
+
+def process_get_raft_events_request(limit, subsystem, level):
+    try:
+        events = get_recent_events(limit=limit, subsystem=subsystem, level=level)
+    except ValueError as e:
+        return JsonResponse(status=400, data={"error": {"code": 400, "message": str(e)}})
+    return JsonResponse(status=200, data={"data": {"events": events}})
+
+
 def process_get_sync_orders_request(next_order_number):
     try:
         # Query for all orders from next_id to the latest
         with orders_lock:
-            orders = Order.objects.filter(order_number__gte=next_order_number).values()
-
-        return JsonResponse(status=200, data={"data": {"orders": list(orders)}})
+            rows = order_store.read_range(next_order_number)
+        orders = [{"order_number": number, "product_name": name, "quantity": quantity} for number, name, quantity in rows]
+        return JsonResponse(status=200, data={"data": {"orders": orders}})
     except Exception as e:
         return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
 
 
+def process_get_sync_status_request():
+    # Latest order number of this replica, used by a synchronizing replica to pick its peers, and
+    # the number up to which it has every order, from which the primary resumes replicating to it
+    with orders_lock:
+        latest_order_number = order_store.latest()
+        contiguous_order_number = order_store.first_missing(order_archive.archived_upto + 1) - 1
+    return JsonResponse(status=200, data={"data": {"latest_order_number": latest_order_number, "contiguous_order_number": contiguous_order_number}})
+
+
+def process_get_sync_orders_stream_request(after, limit, compress, end=None):
+    '''
+    Stream the orders numbered above the cursor `after`, and up to `end` if given, as NDJSON,
+    one order per line, at most `limit` of them. The last line holds the cursor to resume from and whether more orders
+    are left. Orders are read and sent page by page, so memory does not grow with the backlog.
+    '''
+    def stream_orders():
+        sent, cursor = 0, after
+        for page in iter_order_pages(start=after + 1, end=end, page_size=min(SYNC_PAGE_SIZE, limit)):
+            page = page[:limit - sent]
+            sent += len(page)
+            cursor = page[-1][0]
+            yield ''.join(
+                json.dumps({"order_number": number, "product_name": name, "quantity": quantity}) + '\n'
+                for number, name, quantity in page
+            ).encode()
+            if sent >= limit:
+                break
+        more = sent >= limit and bool(order_store.read_range(cursor + 1, end, 1) or order_archive.read_range(cursor + 1, end or order_archive.archived_upto, 1))
+        yield (json.dumps({"cursor": cursor, "more": more}) + '\n').encode()
+
+    def compress_orders(chunks):
+        # Flush the gzip stream after every page, so the replica can apply it right away
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+    chunks = stream_orders()
+    response = StreamingHttpResponse(compress_orders(chunks) if compress else chunks, status=200, content_type='application/x-ndjson')
+    if compress:
+        response['Content-Encoding'] = 'gzip'
+    return response
+
+
 @require_GET
 def get_order(request, order_number):
-    print(order_leader_ID, order_leader_port)
     try:
         # Submit a task to the thread pool executor
-        future = executor.submit(process_get_order_request, order_number)
+        future = read_executor.submit(process_get_order_request, order_number)
+        # Wait for the result of execution
+        response = future.result()
+        return response
+    except Exception as e:
+        return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+
+@require_GET
+def get_orders(request):
+    if 'product' in request.GET:
+        return get_product_orders(request)
+    # Look up either a list of orders, ?numbers=1,2,3, or a range of orders, ?from=1&to=100
+    try:
+        if 'numbers' in request.GET:
+            numbers = [int(number) for number in request.GET['numbers'].split(',') if number]
+            start, end = None, None
+        elif 'from' in request.GET or 'to' in request.GET:
+            numbers = None
+            start = int(request.GET['from']) if request.GET.get('from') else None
+            end = int(request.GET['to']) if request.GET.get('to') else None
+        else:
+            return JsonResponse(status=400, data={"error": {"code": 400, "message": "Either numbers or from/to is required"}})
+    except ValueError:
+        return JsonResponse(status=400, data={"error": {"code": 400, "message": "Order numbers must be integers"}})
+    try:
+        # Submit a task to the thread pool executor
+        future = read_executor.submit(process_get_orders_request, numbers, start, end)
         # Wait for the result of execution
         response = future.result()
         return response
@@ -152,14 +618,53 @@ def get_order(request, order_number):
         return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
 
 
+@require_GET
+def get_product_orders(request):
+    # Page through the orders of a product, ?product=Tux&after=<next_cursor>&limit=100
+    try:
+        after = int(request.GET.get('after', 0))
+        limit = min(int(request.GET.get('limit', PRODUCT_ORDERS_DEFAULT_LIMIT)), PRODUCT_ORDERS_MAX_LIMIT)
+    except ValueError:
+        return JsonResponse(status=400, data={"error": {"code": 400, "message": "after and limit must be integers"}})
+    if limit <= 0:
+        return JsonResponse(status=400, data={"error": {"code": 400, "message": "limit must be positive"}})
+    try:
+        future = read_executor.submit(process_get_product_orders_request, request.GET['product'], after, limit)
+        response = future.result()
+        return response
+    except Exception as e:
+        return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+
+@require_http_methods(["GET", "POST"])
+def orders(request):
+    # GET looks up orders in bulk, POST places a new order
+    if request.method == 'GET':
+        return get_orders(request)
+    return post_order(request)
+
+
 @require_POST
 def post_order(request):
     try:
         # Extract data from the request
         order_data = json.loads(request.body)
-        print(order_data)
         # Submit a task to the thread pool executor
-        future = executor.submit(process_post_order_request, order_data)
+        future = write_executor.submit(process_post_order_request, order_data)
+        # Wait for the result of execution
+        response = future.result()
+        return response
+    except Exception as e:
+        return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+
+@require_POST
+def post_batch_order(request):
+    try:
+        # Extract data from the request
+        batch_data = json.loads(request.body)
+        # Submit a task to the thread pool executor
+        future = write_executor.submit(process_post_batch_order_request, batch_data)
         # Wait for the result of execution
         response = future.result()
         return response
@@ -173,7 +678,7 @@ def post_replicas_leader(request):
         # Extract data from the request
         leader_data = json.loads(request.body)
         # Submit a task to the thread pool executor
-        future = executor.submit(process_post_replicas_leader_request, leader_data)
+        future = internal_executor.submit(process_post_replicas_leader_request, leader_data)
         # Wait for the result of execution
         response = future.result()
         return response
@@ -187,18 +692,161 @@ def post_replicas_order(request):
         # Extract data from the request
         order_data = json.loads(request.body)
         # Submit a task to the thread pool executor
-        future = executor.submit(process_post_replicas_order_request, order_data)
+        future = internal_executor.submit(process_post_replicas_order_request, order_data)
         # Wait for the result of execution
         response = future.result()
         return response
     except Exception as e:
         return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
 
+@require_POST
+def post_replicas_batch_order(request):
+    try:
+        # Extract data from the request
+        batch_data = json.loads(request.body)
+        # Submit a task to the thread pool executor
+        future = internal_executor.submit(process_post_replicas_batch_order_request, batch_data)
+        # Wait for the result of execution
+        response = future.result()
+        return response
+    except Exception as e:
+        return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+@require_GET
+def get_merkle_node(request):
+    # The root by default, or the node given by ?level=&index=
+    try:
+        level = int(request.GET.get('level', MERKLE_LEVELS))
+        index = int(request.GET.get('index', 0))
+    except ValueError:
+        return JsonResponse(status=400, data={"error": {"code": 400, "message": "level and index must be integers"}})
+    try:
+        future = internal_executor.submit(process_get_merkle_node_request, level, index)
+        response = future.result()
+        return response
+    except Exception as e:
+        return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+
+@require_POST
+def post_merkle_repair(request):
+    try:
+        repair_data = json.loads(request.body)
+        future = internal_executor.submit(process_post_merkle_repair_request, repair_data)
+        response = future.result()
+        return response
+    except Exception as e:
+        return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+
+@require_GET
+def get_replication_status(request):
+    try:
+        future = internal_executor.submit(process_get_replication_status_request)
+        response = future.result()
+        return response
+    except Exception as e:
+        return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+
+@require_GET
+def get_sync_status(request):
+    try:
+        future = internal_executor.submit(process_get_sync_status_request)
+        response = future.result()
+        return response
+    except Exception as e:
+        return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+
+@require_GET
+def get_sync_orders_stream(request):
+    # Resume after the cursor, the last order number the replica already has
+    try:
+        after = int(request.GET.get('after', 0))
+        end = int(request.GET['to']) if request.GET.get('to') else None
+        limit = min(int(request.GET.get('limit', SYNC_DEFAULT_LIMIT)), SYNC_MAX_LIMIT)
+    except ValueError:
+        return JsonResponse(status=400, data={"error": {"code": 400, "message": "after, to and limit must be integers"}})
+    if after < 0 or limit <= 0:
+        return JsonResponse(status=400, data={"error": {"code": 400, "message": "after must not be negative and limit must be positive"}})
+    compress = 'gzip' in request.headers.get('Accept-Encoding', '')
+    try:
+        future = internal_executor.submit(process_get_sync_orders_stream_request, after, limit, compress, end)
+        response = future.result()
+        return response
+    except Exception as e:
+        return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+
 @require_GET
 def get_sync_orders(request, next_order_number):
-    print(order_leader_ID)
     try:
-        future = executor.submit(process_get_sync_orders_request, next_order_number)
+        future = internal_executor.submit(process_get_sync_orders_request, next_order_number)
+        response = future.result()
+        return response
+    except Exception as e:
+        return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+
+@require_GET
+def get_raft_status(request):
+    try:
+        future = internal_executor.submit(process_get_raft_status_request)
+        response = future.result()
+        return response
+    except Exception as e:
+        return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+
+@require_GET
+def get_cache_stats(request):
+    try:
+        future = internal_executor.submit(process_get_cache_stats_request)
+        response = future.result()
+        return response
+    except Exception as e:
+        return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+
+@require_GET
+def get_archive_stats(request):
+    try:
+        future = internal_executor.submit(process_get_archive_stats_request)
+        response = future.result()
+        return response
+    except Exception as e:
+        return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+
+@require_GET
+def get_product_stats(request):
+    try:
+        future = read_executor.submit(process_get_product_stats_request)
+        response = future.result()
+        return response
+    except Exception as e:
+        return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+
+@require_POST
+def post_product_stats_rebuild(request):
+    try:
+        future = internal_executor.submit(process_post_product_stats_rebuild_request)
+        response = future.result()
+        return response
+    except Exception as e:
+        return JsonResponse(status=500, data={"error": {"code": 500, "message": "Internal server error"}})
+
+
+@require_GET
+def get_raft_events(request):
+    try:
+        limit = int(request.GET.get('limit', 100))
+    except ValueError:
+        return JsonResponse(status=400, data={"error": {"code": 400, "message": "limit must be an integer"}})
+    try:
+        future = internal_executor.submit(process_get_raft_events_request, limit, request.GET.get('subsystem'), request.GET.get('level'))
         response = future.result()
         return response
     except Exception as e:
@@ -207,134 +855,47 @@ def get_sync_orders(request, next_order_number):
 
 # Raft endpoints
 @require_POST
-def handle_vote(request):
-    from order.wsgi import raft_instance
+async def handle_vote(request):
+    from order.raft_node import raft_instance
+    if not raft_instance.loaded.is_set():
+        # The persistent state is still loading, answering now could break the Raft guarantees
+        return JsonResponse({'error': 'Raft server is starting'}, status=503)
     try:
         data = json.loads(request.body)
-        term = data['Term']
-        candidate_id = data['CandidateId']
-        last_log_index = data['LastLogIndex']
-        last_log_term = data['LastLogTerm']
-
-        with raft_instance.mu:
-            print(f"Receive vote request, my server term {raft_instance.currentTerm}, candidate_id {candidate_id} args term {term}")
-    
-            # If the candidate's term is less than the current term, reject the vote
-            if term < raft_instance.currentTerm:
-                return JsonResponse({'VoteGranted': False, 'Term': raft_instance.currentTerm})
-            # If the candidate's term is greater than the current term, update the current term and vote for the candidate
-            if term > raft_instance.currentTerm:
-                raft_instance.currentTerm = term
-                raft_instance.votedFor = None
-                raft_instance.currentState = RaftConfig.FOLLOWER
-                raft_instance.server_state.update_term(term, None)
-
-            print(f'''last_log_index: {last_log_index}, len(raft_instance.logs) - 1): {len(raft_instance.logs) - 1}''')
-            print(f'''last_log_term: {last_log_term}, raft_instance.logs {raft_instance.logs}''')
-
-            is_logs =  (last_log_index >= len(raft_instance.logs) - 1) and \
-                            (last_log_term >= raft_instance.logs[-1]['term'] if raft_instance.logs else True)
-            print(f'''is_logs: {is_logs}''')
-            
-            # If the term is the same and the candidate's log is at least as up-to-date as the receiver's log, grant the vote
-            if (raft_instance.votedFor is None or raft_instance.votedFor == candidate_id) and is_logs:
-                raft_instance.votedFor = candidate_id
-                raft_instance.currentTerm = term
-                raft_instance.server_state.update_term(term, candidate_id)
-                raft_instance.currentState = RaftConfig.FOLLOWER
-                raft_instance.lastHeartbeatTime = time.time()
-                print(f'''raft_instance.votedFor: {raft_instance.votedFor}, candidate_id: {candidate_id}, raft_instance.me: {raft_instance.me}''')
-                return JsonResponse({'VoteGranted': True, 'Term': raft_instance.currentTerm})
-            else:
-                return JsonResponse({'VoteGranted': False, 'Term': raft_instance.currentTerm})
+        # Handle the RPC on the Raft event loop
+        reply = await raft_instance.call(raft_instance.handle_vote(data))
+        return JsonResponse(reply)
     except json.JSONDecodeError:
         return JsonResponse({'error': 'Invalid JSON'}, status=400)
     except Exception as e:
-        print(e)
+        log_event(views_logger, logging.WARNING, "vote handler failed", error=e)
         return JsonResponse({'error': str(e)}, status=500)
 
 @require_POST
-def handle_append_entries(request):
-    from order.wsgi import raft_instance
+async def handle_append_entries(request):
+    from order.raft_node import raft_instance
+    if not raft_instance.loaded.is_set():
+        # The persistent state is still loading, answering now could break the Raft guarantees
+        return JsonResponse({'error': 'Raft server is starting'}, status=503)
     try:
         data = json.loads(request.body)
-        term = data['Term']
-        leader_id = data['LeaderId']
-        prev_log_index = data['PrevLogIndex']
-        prev_log_term = data['PrevLogTerm']
-        entries = data.get('Entries', [])
-        leader_commit = data['LeaderCommit']
-
-        with raft_instance.mu:
-            if term < raft_instance.currentTerm:
-                return JsonResponse({'success': False, 'term': raft_instance.currentTerm})
-            print("data", data)
-            print("raft_instance.logs", raft_instance.logs)
-            print("raft_instance.commitIndex", raft_instance.commitIndex)
-            if term > raft_instance.currentTerm:
-                raft_instance.currentTerm = term
-                raft_instance.votedFor = None # new term so no vote yet
-                raft_instance.currentState = RaftConfig.FOLLOWER
-                raft_instance.server_state.update_term(term, None)
-                print(f"Updated term to {term} and switched to follower due to higher term received.")
-
-            raft_instance.lastHeartbeatTime = time.time()
-            raft_instance.leaderId = leader_id
-
-            # Check if the previous log matches
-            if prev_log_index >= 1 and len(raft_instance.logs) >= prev_log_index:
-                log_term = raft_instance.logs[prev_log_index - 1]['term']
-                if log_term != prev_log_term:
-                    return JsonResponse({'success': False, 'term': raft_instance.currentTerm})
-                
-            print("prev_log_index", prev_log_index)
-            # Append entries to the log
-            if entries:
-                raft_instance.logs = raft_instance.logs[:prev_log_index]
-                raft_instance.logs.extend(entries)
-
-            print("raft_instance.logs", raft_instance.logs)
-            # Update commitIndex and apply to state machine
-            if leader_commit > raft_instance.commitIndex:
-                raft_instance.commitIndex = min(leader_commit, len(raft_instance.logs))
-                with transaction.atomic():
-                    print(raft_instance.lastApplied + 1, raft_instance.commitIndex + 1)
-                    for i in range(raft_instance.lastApplied + 1, raft_instance.commitIndex + 1):
-                        log_entry = raft_instance.logs[i - 1]
-                        print(log_entry)
-                        order_data = log_entry['order']
-                        order = Order(
-                            product_name=order_data['product_name'],
-                            quantity=order_data['quantity']
-                        )
-                        order.save()
-                        log_entry = LogEntry(
-                            index=log_entry['index'],
-                            term=log_entry['term'],
-                            command=log_entry['command'],
-                            order=order
-                        )
-                        log_entry.save()
-                        print(f"Applied log to state machine: {order}")
-
-                raft_instance.lastApplied = raft_instance.commitIndex
-                print(f"Updated lastApplied to {raft_instance.lastApplied}")
-
-
-            # If entries is empty, it is a heartbeat message
-            if not entries: 
-                print(f'''Received heartbeat message from leader {leader_id}''')
-                return JsonResponse({'success': True, 'term': term})
-            
-            # Update commitIndex
-            if leader_commit > raft_instance.commitIndex:
-                raft_instance.commitIndex = min(leader_commit, len(raft_instance.logs))
-        return JsonResponse({'success': True, 'term': raft_instance.currentTerm})
+        # Handle the RPC on the Raft event loop
+        reply = await raft_instance.call(raft_instance.handle_append_entries(data))
+        return JsonResponse(reply)
     except json.JSONDecodeError:
         return JsonResponse({'error': 'Invalid JSON'}, status=400)
     except Exception as e:
-        print(e)
+        log_event(views_logger, logging.WARNING, "append entries handler failed", error=e)
         return JsonResponse({'error': str(e)}, status=500)
 
 
-        
\ No newline at end of file
+@require_GET
+def get_admission_stats(request):
+    # Served outside of the executor, so the stats stay visible while requests are shed
+    return JsonResponse(status=200, data={"data": {"pools": {executor.name: executor.to_dict() for executor in executors}}})
+
+
+@require_GET
+def get_ready(request):
+    # Served outside of the executors, like a liveness probe
+    return process_get_ready_request()
@@ -7,10 +7,47 @@ For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 """
 
+import asyncio
 import os
 
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'order.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from order.raft_node import raft_instance
+
+# Task starting the Raft server, kept so it is not garbage collected while it runs
+raft_start_task = None
+
+
+def start_raft():
+    '''
+    Start the Raft server in the background, so the log is loaded while requests are served.
+    '''
+    global raft_start_task
+    if raft_instance and raft_start_task is None:
+        raft_start_task = asyncio.get_running_loop().create_task(raft_instance.start_async())
+
+
+async def application(scope, receive, send):
+    """
+    Serve Django and run the Raft server on the event loop of the ASGI server, so a single
+    loop drives the Raft timers, replication and RPC handlers.
+    """
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                start_raft()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if raft_instance:
+                    await raft_instance.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    # Servers running without lifespan events start the Raft server on the first request
+    start_raft()
+    await django_application(scope, receive, send)
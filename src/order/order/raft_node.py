@@ -0,0 +1,19 @@
+"""
+The Raft server of this order replica, shared by the WSGI and ASGI entry points.
+
+The server is only created here. The WSGI entry point starts it on an event loop thread
+of its own, while the ASGI entry point starts it on the event loop of the ASGI server.
+Peers reach each other's Raft RPCs on the dedicated RAFT_RPC_PORTS, not on the ports
+that serve the clients.
+"""
+
+import logging
+import os
+from app.utils.raft import Raft
+from app.utils.constants import ORDER_SERVER_HOST, RAFT_RPC_PORTS
+from app.utils.log import log_event, election_logger
+
+peers = [(id ,f'''http://{ORDER_SERVER_HOST}:{port}''') for id, port in RAFT_RPC_PORTS.items()]
+current_ID = os.getenv('ORDER_SERVER_ID')
+log_event(election_logger, logging.INFO, "Raft server configured", server=current_ID)
+raft_instance = Raft(server_id=current_ID, peers=peers, rpc_port=RAFT_RPC_PORTS[current_ID]) if current_ID else None
@@ -11,13 +11,18 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
 import os
+import sys
 from pathlib import Path
+from app.utils.log import parse_log_levels
 
 DB_NAME = os.environ.get('DB_NAME', 'db.sqlite3')
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# Code shared by the servers, in src/common
+sys.path.append(str(BASE_DIR.parent))
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.0/howto/deployment/checklist/
@@ -138,3 +143,51 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Logging
+# Per-subsystem levels are set with LOG_LEVELS, e.g. "raft=INFO,raft.replication=DEBUG".
+# Records below WARNING are sampled (keep 1 of LOG_SAMPLE) and limited to LOG_RATE_LIMIT
+# per second and logger, both on the console and in the buffer served by /raft/events/.
+
+LOG_LEVELS = parse_log_levels(os.environ.get("LOG_LEVELS", ""))
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "filters": {
+        "rate_limit_console": {
+            "()": "app.utils.log.RateLimitFilter",
+            "rate": os.environ.get("LOG_RATE_LIMIT", "50"),
+            "sample": os.environ.get("LOG_SAMPLE", "1"),
+        },
+        "rate_limit_events": {
+            "()": "app.utils.log.RateLimitFilter",
+            "rate": os.environ.get("LOG_RATE_LIMIT", "50"),
+            "sample": os.environ.get("LOG_SAMPLE", "1"),
+        },
+    },
+    "formatters": {
+        "structured": {
+            "()": "app.utils.log.StructuredFormatter",
+        },
+    },
+    "handlers": {
+        "console": {
+            "class": "logging.StreamHandler",
+            "formatter": "structured",
+            "filters": ["rate_limit_console"],
+        },
+        "events": {
+            "class": "app.utils.log.RingBufferHandler",
+            "filters": ["rate_limit_events"],
+        },
+    },
+    "loggers": {
+        name: (
+            {"handlers": ["console", "events"], "level": level, "propagate": False}
+            if name in ("raft", "order") else {"level": level}
+        )
+        for name, level in LOG_LEVELS.items()
+    },
+}
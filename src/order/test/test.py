@@ -2,10 +2,34 @@ import pytest
 from rest_framework import status
 import requests_mock
 import json
-from django.http import JsonResponse
+from django.http import StreamingHttpResponse
 from unittest import mock
-from app.models import Order
-from app.views import process_get_order_request, process_post_order_request, process_post_replicas_order_request, process_get_sync_orders_request
+import asyncio
+import time
+import gzip
+import httpx
+import numpy as np
+from datetime import timedelta
+from app.models import Order, LogEntry, ProductStats
+from app.views import finish_reservation, hold_reservation, resolve_held_reservation, process_get_order_request, process_get_orders_request, process_get_product_orders_request, process_post_order_request, process_post_batch_order_request, process_post_replicas_order_request, process_post_replicas_batch_order_request, process_get_sync_orders_request, process_get_sync_orders_stream_request, process_get_raft_status_request, process_get_raft_events_request, process_get_cache_stats_request, process_get_product_stats_request, process_post_product_stats_rebuild_request, process_get_ready_request, process_get_sync_status_request
+from app.utils.metrics import Histogram
+from app.utils.cache import OrderCache, order_cache
+from app.utils.log import RateLimitFilter, RingBufferHandler, recent_events
+import logging
+from app.utils.raft import Raft, RaftConfig
+from app.utils.raft_rpc import RaftRPCServer
+from app.middleware import RaftMiddleware
+from app.utils.leader import synchronize_orders, synchronize_until_done
+from app.utils.replication import Replicator
+from app.utils.merkle import MerkleTree, repair_from_peer
+from app.utils.archive import OrderArchive, Archiver
+from app.utils.export import export_orders, load_orders
+from common.admission import AdmissionExecutor
+from common.startup import Readiness
+from app.utils.store import MemoryOrderStore, SQLiteOrderStore, StoredOrder, order_store
+import threading
+import copy
+from django.test import RequestFactory
 
 CATALOG_SERVER_HOST = "localhost"
 CATALOG_SERVER_PORT = "8001"
@@ -49,21 +73,331 @@ def test_get_order_fail():
     print("test_get_order_fail:", response.status_code, expected_response)
 
 
+@pytest.mark.django_db
+def test_get_order_served_from_cache():
+    order_cache.clear()
+    order = Order.objects.create(product_name="Tux", quantity=2)
+    hits = order_cache.hits.to_dict()
+
+    process_get_order_request(str(order.order_number))
+    # Once cached, the order is served without reading the database
+    Order.objects.all().delete()
+    response = process_get_order_request(str(order.order_number))
+    stats = json.loads(process_get_cache_stats_request().content.decode("utf-8"))["data"]
+    order_cache.clear()
+
+    assert response.status_code == status.HTTP_200_OK
+    assert json.loads(response.content.decode("utf-8")) == {"data": {"number": order.order_number, "name": "Tux", "quantity": 2}}
+    assert stats["hits"] == hits + 1
+    assert stats["entries"] == 1
+    assert stats["memory_bytes"] > 0
+    print("test_get_order_served_from_cache", stats)
+
+
+def test_order_cache_evicts_least_recently_used():
+    cache = OrderCache(max_entries=2)
+    cache.put(1, "Tux", 2)
+    cache.put(2, "Lego", 1)
+    cache.get(1)
+    cache.put(3, "Uno", 3)
+
+    assert cache.get(2) is None
+    assert cache.get(1) == ("Tux", 2)
+    assert cache.get(3) == ("Uno", 3)
+    stats = cache.to_dict()
+    assert stats["entries"] == 2
+    assert stats["evictions"] == 1
+    assert stats["hit_ratio"] == 0.75
+    print("test_order_cache_evicts_least_recently_used", stats)
+
+
+@pytest.mark.django_db
+def test_get_orders_by_numbers_and_range():
+    for name, quantity in [("Tux", 2), ("Lego", 1), ("Uno", 3), ("Clue", 4)]:
+        Order.objects.create(product_name=name, quantity=quantity)
+
+    def read(response):
+        return json.loads(b"".join(response.streaming_content).decode("utf-8"))["data"]["orders"]
+
+    with mock.patch("app.views.BULK_LOOKUP_PAGE_SIZE", 2):
+        by_numbers = read(process_get_orders_request(numbers=[4, 2, 9, 2]))
+        by_range = read(process_get_orders_request(start=2, end=4))
+        open_range = read(process_get_orders_request(start=3))
+
+    assert by_numbers == [{"number": 2, "name": "Lego", "quantity": 1}, {"number": 4, "name": "Clue", "quantity": 4}]
+    assert [order["number"] for order in by_range] == [2, 3, 4]
+    assert [order["number"] for order in open_range] == [3, 4]
+    print("test_get_orders_by_numbers_and_range", by_numbers)
+
+
+@pytest.mark.django_db
+def test_get_product_orders_pages_by_cursor():
+    for name in ["Tux", "Lego", "Tux", "Tux", "Uno", "Tux"]:
+        Order.objects.create(product_name=name, quantity=1)
+
+    first = json.loads(process_get_product_orders_request("Tux", 0, 2).content)["data"]
+    second = json.loads(process_get_product_orders_request("Tux", first["next_cursor"], 2).content)["data"]
+
+    assert [order["number"] for order in first["orders"]] == [1, 3]
+    assert first["next_cursor"] == 3
+    assert [order["number"] for order in second["orders"]] == [4, 6]
+    assert second["next_cursor"] is None
+    print("test_get_product_orders_pages_by_cursor", first, second)
+
+
+@pytest.mark.django_db
+def test_product_stats_follow_stored_orders():
+    batch = {"orders": [
+        {"order_number": 1, "name": "Tux", "quantity": 2},
+        {"order_number": 2, "name": "Lego", "quantity": 1},
+        {"order_number": 3, "name": "Tux", "quantity": 3},
+    ]}
+    process_post_replicas_batch_order_request(batch)
+    # A batch sent again must not be counted twice
+    process_post_replicas_batch_order_request(batch)
+
+    def read():
+        return json.loads(process_get_product_stats_request().content)["data"]["products"]
+
+    expected = [
+        {"name": "Lego", "orders": 1, "units": 1, "last_order_number": 2},
+        {"name": "Tux", "orders": 2, "units": 5, "last_order_number": 3},
+    ]
+    assert read() == expected
+
+    ProductStats.objects.all().delete()
+    response = process_post_product_stats_rebuild_request()
+    assert json.loads(response.content)["data"]["products"] == 2
+    assert read() == expected
+    print("test_product_stats_follow_stored_orders", read())
+
+
+@pytest.mark.django_db
+def test_archived_orders_are_still_found(tmp_path):
+    names = ["Tux", "Lego", "Uno", "Clue", "Tux", "Lego", "Uno", "Clue", "Tux", "Lego"]
+    for i, name in enumerate(names):
+        Order.objects.create(product_name=name, quantity=i + 1)
+    process_post_product_stats_rebuild_request()
+    expected_stats = json.loads(process_get_product_stats_request().content)["data"]["products"]
+
+    archive = OrderArchive(str(tmp_path))
+    order_cache.clear()
+    with mock.patch("app.utils.archive.ARCHIVE_SEGMENT_ORDERS", 4), mock.patch("app.utils.archive.ARCHIVE_BLOCK_ORDERS", 2), \
+            mock.patch("app.views.order_archive", archive), mock.patch("app.utils.archive.order_archive", archive):
+        # Orders 1 to 8 fill two segments and are older than the 2 kept orders
+        assert Archiver(archive, keep=2).archive_once() == 8
+        assert list(Order.objects.values_list('order_number', flat=True)) == [9, 10]
+
+        order = json.loads(process_get_order_request(6).content)["data"]
+        missing = process_get_order_request(11)
+        orders = json.loads(b"".join(process_get_orders_request(start=3, end=9).streaming_content))["data"]["orders"]
+        by_numbers = json.loads(b"".join(process_get_orders_request(numbers=[2, 10]).streaming_content))["data"]["orders"]
+        process_post_product_stats_rebuild_request()
+        stats = json.loads(process_get_product_stats_request().content)["data"]["products"]
+
+    assert order == {"number": 6, "name": "Lego", "quantity": 6}
+    assert missing.status_code == 404
+    assert [order["number"] for order in orders] == [3, 4, 5, 6, 7, 8, 9]
+    assert [order["number"] for order in by_numbers] == [2, 10]
+    assert stats == expected_stats
+    # The segments are read back from disk after a restart
+    assert OrderArchive(str(tmp_path)).get(3) == (3, "Uno", 3)
+    print("test_archived_orders_are_still_found", archive.to_dict())
+
+
+@pytest.mark.django_db
+def test_export_orders_appends_new_orders(tmp_path):
+    for name, quantity in [("Tux", 2), ("Lego", 1), ("Tux", 3)]:
+        Order.objects.create(product_name=name, quantity=quantity)
+    assert export_orders(str(tmp_path), chunk_orders=2) == 3
+
+    for name, quantity in [("Uno", 4), ("Lego", 5)]:
+        Order.objects.create(product_name=name, quantity=quantity)
+    assert export_orders(str(tmp_path), chunk_orders=2) == 2
+    assert export_orders(str(tmp_path), chunk_orders=2) == 0
+
+    columns, products = load_orders(str(tmp_path))
+    assert products == ["Tux", "Lego", "Uno"]
+    assert columns["order_number"].tolist() == [1, 2, 3, 4, 5]
+    assert columns["product_id"].tolist() == [0, 1, 0, 2, 1]
+    # Units sold per product, without decoding a single row
+    units = np.bincount(columns["product_id"], weights=columns["quantity"])
+    assert units.tolist() == [5, 6, 4]
+    print("test_export_orders_appends_new_orders", sorted(path.name for path in tmp_path.iterdir()))
+
+
+def test_admission_executor_sheds_excess_requests():
+    executor = AdmissionExecutor(max_workers=1, max_queue=2, max_queue_time=0.05, limits={"slow_write": 1})
+    release = threading.Event()
+
+    def slow_write():
+        release.wait(5)
+        return "written"
+
+    def read():
+        return "read"
+
+    first = executor.submit(slow_write)
+    # A second write is over its endpoint's limit, reads still queue behind the busy worker
+    over_limit = executor.submit(slow_write).result()
+    queued = [executor.submit(read) for _ in range(2)]
+    queue_full = executor.submit(read).result()
+    time.sleep(0.1)
+    release.set()
+
+    assert first.result() == "written"
+    assert over_limit.status_code == 503 and over_limit["Retry-After"] == "1"
+    assert queue_full.status_code == 503
+    # The queued reads waited longer than the queue time, so they are shed when picked up
+    assert all(future.result().status_code == 503 for future in queued)
+    stats = executor.to_dict()
+    assert stats["queued"] == 0 and stats["running"] == 0
+    assert stats["endpoints"]["slow_write"] == {"in_flight": 0, "admitted": 1, "shed_queue_full": 0, "shed_concurrency": 1, "shed_queue_time": 0, "limit": 1}
+    assert stats["endpoints"]["read"]["shed_queue_full"] == 1 and stats["endpoints"]["read"]["shed_queue_time"] == 2
+    print("test_admission_executor_sheds_excess_requests", stats)
+
+
+@pytest.mark.django_db
+def test_admission_executor_holds_streaming_slot_until_closed():
+    executor = AdmissionExecutor(max_workers=2, limits={"stream": 1})
+
+    def stream():
+        return StreamingHttpResponse(iter([b"a", b"b"]))
+
+    response = executor.submit(stream).result()
+    # The worker is done, but the response is still being written
+    while_streaming = executor.submit(stream).result()
+    body = b"".join(response)
+    response.close()
+    after_close = executor.submit(stream).result()
+
+    assert body == b"ab"
+    assert while_streaming.status_code == 503
+    assert isinstance(after_close, StreamingHttpResponse)
+    print("test_admission_executor_holds_streaming_slot_until_closed", executor.to_dict()["endpoints"]["stream"])
+
+
+def test_bulkheads_keep_reads_going_while_writes_stall():
+    read_executor = AdmissionExecutor(1, 10, 5, name="read")
+    write_executor = AdmissionExecutor(1, 10, 5, name="write")
+    release = threading.Event()
+
+    stalled = [write_executor.submit(release.wait, 5) for _ in range(3)]
+    # Reads have their own workers, so they are served while every write worker is stuck
+    assert read_executor.submit(sum, [1, 2]).result(timeout=1) == 3
+    write_stats = write_executor.to_dict()
+    release.set()
+
+    assert all(future.result() for future in stalled)
+    assert write_stats["utilization"] == 1.0 and write_stats["queued"] == 2
+    assert read_executor.to_dict()["wait_seconds"]["count"] == 1
+    print("test_bulkheads_keep_reads_going_while_writes_stall", write_stats)
+
+
+def test_ready_waits_for_background_startup_tasks():
+    readiness = Readiness()
+    release = threading.Event()
+    readiness.run_in_background("sync", release.wait)
+    readiness.run_in_background("leader", lambda: False)
+
+    with mock.patch("app.views.readiness", readiness):
+        # The server serves while the sync runs, but orders are refused until it is done
+        response = process_post_order_request({"name": "Tux", "quantity": 1})
+        assert response.status_code == 503
+        assert process_get_ready_request().status_code == 503
+        release.set()
+        for _ in range(100):
+            if not readiness.is_pending("sync"):
+                break
+            time.sleep(0.01)
+        checks = json.loads(process_get_ready_request().content)["data"]["checks"]
+
+    assert checks["sync"]["ready"] and checks["sync"]["seconds"] is not None
+    assert not checks["leader"]["ready"] and checks["leader"]["error"] == "task failed"
+    print("test_ready_waits_for_background_startup_tasks", checks)
+
+
+@pytest.mark.django_db
+def test_order_stores_behave_the_same():
+    results = []
+    for store in (SQLiteOrderStore(), MemoryOrderStore()):
+        with store.atomic():
+            added = store.add([(None, "Tux", 2), (None, "Lego", 1)])
+            # Orders numbered by the primary, one of them stored already
+            added += store.add([(5, "Tux", 3), (2, "Lego", 1)])
+        store.replace([(2, "Uno", 4)])
+        store.delete([1])
+        results.append({
+            "added": added,
+            "get": (store.get(2), store.get(1)),
+            "many": store.get_many([5, 2, 9]),
+            "range": (store.read_range(2, None, 1), store.read_range(3)),
+            "product": store.read_product("Tux", 0, 10),
+            "latest": store.latest(),
+            "numbers": store.numbers(1, 5),
+            "first_missing": (store.first_missing(1), store.first_missing(2), store.first_missing(5)),
+            "stats": store.product_stats(),
+        })
+        store.replace_product_stats(store.count_products())
+        results[-1]["rebuilt"] = store.product_stats()
+
+    assert results[0] == results[1]
+    result = results[0]
+    assert [tuple(order) for order in result["added"]] == [(1, "Tux", 2), (2, "Lego", 1), (5, "Tux", 3)]
+    assert result["get"] == ((2, "Uno", 4), None)
+    assert result["many"] == [(2, "Uno", 4), (5, "Tux", 3)]
+    assert result["range"] == ([(2, "Uno", 4)], [(5, "Tux", 3)])
+    assert result["product"] == [(5, "Tux", 3)]
+    assert result["latest"] == 5 and result["numbers"] == {2, 5}
+    assert result["first_missing"] == (1, 3, 6)
+    # Stats count the added orders, replaced and deleted ones are only changed by a rebuild
+    assert result["stats"] == [{"name": "Lego", "orders": 1, "units": 1, "last_order_number": 2}, {"name": "Tux", "orders": 2, "units": 5, "last_order_number": 5}]
+    assert result["rebuilt"] == [{"name": "Tux", "orders": 1, "units": 3, "last_order_number": 5}, {"name": "Uno", "orders": 1, "units": 4, "last_order_number": 2}]
+    print("test_order_stores_behave_the_same", result["rebuilt"])
+
+
+@pytest.mark.django_db
+def test_order_stores_persist_and_link_log_entries():
+    entries = [
+        {"index": 1, "term": 1, "command": "Buy 2 Tux", "order": {"product_name": "Tux", "quantity": 2}},
+        {"index": 2, "term": 1, "command": "Buy 1 Lego", "order": {"product_name": "Lego", "quantity": 1}},
+        {"index": 3, "term": 2, "command": "Buy 3 Uno", "order": {"product_name": "Uno", "quantity": 3}},
+    ]
+    results = []
+    for store in (SQLiteOrderStore(), MemoryOrderStore()):
+        store.persist_log_entries(entries[:2])
+        orders = store.add([(None, "Tux", 2)])
+        store.link_log_entries(entries[:1], orders)
+        # A new leader overwrites the uncommitted entry 2, entry 3 is applied without being persisted
+        store.persist_log_entries([{**entries[1], "term": 2}])
+        orders = store.add([(None, "Lego", 1), (None, "Uno", 3)])
+        store.link_log_entries(entries[1:], orders)
+        if isinstance(store, SQLiteOrderStore):
+            rows = LogEntry.objects.order_by("index").values_list("index", "term", "order_id")
+        else:
+            rows = [(index, entry[0], entry[2]) for index, entry in sorted(store.log_entries.items())]
+        results.append(list(rows))
+
+    assert results[0] == results[1] == [(1, 1, 1), (2, 2, 2), (3, 2, 3)]
+    print("test_order_stores_persist_and_link_log_entries", results[0])
+
+
 @pytest.mark.django_db
 def test_post_order_success():
 
     order_data = {'name': 'Tux', 'quantity': 2}
-    expected_response1 = JsonResponse(status = 200, data = {'data': {'name': 'Tux', 'price': '6.90', 'quantity': 77}})
-    expected_response2 = JsonResponse(status = 200, data = {})
+    reservation_response = {'data': {'reservation_id': 'r1', 'ttl': 30}}
 
-    url1 = f"http://{CATALOG_SERVER_HOST}:{CATALOG_SERVER_PORT}/products/{order_data['name']}/"
-    url2 = f"http://{CATALOG_SERVER_HOST}:{CATALOG_SERVER_PORT}/orders/"
+    url1 = f"http://{CATALOG_SERVER_HOST}:{CATALOG_SERVER_PORT}/reservations/"
+    url2 = f"http://{CATALOG_SERVER_HOST}:{CATALOG_SERVER_PORT}/reservations/r1/confirm/"
     with requests_mock.Mocker() as m:
-        m.get(url1, json=expected_response1, status_code=200)
-        m.post(url2, json=expected_response2, status_code=200)
+        m.post(url1, json=reservation_response, status_code=200)
+        m.post(url2, json={'data': {}}, status_code=200)
+        response = process_post_order_request(order_data)
+        paths = [request.path for request in m.request_history]
 
-    response = process_post_order_request(order_data)
     assert response.status_code == status.HTTP_200_OK
+    assert paths == ["/reservations/", "/reservations/r1/confirm/"]
 
     latest_order = Order.objects.latest('order_number')
     assert latest_order.product_name == order_data['name']
@@ -76,15 +410,17 @@ def test_post_order_success():
 def test_post_order_fail():
 
     order_data = {'name': 'Tux', 'quantity': 100}
-    expected_response1 = JsonResponse(status = 200, data = {'data': {'name': 'Tux', 'price': '6.90', 'quantity': 77}})
+    no_stock = {'error': {'code': 400, 'message': 'No sufficient stock of Tux'}}
 
-    url1 = f"http://{CATALOG_SERVER_HOST}:{CATALOG_SERVER_PORT}/products/{order_data['name']}/"
+    url1 = f"http://{CATALOG_SERVER_HOST}:{CATALOG_SERVER_PORT}/reservations/"
     with requests_mock.Mocker() as m:
-        m.get(url1, json=expected_response1, status_code=200)
+        m.post(url1, json=no_stock, status_code=400)
+        response = process_post_order_request(order_data)
 
-    response = process_post_order_request(order_data)
     assert response.status_code == 400
     response_data = json.loads(response.content.decode("utf-8"))
+    assert response_data == no_stock
+    assert Order.objects.count() == 0
     print("test_post_order_fail", response.status_code, response_data)
 
 
@@ -118,3 +454,556 @@ def test_get_sync_orders_success():
     assert response_data == expected_data
     print("test_get_sync_orders_success", response.status_code)
 
+
+@pytest.mark.django_db
+def test_get_sync_orders_stream_resumes_from_cursor():
+    for i in range(5):
+        Order.objects.create(product_name="Tux", quantity=i+1)
+
+    response = process_get_sync_orders_stream_request(1, 2, False)
+    lines = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+    compressed = process_get_sync_orders_stream_request(3, 10, True)
+    rest = [json.loads(line) for line in gzip.decompress(b"".join(compressed.streaming_content)).splitlines()]
+
+    assert response["Content-Type"] == "application/x-ndjson"
+    assert lines == [
+        {"order_number": 2, "product_name": "Tux", "quantity": 2},
+        {"order_number": 3, "product_name": "Tux", "quantity": 3},
+        {"cursor": 3, "more": True},
+    ]
+    assert compressed["Content-Encoding"] == "gzip"
+    assert [order.get("order_number") for order in rest] == [4, 5, None]
+    assert rest[-1] == {"cursor": 5, "more": False}
+    print("test_get_sync_orders_stream_resumes_from_cursor", lines, rest)
+
+
+@pytest.mark.django_db
+def test_synchronize_orders_fetches_ranges_from_peers():
+    Order.objects.create(product_name="Tux", quantity=1)
+
+    with requests_mock.Mocker() as m, mock.patch("app.utils.leader.SYNC_RANGE_SIZE", 1):
+        m.get("http://localhost:8002/sync/status/", json={"data": {"latest_order_number": 3}})
+        m.get("http://localhost:8003/sync/status/", json={"data": {"latest_order_number": 2}})
+        m.get("http://localhost:8004/sync/status/", status_code=500)
+        # The most up-to-date peer fails to serve the first range, which is then fetched from the other one
+        m.get("http://localhost:8002/sync/orders/?after=1", status_code=500)
+        m.get("http://localhost:8003/sync/orders/?after=1", content=b'{"order_number": 2, "product_name": "Lego", "quantity": 2}\n{"cursor": 2, "more": false}\n')
+        m.get("http://localhost:8002/sync/orders/?after=2", content=b'{"order_number": 3, "product_name": "Uno", "quantity": 3}\n{"cursor": 3, "more": false}\n')
+        response = synchronize_orders()
+
+    assert response.status_code == 200
+    assert json.loads(response.content.decode("utf-8"))["synced"] == 2
+    assert list(Order.objects.order_by("order_number").values_list("order_number", "product_name")) == [(1, "Tux"), (2, "Lego"), (3, "Uno")]
+    print("test_synchronize_orders_fetches_ranges_from_peers", response.status_code)
+
+
+@pytest.mark.django_db
+def test_synchronize_until_done_retries_while_no_peer_is_reachable():
+    with requests_mock.Mocker() as m, mock.patch("app.utils.leader.SYNC_RETRY_DELAY", 0.01):
+        # Every peer is down at first, then one of them comes up
+        m.get("http://localhost:8002/sync/status/", [{"status_code": 500}, {"status_code": 500}, {"json": {"data": {"latest_order_number": 0}}}])
+        m.get("http://localhost:8003/sync/status/", status_code=500)
+        m.get("http://localhost:8004/sync/status/", status_code=500)
+        first = synchronize_orders()
+        response = synchronize_until_done()
+
+    assert first.status_code == 503
+    assert response.status_code == 200
+    print("test_synchronize_until_done_retries_while_no_peer_is_reachable", first.status_code, response.status_code)
+
+
+@pytest.mark.django_db
+def test_synchronize_until_done_starts_alone_after_waiting_for_peers():
+    readiness = Readiness()
+    release = threading.Event()
+    readiness.run_in_background("sync", release.wait)
+    with requests_mock.Mocker() as m, mock.patch("app.utils.leader.SYNC_RETRY_DELAY", 0.01), mock.patch("app.utils.leader.SYNC_PEER_WAIT", 0.05):
+        # No peer ever comes up
+        for port in ("8002", "8003", "8004"):
+            m.get(f"http://localhost:{port}/sync/status/", status_code=500)
+        response = synchronize_until_done(readiness)
+    release.set()
+    for _ in range(100):
+        if not readiness.is_pending("sync"):
+            break
+        time.sleep(0.01)
+    check = readiness.to_dict()["sync"]
+
+    # Ready with the local orders, and /ready/ says it did not synchronize
+    assert response.status_code == 200
+    assert check["ready"] and "No replica reachable" in check["warning"]
+    print("test_synchronize_until_done_starts_alone_after_waiting_for_peers", check)
+
+
+def test_histogram_observe():
+    histogram = Histogram(buckets=(0.01, 0.1, 1.0))
+    for value in [0.005, 0.05, 0.05, 0.5, 5.0]:
+        histogram.observe(value)
+
+    data = histogram.to_dict()
+    assert data["count"] == 5
+    assert data["buckets"] == {"0.01": 1, "0.1": 2, "1.0": 1, "+Inf": 1}
+    assert data["p50"] == 0.1
+    assert data["max"] == 5.0
+    print("test_histogram_observe", data)
+
+
+@pytest.mark.django_db
+def test_get_raft_status():
+    peers = [("3", "http://localhost:8002"), ("2", "http://localhost:8003"), ("1", "http://localhost:8004")]
+    raft_instance = Raft(server_id="3", peers=peers)
+
+    with mock.patch("order.raft_node.raft_instance", raft_instance):
+        response = process_get_raft_status_request()
+
+    assert response.status_code == 200
+    response_data = json.loads(response.content.decode("utf-8"))["data"]
+    assert response_data["role"] == "follower"
+    assert response_data["commitIndex"] == 0
+    assert set(response_data["peers"]) == {"2", "1"}
+    assert response_data["peers"]["2"] == {"nextIndex": 1, "matchIndex": 0, "lag": 0}
+    assert set(response_data["metrics"]["append_entries_rtt_seconds"]) == {"2", "1"}
+    print("test_get_raft_status", response.status_code)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_raft_handle_append_entries_applies_committed_entries():
+    peers = [("3", "http://localhost:8002"), ("2", "http://localhost:8003"), ("1", "http://localhost:8004")]
+    raft_instance = Raft(server_id="2", peers=peers)
+    raft_instance.load()
+    entries = [
+        {"index": 1, "term": 1, "command": "Buy 2 Tux", "order": {"product_name": "Tux", "quantity": 2}},
+        {"index": 2, "term": 1, "command": "Buy 1 Lego", "order": {"product_name": "Lego", "quantity": 1}},
+    ]
+    data = {"Term": 1, "LeaderId": "3", "PrevLogIndex": 0, "PrevLogTerm": 0, "Entries": entries, "LeaderCommit": 2}
+
+    async def handle():
+        raft_instance.loop = asyncio.get_running_loop()
+        return await raft_instance.handle_append_entries(data)
+
+    reply = asyncio.run(handle())
+
+    assert reply == {"success": True, "term": 1}
+    assert raft_instance.leaderId == "3"
+    assert raft_instance.lastApplied == 2
+    assert list(Order.objects.order_by("order_number").values_list("product_name", "quantity")) == [("Tux", 2), ("Lego", 1)]
+    print("test_raft_handle_append_entries_applies_committed_entries", reply)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_raft_handle_append_entries_hints_next_index():
+    peers = [("3", "http://localhost:8002"), ("2", "http://localhost:8003"), ("1", "http://localhost:8004")]
+    raft_instance = Raft(server_id="2", peers=peers)
+    raft_instance.load()
+    raft_instance.logs = [
+        {"index": 1, "term": 1, "command": "Buy 2 Tux", "order": {"product_name": "Tux", "quantity": 2}},
+        {"index": 2, "term": 2, "command": "Buy 1 Lego", "order": {"product_name": "Lego", "quantity": 1}},
+        {"index": 3, "term": 2, "command": "Buy 1 Lego", "order": {"product_name": "Lego", "quantity": 1}},
+    ]
+    # The leader is missing the follower's term 2 entries, and the follower is missing entries up to 5
+    conflicting = {"Term": 3, "LeaderId": "3", "PrevLogIndex": 3, "PrevLogTerm": 3, "Entries": [], "LeaderCommit": 0}
+    missing = {"Term": 3, "LeaderId": "3", "PrevLogIndex": 5, "PrevLogTerm": 3, "Entries": [], "LeaderCommit": 0}
+
+    async def handle():
+        raft_instance.loop = asyncio.get_running_loop()
+        return await raft_instance.handle_append_entries(conflicting), await raft_instance.handle_append_entries(missing)
+
+    conflicting_reply, missing_reply = asyncio.run(handle())
+
+    assert conflicting_reply == {"success": False, "term": 3, "next_index": 2}
+    assert missing_reply == {"success": False, "term": 3, "next_index": 4}
+    print("test_raft_handle_append_entries_hints_next_index", conflicting_reply, missing_reply)
+
+
+@pytest.mark.django_db
+def test_raft_load_persisted_entries():
+    peers = [("3", "http://localhost:8002"), ("2", "http://localhost:8003"), ("1", "http://localhost:8004")]
+    raft_instance = Raft(server_id="3", peers=peers)
+    entries = [
+        {"index": 1, "term": 1, "command": "Buy 2 Tux", "order": {"product_name": "Tux", "quantity": 2}},
+        {"index": 2, "term": 1, "command": "Buy 1 Lego", "order": {"product_name": "Lego", "quantity": 1}},
+    ]
+    # Both entries are durable, but only the first one is committed and applied
+    raft_instance.persist_entries(entries)
+    raft_instance.apply_entries(entries[:1])
+
+    restarted = Raft(server_id="3", peers=peers)
+    restarted.load()
+
+    assert restarted.logs == entries
+    assert restarted.commitIndex == 1
+    assert restarted.lastApplied == 1
+    assert restarted.persistedIndex == 2
+    assert Order.objects.count() == 1
+    print("test_raft_load_persisted_entries", restarted.logs)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_raft_rpc_listener_handles_vote():
+    peers = [("3", "http://localhost:9002"), ("2", "http://localhost:9003"), ("1", "http://localhost:9004")]
+    raft_instance = Raft(server_id="2", peers=peers)
+    raft_instance.load()
+    data = {"Term": 1, "CandidateId": "3", "LastLogIndex": -1, "LastLogTerm": 0}
+
+    async def request_vote():
+        raft_instance.loop = asyncio.get_running_loop()
+        rpc_server = await RaftRPCServer(raft_instance).start("localhost", 0)
+        port = rpc_server.server.sockets[0].getsockname()[1]
+        async with httpx.AsyncClient() as client:
+            vote_response = await client.post(f"http://localhost:{port}/vote/", json=data)
+            missing_response = await client.post(f"http://localhost:{port}/orders/", json={})
+        await rpc_server.stop()
+        return vote_response, missing_response
+
+    vote_response, missing_response = asyncio.run(request_vote())
+
+    assert vote_response.status_code == 200
+    assert vote_response.json() == {"VoteGranted": True, "Term": 1}
+    assert raft_instance.votedFor == "3"
+    assert missing_response.status_code == 404
+    print("test_raft_rpc_listener_handles_vote", vote_response.json())
+
+
+def test_raft_middleware_forwards_to_leader():
+    raft_instance = mock.Mock(me="2", leaderId="3")
+    raft_instance.get_state.return_value = (4, False)
+    raft_instance.get_leader_url.return_value = "http://localhost:8002"
+    request = RequestFactory().put("/orders/7/?verbose=1", data=b'{"quantity": 3}', content_type="application/json")
+
+    with mock.patch.dict("os.environ", {"USE_RAFT": "True"}), mock.patch("order.raft_node.raft_instance", raft_instance):
+        with requests_mock.Mocker() as m:
+            m.put("http://localhost:8002/orders/7/?verbose=1", content=b'{"data": {"order_number": 7}}', status_code=202, headers={"Content-Type": "application/json"})
+            response = RaftMiddleware(lambda request: None)(request)
+            body = b"".join(response.streaming_content)
+            forwarded = m.last_request
+
+    assert forwarded.method == "PUT"
+    assert forwarded.body == b'{"quantity": 3}'
+    assert response.status_code == 202
+    assert body == b'{"data": {"order_number": 7}}'
+    assert response["X-Raft-Leader"] == "3"
+    assert response["X-Raft-Term"] == "4"
+    print("test_raft_middleware_forwards_to_leader", response.status_code, body)
+
+
+def test_rate_limit_filter_keeps_warnings():
+    rate_filter = RateLimitFilter(rate=2, sample=1)
+    records = [logging.LogRecord("raft.replication", logging.DEBUG, __file__, 0, "heartbeat", None, None) for _ in range(5)]
+    kept = [rate_filter.filter(record) for record in records]
+    warning = logging.LogRecord("raft.replication", logging.WARNING, __file__, 0, "not committed", None, None)
+
+    assert kept == [True, True, False, False, False]
+    assert rate_filter.filter(warning)
+    print("test_rate_limit_filter_keeps_warnings", kept)
+
+
+def test_get_raft_events():
+    logger = logging.getLogger("test.events")
+    handler = RingBufferHandler()
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    recent_events.clear()
+    try:
+        logger.debug("heartbeat", extra={"fields": {"peer": "2"}})
+        logger.warning("not committed", extra={"fields": {"index": 7, "error": ValueError("timeout")}})
+        response = process_get_raft_events_request(10, "test", "warning")
+        bad_response = process_get_raft_events_request(10, None, "loud")
+    finally:
+        logger.removeHandler(handler)
+
+    assert response.status_code == 200
+    events = json.loads(response.content.decode("utf-8"))["data"]["events"]
+    assert [event["message"] for event in events] == ["not committed"]
+    assert events[0]["fields"] == {"index": 7, "error": "timeout"}
+    assert bad_response.status_code == 400
+    print("test_get_raft_events", events)
+
+
+@pytest.mark.django_db
+def test_post_batch_order_validates_stock_once():
+    batch_data = {"orders": [{"name": "Tux", "quantity": 2}, {"name": "Lego", "quantity": 1}, {"name": "Tux", "quantity": 4}]}
+    no_stock = {"error": {"code": 400, "message": "No sufficient stock of Tux"}}
+
+    with requests_mock.Mocker() as m:
+        m.post(f"http://{CATALOG_SERVER_HOST}:{CATALOG_SERVER_PORT}/reservations/", json=no_stock, status_code=400)
+        response = process_post_batch_order_request(batch_data)
+        catalog_requests = m.request_history
+
+    # Tux is ordered 6 times in total, but only 5 are in stock, so nothing is ordered
+    assert response.status_code == 400
+    assert len(catalog_requests) == 1
+    assert catalog_requests[0].json()["orders"] == batch_data["orders"]
+    assert Order.objects.count() == 0
+    print("test_post_batch_order_validates_stock_once", response.status_code)
+
+
+@pytest.mark.django_db
+def test_post_order_confirms_or_releases_reservation():
+    reservations_url = f"http://{CATALOG_SERVER_HOST}:{CATALOG_SERVER_PORT}/reservations/"
+    with requests_mock.Mocker() as m:
+        m.post(reservations_url, json={"data": {"reservation_id": "r1", "ttl": 30}})
+        m.post(reservations_url + "r1/confirm/", json={"data": {}})
+        m.post(reservations_url + "r1/release/", json={"data": {}})
+        response = process_post_order_request({"name": "Tux", "quantity": 2})
+        with mock.patch.object(order_store, "add", side_effect=RuntimeError("disk full")):
+            failed_response = process_post_order_request({"name": "Tux", "quantity": 1})
+        paths = [request.path for request in m.request_history]
+
+    assert response.status_code == 200
+    assert failed_response.status_code == 500
+    # The committed order takes its stock for good, the failed one gives it back
+    assert paths == ["/reservations/", "/reservations/r1/confirm/", "/reservations/", "/reservations/r1/release/"]
+    assert list(Order.objects.values_list("product_name", "quantity")) == [("Tux", 2)]
+    print("test_post_order_confirms_or_releases_reservation", paths)
+
+
+def test_finish_reservation_retries_failed_confirm():
+    confirm_url = f"http://{CATALOG_SERVER_HOST}:{CATALOG_SERVER_PORT}/reservations/r1/confirm/"
+    with requests_mock.Mocker() as m, mock.patch("app.views.CONFIRM_RETRY_DELAY", 0.01):
+        m.post(confirm_url, [{"status_code": 503, "json": {}}, {"status_code": 500, "json": {}}, {"status_code": 200, "json": {"data": {}}}])
+        finish_reservation("r1", confirm=True)
+        for _ in range(100):
+            if m.call_count == 3:
+                break
+            time.sleep(0.01)
+        time.sleep(0.05)
+        calls = m.call_count
+
+    # Retried in the background until the catalog server accepts the confirm, then no more
+    assert calls == 3
+    print("test_finish_reservation_retries_failed_confirm", calls)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_raft_append_batch_commits_all_entries():
+    raft_instance = Raft(server_id="3", peers=[("3", "http://localhost:9002")])
+    raft_instance.load()
+    proposals = [("Buy 2 Tux", {"name": "Tux", "quantity": 2}), ("Buy 1 Lego", {"name": "Lego", "quantity": 1})]
+
+    async def propose():
+        raft_instance.loop = asyncio.get_running_loop()
+        raft_instance.currentState, raft_instance.currentTerm = RaftConfig.LEADER, 1
+        return await raft_instance.append_batch(1, proposals)
+
+    ok, orders = asyncio.run(propose())
+
+    assert ok
+    assert [(order.product_name, order.quantity) for order in orders] == [("Tux", 2), ("Lego", 1)]
+    assert raft_instance.commitIndex == 2
+    assert list(LogEntry.objects.order_by("index").values_list("index", "order_id")) == [(1, orders[0].order_number), (2, orders[1].order_number)]
+    print("test_raft_append_batch_commits_all_entries", [order.order_number for order in orders])
+
+
+@pytest.mark.django_db(transaction=True)
+def test_raft_resolves_proposals_that_timed_out():
+    peers = [("3", "http://localhost:9002"), ("2", "http://localhost:9003"), ("1", "http://localhost:9004")]
+    raft_instance = Raft(server_id="3", peers=peers)
+    raft_instance.load()
+    resolved = []
+
+    async def propose():
+        raft_instance.loop = asyncio.get_running_loop()
+        raft_instance.currentState, raft_instance.currentTerm = RaftConfig.LEADER, 1
+        # No peer answers, so neither proposal is committed in time
+        first = await raft_instance.append_entry(1, "Buy 2 Tux", {"name": "Tux", "quantity": 2}, on_resolved=lambda committed: resolved.append(("Tux", committed)))
+        second = await raft_instance.append_entry(1, "Buy 1 Lego", {"name": "Lego", "quantity": 1}, on_resolved=lambda committed: resolved.append(("Lego", committed)))
+        # A peer stored the first entry after all, then a new leader replaces the second one and commits its own
+        async with raft_instance.mu:
+            raft_instance.matchIndex["2"] = 1
+            await raft_instance.advance_commit_index()
+        await raft_instance.handle_append_entries({
+            "Term": 2, "LeaderId": "2", "PrevLogIndex": 1, "PrevLogTerm": 1, "LeaderCommit": 2,
+            "Entries": [{"index": 2, "term": 2, "command": "Buy 3 Uno", "order": {"product_name": "Uno", "quantity": 3}}],
+        })
+        for _ in range(100):
+            if len(resolved) == 2:
+                break
+            await asyncio.sleep(0.01)
+        return first, second
+
+    with mock.patch.object(RaftConfig, "PROPOSAL_TIMEOUT", timedelta(milliseconds=100)):
+        first, second = asyncio.run(propose())
+
+    # The outcome was unknown when the proposals returned, and is reported once it is
+    assert first == (None, None) and second == (None, None)
+    assert resolved == [("Tux", True), ("Lego", False)]
+    assert list(Order.objects.order_by("order_number").values_list("product_name", flat=True)) == ["Tux", "Uno"]
+    print("test_raft_resolves_proposals_that_timed_out", resolved)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_raft_new_leader_resolves_proposals_of_earlier_terms():
+    raft_instance = Raft(server_id="3", peers=[("3", "http://localhost:9002")])
+    raft_instance.load()
+    resolved = []
+    entry = {"index": 1, "term": 1, "command": "Buy 2 Tux", "order": {"product_name": "Tux", "quantity": 2}}
+    # An entry of term 1 whose proposal timed out, and no order is proposed after it
+    raft_instance.persist_entries([entry])
+    raft_instance.logs = [entry]
+    raft_instance.unresolved_proposals = [(1, 1, lambda committed: resolved.append(committed))]
+
+    async def elect():
+        raft_instance.loop = asyncio.get_running_loop()
+        async with raft_instance.mu:
+            raft_instance.currentTerm = 2
+            raft_instance.become_leader()
+        await raft_instance.persist_task
+        for _ in range(100):
+            if resolved:
+                break
+            await asyncio.sleep(0.01)
+
+    asyncio.run(elect())
+
+    # The no-op entry of the new term commits the entry before it
+    assert [entry["command"] for entry in raft_instance.logs] == ["Buy 2 Tux", RaftConfig.NOOP_COMMAND]
+    assert raft_instance.commitIndex == 2
+    assert resolved == [True]
+    assert list(Order.objects.values_list("product_name", "quantity")) == [("Tux", 2)]
+    assert list(LogEntry.objects.order_by("index").values_list("index", "command", "product_name")) == [(1, "Buy 2 Tux", "Tux"), (2, RaftConfig.NOOP_COMMAND, None)]
+    print("test_raft_new_leader_resolves_proposals_of_earlier_terms", resolved)
+
+
+def test_held_reservation_is_renewed_until_resolved():
+    reservation_url = f"http://{CATALOG_SERVER_HOST}:{CATALOG_SERVER_PORT}/reservations/r1/"
+    resolved = threading.Event()
+    with requests_mock.Mocker() as m, mock.patch("app.views.RESERVATION_RENEW_INTERVAL", 0.01):
+        m.post(reservation_url + "renew/", json={"data": {"reservation_id": "r1", "ttl": 30}})
+        m.post(reservation_url + "confirm/", json={"data": {}})
+        hold_reservation("r1", resolved)
+        for _ in range(100):
+            if m.call_count >= 2:
+                break
+            time.sleep(0.01)
+        resolve_held_reservation("r1", resolved, True)
+        time.sleep(0.05)
+        paths = [request.path for request in m.request_history]
+
+    # Renewed while the outcome was unknown, then confirmed and no longer renewed
+    assert paths[-1] == "/reservations/r1/confirm/"
+    assert len(paths) >= 3 and set(paths[:-1]) == {"/reservations/r1/renew/"}
+    assert m.request_history[0].json() == {"ttl": 30}
+    print("test_held_reservation_is_renewed_until_resolved", len(paths))
+
+
+@pytest.mark.django_db
+def test_replica_acks_orders_up_to_its_first_gap():
+    # A backup that has order 5, but misses 3 and 4
+    order_store.add([(1, "Tux", 1), (2, "Lego", 1), (5, "Uno", 1)])
+    status_data = json.loads(process_get_sync_status_request().content)["data"]
+    first = process_post_replicas_batch_order_request({"orders": [{"order_number": 3, "name": "Clue", "quantity": 1}]})
+    second = process_post_replicas_batch_order_request({"orders": [{"order_number": 4, "name": "Uno", "quantity": 2}]})
+
+    assert status_data == {"latest_order_number": 5, "contiguous_order_number": 2}
+    # The primary is not told about order 5 until 4 is stored, so it sends 4 next
+    assert json.loads(first.content)["data"]["acked"] == 3
+    assert json.loads(second.content)["data"]["acked"] == 5
+    print("test_replica_acks_orders_up_to_its_first_gap", status_data)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_replicator_backfills_orders_that_were_never_queued():
+    # Order 3 was stored on the primary by a sync, so it was never queued for the backups
+    order_store.add([(1, "Tux", 1), (2, "Lego", 1), (3, "Clue", 1), (4, "Uno", 1)])
+    # Backup 2 has the first two orders, backup 1 is down and keeps them queued
+    stored = {1, 2}
+
+    def store_batch(request, context):
+        stored.update(order["order_number"] for order in request.json()["orders"])
+        acked = 0
+        while acked + 1 in stored:
+            acked += 1
+        return {"data": {"acked": acked}}
+
+    replicator = Replicator("3", {"3": "8002", "2": "8003", "1": "8004"})
+    with requests_mock.Mocker() as m:
+        m.get("http://localhost:8003/sync/status/", json={"data": {"latest_order_number": 2, "contiguous_order_number": 2}})
+        m.post("http://localhost:8003/replicas/orders/batch/", json=store_batch)
+        m.get("http://localhost:8004/sync/status/", status_code=500)
+        # Queue the orders before the shippers start, so the first batch is read from the queue
+        replicator.started = True
+        replicator.enqueue([StoredOrder(number, name, quantity) for number, name, quantity in order_store.get_many([1, 2, 4])])
+        replicator.started = False
+        replicator.start()
+        for _ in range(50):
+            if replicator.replicas["2"].acked == 4:
+                break
+            time.sleep(0.1)
+        replicator.stop()
+        shipped = [[order["order_number"] for order in request.json()["orders"]] for request in m.request_history
+                   if request.method == "POST" and request.port == 8003]
+
+    # The queue skips order 3, the backup stops at 2, and the range after it is read from the database
+    assert shipped == [[4], [3, 4]]
+    assert replicator.get_status()["replicas"]["2"]["acked"] == 4
+    print("test_replicator_backfills_orders_that_were_never_queued", shipped)
+
+
+@pytest.mark.django_db
+def test_replicator_ships_batches_to_backups():
+    orders = [Order(order_number=1, product_name="Tux", quantity=2), Order(order_number=2, product_name="Lego", quantity=1)]
+    replicator = Replicator("3", {"3": "8002", "2": "8003"})
+
+    with requests_mock.Mocker() as m:
+        m.get("http://localhost:8003/sync/status/", json={"data": {"latest_order_number": 0, "contiguous_order_number": 0}})
+        m.post("http://localhost:8003/replicas/orders/batch/", json={"data": {"acked": 2}})
+        replicator.enqueue(orders)
+        for _ in range(50):
+            if replicator.replicas["2"].acked == 2:
+                break
+            time.sleep(0.1)
+        replicator.stop()
+        shipped = [request.json() for request in m.request_history if request.method == "POST"]
+
+    assert shipped == [{"orders": [
+        {"order_number": 1, "name": "Tux", "quantity": 2},
+        {"order_number": 2, "name": "Lego", "quantity": 1},
+    ]}]
+    status = replicator.get_status()
+    assert status["replicas"]["2"]["lag"] == 0
+    assert status["queued"] == 0
+    print("test_replicator_ships_batches_to_backups", status["replicas"]["2"]["acked"])
+
+
+@pytest.mark.django_db
+def test_post_replicas_batch_order_is_idempotent():
+    batch_data = {"orders": [{"order_number": 4, "name": "Tux", "quantity": 2}, {"order_number": 5, "name": "Lego", "quantity": 1}]}
+
+    process_post_replicas_batch_order_request(batch_data)
+    response = process_post_replicas_batch_order_request(batch_data)
+
+    assert response.status_code == 200
+    assert json.loads(response.content.decode("utf-8")) == {"data": {"acked": 5}}
+    assert list(Order.objects.order_by("order_number").values_list("order_number", "product_name")) == [(4, "Tux"), (5, "Lego")]
+    print("test_post_replicas_batch_order_is_idempotent", response.status_code)
+
+
+@pytest.mark.django_db
+def test_merkle_repair_only_touches_differing_range():
+    Order.objects.bulk_create([Order(order_number=number, product_name="Tux", quantity=1) for number in range(1, 3001)])
+    tree = MerkleTree()
+    tree.refresh()
+    # The peer has the same orders, except another quantity for order 2500
+    peer_tree = MerkleTree()
+    peer_tree.nodes, peer_tree.built = copy.deepcopy(tree.nodes), True
+    Order.objects.filter(order_number=2500).update(quantity=7)
+    peer_tree.mark_dirty([2500])
+    peer_tree.refresh()
+    Order.objects.filter(order_number=2500).update(quantity=1)
+
+    def merkle_node(request, context):
+        return {"data": peer_tree.get_node(int(request.qs["level"][0]), int(request.qs["index"][0]))}
+
+    with requests_mock.Mocker() as m:
+        m.get("http://localhost:8003/merkle/", json=merkle_node)
+        peer_orders = "".join(json.dumps({"order_number": number, "product_name": "Tux", "quantity": 7 if number == 2500 else 1}) + "\n" for number in range(2049, 3001))
+        m.get("http://localhost:8003/sync/orders/?after=2048&to=3072", text=peer_orders + '{"cursor": 3000, "more": false}\n')
+        result = repair_from_peer(tree, "2")
+        sync_requests = [request for request in m.request_history if "/sync/orders/" in request.url]
+
+    # Only the path to the leaf of order 2500 is compared, and only that leaf's range is fetched
+    assert result == {"peer": "2", "nodes_compared": 7, "ranges": 1, "inserted": 0, "updated": 1, "local_only": 0}
+    assert len(sync_requests) == 1
+    assert Order.objects.get(order_number=2500).quantity == 7
+    assert tree.get_node()["hash"] == peer_tree.get_node()["hash"]
+    print("test_merkle_repair_only_touches_differing_range", result)